@@ -1,8 +1,7 @@
 import time
-import requests
 import threading
 import logging
-from flask import Flask
+from flask import Flask, Response, jsonify
 from waitress import serve
 from flask_cors import CORS
 from urllib.parse import urljoin
@@ -13,8 +12,12 @@ import json
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
 from ML_server.config import Config
+from ML_server.platform_client import get_platform_client
 from common.models import TaskPackage, ProcessingMode, PackageStatus
 from ML_server.jobs import Job
+from ML_server.scheduler import JobScheduler, JobSlot
+from ML_server.metrics import get_metrics
+from ML_server.checkpoint import remove_stale_workspaces
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,25 +27,66 @@ app = Flask(__name__)
 CORS(app)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Server started by run_active_server, reported by the health endpoints
+_active_server = None
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(get_metrics().render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/health')
+def health():
+    """The process is alive"""
+    slots = _active_server.scheduler.active_tasks() if _active_server else {}
+    return jsonify({'status': 'ok', 'slots': slots})
+
+
+@app.route('/ready')
+def ready():
+    """The server claims and runs packages"""
+    if _active_server is None or not _active_server.is_ready():
+        return jsonify({'status': 'not ready'}), 503
+    return jsonify({'status': 'ready'})
 
 
 class ActiveServer:
     def __init__(self,
-                 get_package_url=Config().GET_PACKAGE_URL,
+                 claim_package_url=Config().CLAIM_PACKAGE_URL,
+                 wait_package_url=Config().WAIT_PACKAGE_URL,
+                 package_heartbeat_url=Config().PACKAGE_HEARTBEAT_URL,
                  status_update_url=Config().STATUS_UPDATE_URL,
                  update_package_status=Config().UPDATE_PACKAGE_STATUS,
                  result_upload_url=Config().RESULT_UPLOAD_URL,
-                 check_interval=10):
-        self.get_package_url = get_package_url
+                 check_interval=10,
+                 job_slots=Config().JOB_SLOTS,
+                 max_concurrent_jobs=Config().MAX_CONCURRENT_JOBS):
+        self.claim_package_url = claim_package_url
+        self.wait_package_url = wait_package_url
+        self.use_long_poll = Config().USE_LONG_POLL
+        self.package_heartbeat_url = package_heartbeat_url
+        self.worker_id = Config().WORKER_ID
         self.status_update_url = status_update_url
         self.update_package_status = update_package_status
         self.result_upload_url = result_upload_url
         self.check_interval = check_interval
+        self.client = get_platform_client()
+        self.checker_thread = None
 
-        self._task_lock = threading.Lock()
-        self._is_busy = False
-        self.current_task = None
+        # Workspaces of interrupted jobs are kept for resuming, unless nobody claimed them for too long
+        remove_stale_workspaces(Config().CHECKPOINT_MAX_AGE)
 
+        self.scheduler = JobScheduler(
+            job_runner=self._run_job,
+            slots_per_mode=job_slots,
+            max_concurrent_jobs=max_concurrent_jobs
+        )
+        self.scheduler.start()
+
+
+    def is_ready(self) -> bool:
+        return self.checker_thread is not None and self.checker_thread.is_alive()
 
     def build_full_url(self, url):
         if url.startswith('https'):
@@ -50,112 +94,108 @@ class ActiveServer:
 
         return urljoin(Config().BASE_URL, url)
 
-    def process_package(self, package_data: dict) -> bool:
+    def reset_package_status(self, package_id: int) -> None:
+        """Return the package to the CREATED status so it can be claimed again, it was not run so it is no failed attempt"""
         try:
-            with self._task_lock:
-                self._is_busy = True
-                self.current_task = TaskPackage.model_validate(package_data)
-
-            self.current_task.package = self.build_full_url(self.current_task.package)
-            self.current_task.label_properties = self.build_full_url(self.current_task.label_properties)
-
-            # Create an instance of Job and start it in a separate thread
-            job = Job(
-                task_package=self.current_task,
-                status_update_url=self.status_update_url,
-                update_package_status=self.update_package_status,
-                result_upload_url=self.result_upload_url
+            self.client.put(
+                self.update_package_status + str(package_id) + '/',
+                json={'package_id': package_id, 'package_status': PackageStatus.CREATED, 'worker': self.worker_id,
+                      'released': True}
             )
+        except Exception as e:
+            logger.error(f"Error resetting package status: {e}")
 
-            # Start job processing in a separate thread
-            job_thread = threading.Thread(target=self._run_job, args=(job,))
-            job_thread.start()
+    def process_package(self, package_data: dict) -> bool:
+        try:
+            task_package = TaskPackage.model_validate(package_data)
+            task_package.package = self.build_full_url(task_package.package)
+            task_package.label_properties = self.build_full_url(task_package.label_properties)
+
+            # The package waits in the queue of its mode until a slot takes it
+            if not self.scheduler.submit(task_package):
+                raise RuntimeError(f"No free slot for mode: {task_package.mode}")
             return True
 
         except Exception as e:
-            requests.put(
-                        self.update_package_status + str(package_data['package_id']) + '/',
-                        json={'package_id': package_data['package_id'], 'package_status': PackageStatus.CREATED},
-                        headers=Config().authorization(),
-                        verify=False
-                    )
-
             logger.error(f"Error processing package: {e}")
-            # We release the server only when the error of creating a task
-            with self._task_lock:
-                self._is_busy = False
-                self.current_task = None
             return False
 
-    def _run_job(self, job: Job):
+    def _run_job(self, task_package: TaskPackage, slot: JobSlot):
+        job = Job(
+            task_package=task_package,
+            status_update_url=self.status_update_url,
+            update_package_status=self.update_package_status,
+            result_upload_url=self.result_upload_url,
+            workspace=slot.workspace,
+            package_heartbeat_url=self.package_heartbeat_url,
+            worker_id=self.worker_id
+        )
         try:
             success = job.run()
             if not success:
-                logger.error("Job failed to complete")
+                logger.error(f"Job for package {task_package.package_id} failed to complete")
         except Exception as e:
             logger.error(f"Error running job: {e}")
-            job.update_package_status(PackageStatus.CREATED)
-        finally:
-            # We free the server after the completion of the task (successful or not)
-            with self._task_lock:
-                self._is_busy = False
-                self.current_task = None
-            logger.info("Server is now free")
+            job.update_package_status_for_PI(PackageStatus.CREATED)
+
+    def wait_for_package(self, modes) -> bool:
+        """
+        Long-poll the platform until a package of the given modes is created
+
+        Returns:
+            bool: False if long-polling is not available and the caller has to fall back to polling
+        """
+        try:
+            timeout = Config().LONG_POLL_TIMEOUT
+            response = self.client.get(
+                self.wait_package_url,
+                params={'mode': [mode.value for mode in modes], 'timeout': timeout},
+                timeout=(self.client.timeout[0], timeout + 10)
+            )
+            if response.status_code == 200:
+                return True
+            logger.error(f"Package long-poll failed: {response.status_code}")
+        except Exception as e:
+            logger.error(f"Error in package long-poll: {e}")
+        return False
 
     def check_packages(self):
         while True:
-            if self._is_busy:
-                time.sleep(self.check_interval)
+            accepting_modes = self.scheduler.accepting_modes()
+            if not accepting_modes:
+                # Woken up as soon as a slot finishes its job
+                self.scheduler.wait_for_capacity(self.check_interval)
                 continue
 
             try:
-                # Requesting a new package
-                response = requests.get(
-                    self.get_package_url,
-                    headers=Config().authorization(),
-                    verify=False
+                # Claiming a package is atomic on the platform side: the package is leased
+                # to this worker and already switched to IN_PROGRESS
+                response = self.client.post(
+                    self.claim_package_url,
+                    json={
+                        'modes': [mode.value for mode in accepting_modes],
+                        'worker': self.worker_id,
+                        'lease_seconds': Config().LEASE_SECONDS
+                    }
                 )
 
-
-                if response.status_code == 200 and response.json().get('package_status') == PackageStatus.CREATED:
-                    logger.info("Package available")
+                if response.status_code == 200:
                     package = response.json()
-
-                    # Check if the processing mode is supported
-                    if package['mode'] in (ProcessingMode.DETECTION, ProcessingMode.SEGMENTATION):
-                        # Update the status of the package to "in processing"
-                        try:
-                            update_response = requests.put(
-                                self.update_package_status + str(package['package_id']) + '/',
-                                json={'package_id': package['package_id'], 'package_status': PackageStatus.IN_PROGRESS},
-                                headers=Config().authorization(),
-                                verify=False
-                            )
-                            if update_response.status_code == 200:
-                                # Start processing the packet
-                                if not self.process_package(package):
-                                    # If it was not possible to start processing, reset the status of the package
-                                    logger.error("Failed to start package processing")
-                                    requests.put(
-                                        self.update_package_status + str(package['package_id']) + '/',
-                                        json={'package_id': package['package_id'],
-                                              'package_status': PackageStatus.CREATED},
-                                        headers=Config().authorization(),
-                                        verify=False
-                                    )
-                            else:
-                                logger.error(f"Failed to update package status: {update_response.status_code}")
-                        except Exception as e:
-                            logger.error(f"Error updating package status: {e}")
-                    else:
-                        logger.error(f"Unsupported processing mode: {package['mode']}")
-                        # Return the package to the status of Created, because We cannot process it
-                        requests.put(
-                            self.update_package_status + str(package['package_id']) + '/',
-                            json={'package_id': package['package_id'], 'package_status': PackageStatus.CREATED},
-                            headers=Config().authorization(),
-                            verify=False
-                        )
+                    logger.info(f"Package {package['package_id']} claimed")
+
+                    # Start processing the packet
+                    if self.process_package(package):
+                        # Another slot may still be free, ask for the next package right away
+                        continue
+                    # If it was not possible to start processing, reset the status of the package
+                    logger.error("Failed to start package processing")
+                    self.reset_package_status(package['package_id'])
+                elif response.status_code == 404:
+                    # Nothing to claim, wait for the platform to announce a new package
+                    if self.use_long_poll and self.wait_for_package(accepting_modes):
+                        continue
+                else:
+                    logger.error(f"Failed to claim package: {response.status_code}")
 
             except Exception as e:
                 logger.error(f"Error in package checking: {e}")
@@ -164,12 +204,18 @@ class ActiveServer:
 
 
 def start_package_checker(active_server):
-    threading.Thread(target=active_server.check_packages, daemon=True).start()
+    active_server.checker_thread = threading.Thread(target=active_server.check_packages, daemon=True)
+    active_server.checker_thread.start()
 
 
 def run_active_server():
+    global _active_server
     active_server = ActiveServer()
     start_package_checker(active_server)
+    _active_server = active_server
+    # torch is imported here and not at module level, spawned worker processes re-import this module
+    from common.tools.clear_routines import log_gpu_memory
+    log_gpu_memory()
     logger.info("Starting active server")
     serve(app, host='*', port=8000)
 
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from typing import Iterable, List, Optional, Set
+
+from quantitave_analysis.models.config import Config
+
+logger = logging.getLogger()
+
+STATE_FILE = 'checkpoint.json'
+JOURNAL_FILE = 'uploaded.log'
+
+
+class JobCheckpoint:
+    """
+    Progress of one package kept on disk next to its workspace.
+
+    checkpoint.json records the digest of the package and the finished stages,
+    uploaded.log is an append-only journal of uploaded images, so recording an
+    image costs one short write. A checkpoint written for a different version of
+    the package (package IDs are reused by the platform) is discarded on load.
+    """
+
+    def __init__(self, workspace: str, package_id: int, digest: str):
+        self.workspace = workspace
+        self.package_id = package_id
+        self.digest = digest
+        self.stages: List[str] = []
+        self._uploaded: Set[str] = set()
+        self._lock = threading.Lock()
+        self._state_path = os.path.join(workspace, STATE_FILE)
+        self._journal_path = os.path.join(workspace, JOURNAL_FILE)
+
+    @property
+    def resumed(self) -> bool:
+        """The checkpoint holds progress of an earlier run"""
+        return bool(self.stages or self._uploaded)
+
+    def load(self) -> bool:
+        """
+        Load the progress of an earlier run of the same package version
+
+        Returns:
+            bool: True if there is progress to resume from, the workspace is reset otherwise
+        """
+        try:
+            with open(self._state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = None
+        except (json.JSONDecodeError, IOError) as e:
+            logger.warning(f"Checkpoint of package {self.package_id} is unreadable: {e}")
+            state = None
+
+        if not state or state.get('digest') != self.digest:
+            if state:
+                logger.info(f"Package {self.package_id} changed since the checkpoint, starting over")
+            self.reset()
+            return False
+
+        self.stages = list(state.get('stages', []))
+        try:
+            with open(self._journal_path, 'r', encoding='utf-8') as f:
+                self._uploaded = {line.rstrip('\n') for line in f if line.strip()}
+        except FileNotFoundError:
+            self._uploaded = set()
+        logger.info(f"Resuming package {self.package_id}: finished stages {self.stages}, "
+                    f"{len(self._uploaded)} images already uploaded")
+        return self.resumed
+
+    def reset(self) -> None:
+        """Remove the workspace and start a new checkpoint in it"""
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        os.makedirs(self.workspace, exist_ok=True)
+        self.stages = []
+        self._uploaded = set()
+        self._save()
+
+    def _save(self) -> None:
+        state = {
+            'package_id': self.package_id,
+            'digest': self.digest,
+            'stages': self.stages,
+            'updated_at': time.time()
+        }
+        temp_path = self._state_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._state_path)
+
+    def is_done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def mark_done(self, stage: str) -> None:
+        with self._lock:
+            if stage not in self.stages:
+                self.stages.append(stage)
+                self._save()
+
+    def is_uploaded(self, key: str) -> bool:
+        with self._lock:
+            return key in self._uploaded
+
+    def mark_uploaded(self, keys: Iterable[str]) -> None:
+        """Journal images whose results were accepted by the platform"""
+        with self._lock:
+            new_keys = [key for key in keys if key not in self._uploaded]
+            if not new_keys:
+                return
+            with open(self._journal_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(key + '\n' for key in new_keys))
+                f.flush()
+                os.fsync(f.fileno())
+            self._uploaded.update(new_keys)
+
+    def remove(self) -> None:
+        """Drop the workspace after the package is finished"""
+        shutil.rmtree(self.workspace, ignore_errors=True)
+
+
+def remove_stale_workspaces(max_age: float, root: str = Config().PACKAGE_WORKSPACES_FOLDER) -> None:
+    """
+    Remove package workspaces that were not resumed for max_age seconds
+
+    Args:
+        max_age: Age in seconds after which a checkpoint is dropped
+        root: Folder with the package workspaces
+    """
+    if not os.path.isdir(root):
+        return
+    now = time.time()
+    for name in os.listdir(root):
+        workspace = os.path.join(root, name)
+        paths = [os.path.join(workspace, STATE_FILE), os.path.join(workspace, JOURNAL_FILE), workspace]
+        try:
+            modified = max(os.path.getmtime(path) for path in paths if os.path.exists(path))
+        except (OSError, ValueError):
+            continue
+        if now - modified > max_age:
+            logger.info(f"Removing stale package workspace {workspace}")
+            shutil.rmtree(workspace, ignore_errors=True)
+
+
+def package_workspace(package_id: int, root: str = Config().PACKAGE_WORKSPACES_FOLDER) -> str:
+    return os.path.join(root, str(package_id))
+
+
+def checkpoint_key(record_id: str, filename: Optional[str] = None) -> str:
+    """Key of one image of a record in the upload journal"""
+    return f"{record_id}/{filename}" if filename else str(record_id)
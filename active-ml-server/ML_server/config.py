@@ -1,8 +1,11 @@
 from pydantic import BaseModel
-import requests
-from typing import ClassVar, Dict, Any
+import os
+import socket
+from typing import ClassVar, Dict, Any, Tuple
 import urllib3
 
+from common.models import ProcessingMode
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
@@ -10,11 +13,56 @@ class Config(BaseModel):
     # Define your configuration fields with type hints and default values
     BASE_URL: str = 'https://localhost'
     GET_TOKEN_URL: str = BASE_URL + '/api/token_9fqmnqe010opnsvq9ql/'
+    REFRESH_TOKEN_URL: str = BASE_URL + '/api/refresh_token_gn240202ns301f1/'
     GET_PACKAGE_URL: str = BASE_URL + '/api/package/'
+    CLAIM_PACKAGE_URL: str = BASE_URL + '/api/package/claim/'
+    WAIT_PACKAGE_URL: str = BASE_URL + '/api/package/wait/'
+    PACKAGE_HEARTBEAT_URL: str = BASE_URL + '/api/package_heartbeat/'
     STATUS_UPDATE_URL: str = BASE_URL + '/api/status_mfdqofn19101f/'
     UPDATE_PACKAGE_STATUS: str = BASE_URL + '/api/package_status/'
     RESULT_UPLOAD_URL: str = BASE_URL + '/api/processed_package/'
 
+    # Number of jobs the server runs concurrently for each processing mode
+    JOB_SLOTS: Dict[ProcessingMode, int] = {
+        ProcessingMode.SEGMENTATION: 1,
+        ProcessingMode.DETECTION: 1
+    }
+    # Number of jobs the server runs concurrently across all modes. Jobs share one GPU,
+    # so by default a single job runs at a time; raise it to let the modes run in parallel
+    MAX_CONCURRENT_JOBS: int = 1
+
+    # Platform client: (connect, read) timeout in seconds, retries of idempotent requests,
+    # size of the keep-alive pool and how long before expiration the access token is renewed
+    REQUEST_TIMEOUT: Tuple[float, float] = (10.0, 120.0)
+    REQUEST_RETRIES: int = 3
+    CONNECTION_POOL_SIZE: int = 10
+    TOKEN_LEEWAY: int = 60
+
+    # Package lease held by this server, it is extended by heartbeats while the job runs
+    WORKER_ID: str = f"{socket.gethostname()}-{os.getpid()}"
+    LEASE_SECONDS: int = 120
+    HEARTBEAT_INTERVAL: int = 30
+
+    # Inference packages run download, inference and upload as concurrent stages
+    STREAMING_PIPELINE: bool = True
+    PIPELINE_QUEUE_SIZE: int = 16
+
+    # Jobs keep their progress in a per-package workspace and resume from it after a restart,
+    # workspaces of packages that were not claimed again are removed after CHECKPOINT_MAX_AGE seconds
+    CHECKPOINT_JOBS: bool = True
+    CHECKPOINT_MAX_AGE: int = 7 * 24 * 3600
+
+    # Package files are downloaded in one request from the package archive when the platform offers it
+    USE_PACKAGE_ARCHIVE: bool = True
+
+    # The files of the last training package of a dataset are kept, so an incremental
+    # training package only has to carry the records changed since then
+    RETAIN_TRAINING_SETS: bool = True
+
+    # Long-poll for new packages, the server falls back to polling if it is unavailable
+    USE_LONG_POLL: bool = True
+    LONG_POLL_TIMEOUT: int = 25
+
     data_user: ClassVar[Dict[str, Any]] =  {  # user
         "username": "user",
         "password": "userpass"
@@ -28,14 +76,9 @@ class Config(BaseModel):
 
     # Server authorization
     def authorization(self):
-        response = requests.post(self.GET_TOKEN_URL, json=self.data_user, verify=False)
-        tokens = response.json()
-        access_token = tokens.get("access")
-        headers = {
-            "Authorization": "Bearer " + access_token
-        }
-
-        return headers
+        # The token is cached by the shared platform client
+        from ML_server.platform_client import get_platform_client
+        return get_platform_client().auth_headers()
 
 # Create an instance of the Config class
 config = Config()
\ No newline at end of file
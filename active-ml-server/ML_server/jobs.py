@@ -1,14 +1,19 @@
-import requests
+import os
+import hashlib
+import importlib
 import logging
 import threading
 from types import MappingProxyType
 from collections.abc import Mapping
-from typing import Type
+from typing import Iterable, Optional, Type
 import urllib3
 
 from quantitave_analysis.utils.temporary_storage import TemporaryStorageManager
 from quantitave_analysis.models.config import Config
 from ML_server.config import Config as ConfigServer
+from ML_server.platform_client import get_platform_client
+from ML_server.metrics import get_metrics, folder_stats
+from ML_server.checkpoint import JobCheckpoint, package_workspace, checkpoint_key
 from common.models import TaskPackage, TaskType, PackageStatus, ProcessingMode
 from common.platform_to_task_converter.segmentation_converter import SegmentationPlatformToTaskConverter
 from common.platform_to_task_converter.detection_converter import DetectionPlatformToTaskConverter
@@ -17,8 +22,7 @@ from common.results_to_platform_converter.base import BaseResultsToPlatformConve
 from common.results_to_platform_converter.segmentation_converter import SegmentationResultsToPlatformConverter
 from common.results_to_platform_converter.detection_converter import DetectionResultsToPlatformConverter
 from ML_server.ml_routines.base import MLRoutinesBase
-from ML_server.ml_routines.segmentation_routines import SegmentationRoutines
-from ML_server.ml_routines.detection_routines import DetectionRoutines
+from ML_server.pipeline import StreamingInferencePipeline
 
 logger = logging.getLogger()
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -33,57 +37,210 @@ CONVERTERS_RESULTS_TO_PLATFORM: Mapping[ProcessingMode, Type[BaseResultsToPlatfo
     ProcessingMode.DETECTION: DetectionResultsToPlatformConverter
 })
 
-ROUTINES: Mapping[ProcessingMode, Type[MLRoutinesBase]] = MappingProxyType({
-    ProcessingMode.SEGMENTATION: SegmentationRoutines,
-    ProcessingMode.DETECTION: DetectionRoutines
+# Routines import torch and autogluon, so they are imported by the first job of the mode. Worker pools
+# are spawned and re-import the server modules, which must not load the model stack in every worker.
+ROUTINES: Mapping[ProcessingMode, str] = MappingProxyType({
+    ProcessingMode.SEGMENTATION: 'ML_server.ml_routines.segmentation_routines.SegmentationRoutines',
+    ProcessingMode.DETECTION: 'ML_server.ml_routines.detection_routines.DetectionRoutines'
 })
 
 
+def create_ml_routine(mode: ProcessingMode) -> MLRoutinesBase:
+    """Create the ML routine of the processing mode, its module is imported on first use"""
+    module_name, class_name = ROUTINES[mode].rsplit('.', 1)
+    routine_class: Type[MLRoutinesBase] = getattr(importlib.import_module(module_name), class_name)
+    return routine_class()
+
+
+class LeaseLostError(Exception):
+    """The platform gave the package lease to another worker"""
+
+
 class Job:
     def __init__(self,
                  task_package: TaskPackage,
                  status_update_url,
                  update_package_status,
-                 result_upload_url):
+                 result_upload_url,
+                 workspace: Optional[str] = None,
+                 package_heartbeat_url: Optional[str] = None,
+                 worker_id: Optional[str] = None):
         self.task_package = task_package
-        self.upload_folder = Config().UPLOAD_FOLDER
-        self.processed_folder = Config().PROCESSED_FOLDER
+        if workspace:
+            # Every scheduler slot keeps its data apart so that jobs can run side by side
+            self.set_workspace(workspace)
+        else:
+            self.upload_folder = Config().UPLOAD_FOLDER
+            self.processed_folder = Config().PROCESSED_FOLDER
+            self.return_folder = Config().RETURN_FOLDER
+        self.checkpoint: Optional[JobCheckpoint] = None
         self.models_directory = Config().ALL_MODELS_FOLDER
-        self.return_folder = Config().RETURN_FOLDER
         self.status_update_url = status_update_url
         self.update_package_status = update_package_status
         self.result_upload_url = result_upload_url
         self.storage_manager = TemporaryStorageManager()
+        self.client = get_platform_client()
+        self.package_heartbeat_url = package_heartbeat_url
+        self.worker_id = worker_id
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        # Set when the lease is lost, the job stops and leaves the package to its new worker
+        self.lease_lost = threading.Event()
+
+
+    def set_workspace(self, workspace: str) -> None:
+        self.upload_folder = os.path.join(workspace, 'uploads')
+        self.processed_folder = os.path.join(workspace, 'processed')
+        self.return_folder = os.path.join(workspace, 'return_files')
+
+    def package_digest(self) -> Optional[str]:
+        """
+        Digest of the package content, the platform reuses package IDs for new data
+
+        Returns:
+            str: sha256 of the task, the mode and the package data, None if the package can not be read
+        """
+        try:
+            response = self.client.get(self.task_package.package)
+            response.raise_for_status()
+        except Exception as e:
+            logger.error(f"Error reading package for checkpoint: {e}")
+            return None
+        digest = hashlib.sha256()
+        digest.update(f"{self.task_package.task.value}:{self.task_package.mode.value}:".encode())
+        digest.update(response.content)
+        return digest.hexdigest()
 
+    def open_checkpoint(self) -> None:
+        """Move the job to the workspace of its package and load the progress of an earlier run"""
+        if not ConfigServer().CHECKPOINT_JOBS:
+            return
+        digest = self.package_digest()
+        if digest is None:
+            return
+        workspace = package_workspace(self.task_package.package_id)
+        self.checkpoint = JobCheckpoint(workspace, self.task_package.package_id, digest)
+        self.checkpoint.load()
+        self.set_workspace(workspace)
+
+    def stage_done(self, stage: str) -> bool:
+        return self.checkpoint is not None and self.checkpoint.is_done(stage)
+
+    def mark_stage_done(self, stage: str) -> None:
+        if self.checkpoint is not None:
+            self.checkpoint.mark_done(stage)
+
+    def is_uploaded(self, key: str) -> bool:
+        """The result of the image was uploaded by an interrupted run of the job"""
+        return self.checkpoint is not None and self.checkpoint.is_uploaded(key)
+
+    def is_file_uploaded(self, record_id: str, filename: str) -> bool:
+        return self.is_uploaded(checkpoint_key(record_id, filename))
+
+    def mark_uploaded(self, keys: Iterable[str]) -> None:
+        if self.checkpoint is not None:
+            self.checkpoint.mark_uploaded(keys)
+
+    def finish_checkpoint(self) -> None:
+        """The package is done, its workspace is not needed anymore"""
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+            self.checkpoint = None
 
     def send_status(self, status: str) -> None:
         """Send status updates to the platform"""
         try:
-            response = requests.put(
+            response = self.client.put(
                 self.status_update_url,
-                json={'status': status, 'dataset_id': self.task_package.dataset_id},
-                headers=ConfigServer().authorization(),
-                verify=False
+                json={'status': status, 'dataset_id': self.task_package.dataset_id}
             )
             logger.info(f"Status sent: {status}, Dataset ID: {self.task_package.dataset_id} Response: {response.status_code}")
         except Exception as e:
             logger.error(f"Error sending status: {e}")
 
     def update_package_status_for_PI(self, package_status_PI: str = PackageStatus.DONE) -> None:
-        """Update package status to DONE (or CREATED if error)"""
+        """
+        Update package status to DONE (or CREATED if error), skipped when the lease is lost
+        The platform counts a CREATED status as a failed run, retries the package later and marks it FAILED at the limit
+        """
+        if self.lease_lost.is_set():
+            logger.warning(f"Lease of package {self.task_package.package_id} is lost, status {package_status_PI} is not sent")
+            return
         try:
-            response = requests.put(
+            response = self.client.put(
                 self.update_package_status + str(self.task_package.package_id) + '/',
-                json={'package_status': package_status_PI},
-                headers=ConfigServer().authorization(),
-                verify=False
+                json={'package_status': package_status_PI, 'worker': self.worker_id}
             )
+            if response.status_code == 409:
+                logger.error(f"Lease of package {self.task_package.package_id} is lost, status {package_status_PI} is rejected")
+                self.lease_lost.set()
+                return
             logger.info(f"Status sent: {package_status_PI}, Response: {response.status_code}")
         except Exception as e:
             logger.error(f"Error updating package status: {e}")
 
+    def ensure_lease(self) -> None:
+        """Stop the job between stages once the lease is lost"""
+        if self.lease_lost.is_set():
+            raise LeaseLostError(f"Lease of package {self.task_package.package_id} is lost")
+
+    def send_heartbeat(self) -> bool:
+        """
+        Extend the lease of the package on the platform
+
+        Returns:
+            bool: False if the lease is no longer held by this worker
+        """
+        try:
+            response = self.client.put(
+                self.package_heartbeat_url + str(self.task_package.package_id) + '/',
+                json={'worker': self.worker_id, 'lease_seconds': ConfigServer().LEASE_SECONDS}
+            )
+            if response.status_code == 409:
+                logger.error(f"Lease of package {self.task_package.package_id} is lost")
+                return False
+            if response.status_code != 200:
+                logger.error(f"Heartbeat failed: {response.status_code}")
+        except Exception as e:
+            logger.error(f"Error sending heartbeat: {e}")
+        return True
+
+    def _heartbeat_loop(self) -> None:
+        while not self._heartbeat_stop.wait(ConfigServer().HEARTBEAT_INTERVAL):
+            if not self.send_heartbeat():
+                self.lease_lost.set()
+                break
+
+    def start_heartbeat(self) -> None:
+        """Keep the package lease alive while the job is running"""
+        if not self.package_heartbeat_url or not self.worker_id:
+            return
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(
+            target=self._heartbeat_loop,
+            name=f"heartbeat-{self.task_package.package_id}",
+            daemon=True
+        )
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self) -> None:
+        self._heartbeat_stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
     def prepare_directories(self) -> None:
-        """Prepare directories for processing"""
+        """Prepare directories for processing, folders of stages finished by an earlier run are kept"""
+        if self.checkpoint is not None and self.checkpoint.resumed:
+            for folder, stage in ((self.upload_folder, 'download'),
+                                  (self.processed_folder, 'create_dataset'),
+                                  (self.return_folder, 'predict')):
+                if self.stage_done(stage):
+                    os.makedirs(folder, exist_ok=True)
+                else:
+                    self.storage_manager.reset_directory(folder)
+            return
+
         # Ensure upload folder exists
         self.storage_manager.reset_directory(self.upload_folder)
         self.storage_manager.reset_directory(self.processed_folder)
@@ -93,34 +250,103 @@ class Job:
             self.storage_manager.reset_directory(self.return_folder)
 
 
+    def run_streaming_inference(self) -> bool:
+        """Run inference with download, prediction and upload overlapping each other"""
+        self.send_status('INFERENCE')
+        pipeline = StreamingInferencePipeline(
+            data_processor=CONVERTERS_PLATFORM_TO_TASK[self.task_package.mode](),
+            ml_routine=create_ml_routine(self.task_package.mode),
+            post_processor=CONVERTERS_RESULTS_TO_PLATFORM[self.task_package.mode](),
+            queue_size=ConfigServer().PIPELINE_QUEUE_SIZE,
+            mode=self.task_package.mode.value,
+            checkpoint=self.checkpoint,
+            stop=self.lease_lost
+        )
+        success = pipeline.run(
+            self.task_package.package,
+            self.task_package.label_properties,
+            self.upload_folder,
+            self.return_folder,
+            self.result_upload_url,
+            self.task_package.package_id,
+            self.task_package.dataset_id
+        )
+
+        if success:
+            self.finish_checkpoint()
+            self.update_package_status_for_PI()
+        else:
+            logger.error("Streaming inference failed")
+            self.update_package_status_for_PI(PackageStatus.CREATED)
+        self.send_status('FREE')
+        return success
+
     def run(self) -> bool:
         """Run the job processing pipeline"""
+        self.start_heartbeat()
+        success = False
+        try:
+            success = self._run()
+            return success
+        finally:
+            self.stop_heartbeat()
+            get_metrics().count_job(self.task_package.mode.value, self.task_package.task.value,
+                                    'success' if success else 'failure')
+
+    def _run(self) -> bool:
+        """Run the steps of the job, every step is measured as a stage in the server metrics"""
+        metrics = get_metrics()
+        mode = self.task_package.mode.value
         try:
+            self.open_checkpoint()
             self.prepare_directories()
 
+            if self.task_package.task == TaskType.INFERENCE and ConfigServer().STREAMING_PIPELINE:
+                return self.run_streaming_inference()
+
             # Step 1: Data Processing - Download and prepare data
             data_processor = CONVERTERS_PLATFORM_TO_TASK[self.task_package.mode]()
             if not data_processor:
                 raise ValueError(f"No processor available for mode: {self.task_package.mode}")
 
-            if not data_processor.run(self.task_package.package, self.task_package.label_properties, self.upload_folder):
-                logger.error("Data processing failed")
-                return False
+            if not self.stage_done('download'):
+                with metrics.stage('download', mode) as stage:
+                    # Images of an inference package uploaded by an interrupted run are not downloaded again
+                    skip_file = self.is_file_uploaded if self.task_package.task == TaskType.INFERENCE else None
+                    download_success = data_processor.run(
+                        self.task_package.package, self.task_package.label_properties, self.upload_folder,
+                        skip_file=skip_file)
+                    stage.failed = not download_success
+                    stage.add(*folder_stats(self.upload_folder))
+                if not download_success:
+                    logger.error("Data processing failed")
+                    return False
+                self.mark_stage_done('download')
+
+            self.ensure_lease()
 
             # Step 2: ML Processing - Run train or inference
-            ml_routine = ROUTINES[self.task_package.mode]()
+            ml_routine = create_ml_routine(self.task_package.mode)
             if not ml_routine:
                 raise ValueError(f"No ML routine available for mode: {self.task_package.mode}")
 
             if self.task_package.task == TaskType.TRAIN:
                 # Training workflow
-                self.send_status('CREATE DATASET')
-                ml_routine.create_dataset(self.upload_folder, self.processed_folder)
+                if not self.stage_done('create_dataset'):
+                    self.send_status('CREATE DATASET')
+                    with metrics.stage('create_dataset', mode) as stage:
+                        ml_routine.create_dataset(self.upload_folder, self.processed_folder)
+                        stage.add(*folder_stats(self.processed_folder))
+                    self.mark_stage_done('create_dataset')
 
+                self.ensure_lease()
                 self.send_status('TRAINING')
-                train_success = ml_routine.train(self.processed_folder, self.models_directory, self.task_package.dataset_id)
+                with metrics.stage('train', mode) as stage:
+                    train_success = ml_routine.train(self.processed_folder, self.models_directory, self.task_package.dataset_id)
+                    stage.failed = not train_success
 
                 if train_success:
+                    self.finish_checkpoint()
                     self.update_package_status_for_PI()
                 else:  
                     self.update_package_status_for_PI(PackageStatus.CREATED)
@@ -129,20 +355,34 @@ class Job:
 
             elif self.task_package.task == TaskType.INFERENCE:
                 # Inference workflow
-                self.send_status('INFERENCE')
-                predict_success = ml_routine.predict(self.upload_folder, self.return_folder, self.task_package.dataset_id)
+                predict_success = True
+                if not self.stage_done('predict'):
+                    self.send_status('INFERENCE')
+                    with metrics.stage('predict', mode) as stage:
+                        predict_success = ml_routine.predict(self.upload_folder, self.return_folder, self.task_package.dataset_id)
+                        stage.failed = not predict_success
+                        stage.add(*folder_stats(self.return_folder))
+                    if predict_success:
+                        self.mark_stage_done('predict')
 
                 # Step 3: Post Processing - Prepare and upload results
+                self.ensure_lease()
                 self.send_status('DOWNLOAD')
                 post_processor = CONVERTERS_RESULTS_TO_PLATFORM[self.task_package.mode]()
                 if not post_processor:
                     raise ValueError(f"No post-processor available for mode: {self.task_package.mode}")
 
-                if not post_processor.run(self.return_folder, self.upload_folder, self.result_upload_url, self.task_package.package_id):
+                with metrics.stage('upload', mode) as stage:
+                    upload_success = post_processor.run(
+                        self.return_folder, self.upload_folder, self.result_upload_url, self.task_package.package_id,
+                        is_uploaded=self.is_uploaded, on_uploaded=self.mark_uploaded)
+                    stage.failed = not upload_success
+                if not upload_success:
                     logger.error("Post processing failed")
                     return False
 
                 if predict_success:
+                    self.finish_checkpoint()
                     self.update_package_status_for_PI()
                 else:  
                     self.update_package_status_for_PI(PackageStatus.CREATED)
@@ -153,6 +393,10 @@ class Job:
             self.send_status('FREE')
             return False
 
+        except LeaseLostError as e:
+            logger.error(f"Job stopped: {e}")
+            self.send_status('FREE')
+            return False
         except Exception as e:
             logger.error(f"Error in job execution: {e}")
             self.update_package_status_for_PI(PackageStatus.CREATED)
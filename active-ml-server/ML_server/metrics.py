@@ -0,0 +1,208 @@
+import os
+import time
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger()
+
+# (stage, mode)
+StageKey = Tuple[str, str]
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of the process, ru_maxrss is reported in kilobytes on Linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss_bytes() -> int:
+    """Current resident set size of the process, 0 where /proc is not available"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def folder_stats(path: str) -> Tuple[int, int]:
+    """Number of files and their total size in the folder tree"""
+    files = 0
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                continue
+    return files, size
+
+
+class StageStats:
+    """Accumulated measurements of one stage"""
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+        self.items = 0
+        self.failed_items = 0
+        self.bytes = 0
+        self.peak_rss = 0
+
+
+class StageRecord:
+    """Measurements of a running stage, filled by the code inside the stage"""
+
+    def __init__(self, stage: str, mode: str):
+        self.stage = stage
+        self.mode = mode
+        self.items = 0
+        self.failed_items = 0
+        self.bytes = 0
+        self.failed = False
+        self.seconds = 0.0
+
+    def add(self, items: int = 1, size: int = 0) -> None:
+        self.items += items
+        self.bytes += size
+
+    def add_failed(self, items: int = 1) -> None:
+        """Count images or records the stage could not process"""
+        self.failed_items += items
+
+
+class MetricsRegistry:
+    """
+    Per-stage timing and throughput of the jobs run by this server.
+
+    Stages (download, convert, create_dataset, train, predict, upload) record their
+    duration, processed items and bytes. Transfer counters add the bytes sent to and
+    received from the platform. Everything is rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[StageKey, StageStats] = {}
+        self._jobs: Dict[Tuple[str, str, str], int] = {}
+        self._transfer_files: Dict[str, int] = {}
+        self._transfer_bytes: Dict[str, int] = {}
+        self.started_at = time.time()
+
+    @contextmanager
+    def stage(self, stage: str, mode: str = '') -> Iterator[StageRecord]:
+        """
+        Measure a stage, an exception inside marks the run as failed
+
+        Args:
+            stage: Name of the stage
+            mode: Processing mode of the job
+
+        Yields:
+            StageRecord to report processed items and bytes
+        """
+        record = StageRecord(stage, mode)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record.failed = True
+            raise
+        finally:
+            record.seconds = time.perf_counter() - start
+            self.observe(record)
+
+    def observe(self, record: StageRecord) -> None:
+        """Add a finished stage run to the totals"""
+        rss = peak_rss_bytes()
+        with self._lock:
+            stats = self._stages.setdefault((record.stage, record.mode), StageStats())
+            stats.runs += 1
+            stats.failures += int(record.failed)
+            stats.seconds += record.seconds
+            stats.max_seconds = max(stats.max_seconds, record.seconds)
+            stats.last_seconds = record.seconds
+            stats.items += record.items
+            stats.failed_items += record.failed_items
+            stats.bytes += record.bytes
+            stats.peak_rss = max(stats.peak_rss, rss)
+
+    def count_job(self, mode: str, task: str, result: str) -> None:
+        with self._lock:
+            key = (mode, task, result)
+            self._jobs[key] = self._jobs.get(key, 0) + 1
+
+    def count_transfer(self, direction: str, files: int = 1, size: int = 0) -> None:
+        """
+        Count files exchanged with the platform
+
+        Args:
+            direction: 'download', 'upload' or 'cache' for downloads served by the image cache
+            files: Number of files
+            size: Number of bytes
+        """
+        with self._lock:
+            self._transfer_files[direction] = self._transfer_files.get(direction, 0) + files
+            self._transfer_bytes[direction] = self._transfer_bytes.get(direction, 0) + size
+
+    def render_prometheus(self) -> str:
+        """Current values in the Prometheus text exposition format"""
+        with self._lock:
+            stages = [(key, vars(stats).copy()) for key, stats in sorted(self._stages.items())]
+            jobs = sorted(self._jobs.items())
+            transfer_files = sorted(self._transfer_files.items())
+            transfer_bytes = sorted(self._transfer_bytes.items())
+
+        lines: List[str] = []
+
+        def metric(name: str, metric_type: str, help_text: str, samples: List[Tuple[str, float]]) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+        def stage_labels(key: StageKey) -> str:
+            return f'stage="{key[0]}",mode="{key[1]}"'
+
+        stage_metrics = [
+            ('ml_server_stage_runs_total', 'counter', 'Finished runs of the stage', 'runs'),
+            ('ml_server_stage_failures_total', 'counter', 'Runs of the stage that raised an error', 'failures'),
+            ('ml_server_stage_seconds_total', 'counter', 'Time spent in the stage', 'seconds'),
+            ('ml_server_stage_max_seconds', 'gauge', 'Longest run of the stage', 'max_seconds'),
+            ('ml_server_stage_last_seconds', 'gauge', 'Duration of the last run of the stage', 'last_seconds'),
+            ('ml_server_stage_items_total', 'counter', 'Images or records processed by the stage', 'items'),
+            ('ml_server_stage_failed_items_total', 'counter', 'Images or records the stage failed to process', 'failed_items'),
+            ('ml_server_stage_bytes_total', 'counter', 'Bytes processed by the stage', 'bytes'),
+            ('ml_server_stage_peak_rss_bytes', 'gauge', 'Peak RSS of the process observed at the end of the stage', 'peak_rss'),
+        ]
+        for name, metric_type, help_text, field in stage_metrics:
+            metric(name, metric_type, help_text, [(stage_labels(key), stats[field]) for key, stats in stages])
+
+        metric('ml_server_jobs_total', 'counter', 'Finished jobs by result',
+               [(f'mode="{mode}",task="{task}",result="{result}"', count) for (mode, task, result), count in jobs])
+        metric('ml_server_transfer_files_total', 'counter', 'Files exchanged with the platform',
+               [(f'direction="{direction}"', count) for direction, count in transfer_files])
+        metric('ml_server_transfer_bytes_total', 'counter', 'Bytes exchanged with the platform',
+               [(f'direction="{direction}"', count) for direction, count in transfer_bytes])
+        metric('ml_server_peak_rss_bytes', 'gauge', 'Peak resident set size of the process', [('', peak_rss_bytes())])
+        metric('ml_server_rss_bytes', 'gauge', 'Resident set size of the process', [('', current_rss_bytes())])
+        metric('ml_server_uptime_seconds', 'gauge', 'Time since the server started',
+               [('', round(time.time() - self.started_at, 3))])
+        return "\n".join(lines) + "\n"
+
+
+_metrics: Optional[MetricsRegistry] = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsRegistry:
+    """Metrics registry shared by the server, jobs and converters"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+        return _metrics
@@ -1,9 +1,18 @@
 from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any, List
+
+if TYPE_CHECKING:
+    from common.platform_to_task_converter.base import DecodedImage
 
 
 class MLRoutinesBase(ABC):
     """Base class for ML routines"""
 
+    # The model reads input images from files, so decoded images are written as PNG before inference
+    NEEDS_IMAGE_PATH = True
+    # Images the streaming pipeline passes to predict_decoded_images in one call
+    predict_batch_size = 1
+
     @abstractmethod
     def create_dataset(self, input_folder: str, output_folder: str) -> None:
         """
@@ -39,3 +48,73 @@ class MLRoutinesBase(ABC):
             dataset_id: Dataset ID
         """
         pass
+
+    @abstractmethod
+    def start_inference(self, input_folder: str, output_folder: str, dataset_id: int) -> None:
+        """
+        Load the model once for per-image inference used by the streaming pipeline
+
+        Args:
+            input_folder: Directory where input images appear
+            output_folder: Directory to store the predictions
+            dataset_id: Dataset ID
+        """
+        pass
+
+    def finish_inference(self) -> None:
+        """Release what start_inference set up besides the model, called when the streaming inference is done"""
+        pass
+
+    @abstractmethod
+    def predict_image(self, image_path: str) -> Any:
+        """
+        Run inference on one image, start_inference must be called first
+
+        Args:
+            image_path: Path to the input image
+
+        Returns:
+            Prediction in the form expected by the results converter of the mode
+        """
+        pass
+
+    def predict_decoded_image(self, image: "DecodedImage") -> Any:
+        """
+        Run inference on an image decoded in memory, start_inference must be called first
+        Routines that set NEEDS_IMAGE_PATH to False override it and use image.array
+
+        Args:
+            image: Downloaded image
+
+        Returns:
+            Prediction in the form expected by the results converter of the mode
+        """
+        return self.predict_image(image.path)
+
+    def predict_images(self, image_paths: List[str]) -> List[Any]:
+        """
+        Run inference on several images, start_inference must be called first
+        Routines whose model takes a batch in one call override it, by default the images are predicted one by one
+
+        Args:
+            image_paths: Paths to the input images
+
+        Returns:
+            List[Any]: Prediction of every image in the order of image_paths
+        """
+        return [self.predict_image(image_path) for image_path in image_paths]
+
+    def predict_decoded_images(self, images: List["DecodedImage"]) -> List[Any]:
+        """
+        Run inference on a batch of decoded images, start_inference must be called first
+
+        Args:
+            images: Downloaded images, at most predict_batch_size
+
+        Returns:
+            List[Any]: Prediction of every image in the order of images, a prediction may be a
+                Future when the routine finishes it in the background
+        """
+        if not self.NEEDS_IMAGE_PATH:
+            return [self.predict_decoded_image(image) for image in images]
+        return self.predict_images([image.path for image in images])
@@ -1,4 +1,6 @@
+import os
 import logging
+from typing import List
 
 from quantitave_analysis.models.detection.detection_dataset_pipeline import DetectionDatasetPipeline
 from quantitave_analysis.models.detection.detection_model import DinoDetectionModelHandler
@@ -13,6 +15,12 @@ class DetectionRoutines(MLRoutinesBase):
     def __init__(self):
         self.dataset_pipeline = DetectionDatasetPipeline()
         self.model_handler = DinoDetectionModelHandler()
+        self._predictor = None
+        self._model_dir = None
+
+    @property
+    def predict_batch_size(self) -> int:
+        return max(1, self.model_handler.model_handler_config.predict_batch_size)
 
     def create_dataset(self, input_folder: str, output_folder: str) -> None:
         """
@@ -41,6 +49,7 @@ class DetectionRoutines(MLRoutinesBase):
         """
         try:
             logger.info(f"Training detection model with data from {dataset_folder}")
+            self.model_handler.configure_folders(train_data_folder=dataset_folder)
             self.model_handler.run_train(dataset_id)
             return True
         except Exception as e:
@@ -59,9 +68,48 @@ class DetectionRoutines(MLRoutinesBase):
         """
         try:
             logger.info(f"Running detection prediction from {input_folder} to {output_folder}")
+            self.model_handler.configure_folders(inference_data_folder=input_folder, results_folder=output_folder)
             self.model_handler.run_predict(dataset_id)
             return True
         except Exception as e:
             logger.error(f"Error in detection prediction: {e}")
             return False
             raise
+
+    def start_inference(self, input_folder: str, output_folder: str, dataset_id: int) -> None:
+        """
+        Load the detection model for per-image inference
+
+        Args:
+            input_folder: Directory where input images appear
+            output_folder: Directory to store the predictions
+            dataset_id: Dataset ID
+        """
+        self.model_handler.configure_folders(inference_data_folder=input_folder, results_folder=output_folder)
+        self._predictor, self._model_dir = self.model_handler.load_predictor(dataset_id)
+
+    def predict_image(self, image_path: str) -> dict:
+        """
+        Detect objects on one image
+
+        Args:
+            image_path: Path to the input PNG image
+
+        Returns:
+            dict: Detections of the image keyed by the image name
+        """
+        return self.model_handler.predict_image(self._predictor, self._model_dir, image_path)
+
+    def predict_images(self, image_paths: List[str]) -> List[dict]:
+        """
+        Detect objects on several images in one predictor call
+
+        Args:
+            image_paths: Paths to the input PNG images
+
+        Returns:
+            List[dict]: Detections of every image keyed by the image name, in the order of image_paths
+        """
+        results = self.model_handler.predict_batch(self._predictor, self._model_dir, image_paths)
+        image_names = [os.path.splitext(os.path.basename(image_path))[0] for image_path in image_paths]
+        return [{image_name: results.get(image_name, [])} for image_name in image_names]
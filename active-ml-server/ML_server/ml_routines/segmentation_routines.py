@@ -1,4 +1,6 @@
 import logging
+from concurrent.futures import Future
+from typing import List
 
 from quantitave_analysis.models.segmentation.dataset_pipeline import SegmentationDatasetPreparer
 from quantitave_analysis.models.segmentation.segmentation_model import SegmentationModelHandler
@@ -13,6 +15,14 @@ class SegmentationRoutines(MLRoutinesBase):
     def __init__(self):
         self.dataset_pipeline = SegmentationDatasetPreparer()
         self.model_handler = SegmentationModelHandler()
+        self._predictor = None
+        self._label_properties = None
+        self._label_properties_loaded = False
+        self._mask_writer = None
+
+    @property
+    def predict_batch_size(self) -> int:
+        return max(1, self.model_handler.model_handler_config.predict_batch_size)
 
     def create_dataset(self, input_folder: str, output_folder: str) -> None:
         """
@@ -41,6 +51,7 @@ class SegmentationRoutines(MLRoutinesBase):
         """
         try:
             logger.info(f"Training segmentation model with data from {dataset_folder}")
+            self.model_handler.configure_folders(folder_for_train=dataset_folder)
             self.model_handler.run_train(dataset_id)
             return True
         except Exception as e:
@@ -59,9 +70,71 @@ class SegmentationRoutines(MLRoutinesBase):
         """
         try:
             logger.info(f"Running segmentation prediction from {input_folder} to {output_folder}")
+            self.model_handler.configure_folders(folder_for_inference=input_folder,
+                                                 results_folder_after_inference=output_folder)
             self.model_handler.run_predict(dataset_id)
             return True
         except Exception as e:
             logger.error(f"Error in segmentation prediction: {e}")
             return False
             raise
+
+    def start_inference(self, input_folder: str, output_folder: str, dataset_id: int) -> None:
+        """
+        Load the segmentation model for per-image inference
+
+        Args:
+            input_folder: Directory where input images appear
+            output_folder: Directory to store the predicted masks
+            dataset_id: Dataset ID
+        """
+        self.model_handler.configure_folders(folder_for_inference=input_folder,
+                                             results_folder_after_inference=output_folder)
+        self._predictor = self.model_handler.load_predictor(dataset_id)
+        self._label_properties = None
+        self._label_properties_loaded = False
+
+    def finish_inference(self) -> None:
+        """Wait for the masks still being saved and stop the writer pool"""
+        if self._mask_writer is not None:
+            self._mask_writer.shutdown(wait=True)
+            self._mask_writer = None
+
+    def _inference_label_properties(self):
+        # Label properties are downloaded before the first image, so they are read on demand
+        if not self._label_properties_loaded:
+            self._label_properties = self.model_handler.load_inference_label_properties()
+            self._label_properties_loaded = True
+        return self._label_properties
+
+    def predict_image(self, image_path: str) -> str:
+        """
+        Predict the mask of one image
+
+        Args:
+            image_path: Path to the input PNG image
+
+        Returns:
+            str: Path to the predicted RGBA mask
+        """
+        return self.model_handler.predict_image(self._predictor, image_path, self._inference_label_properties())
+
+    def predict_images(self, image_paths: List[str]) -> List[Future]:
+        """
+        Predict the masks of several images in one predictor call
+
+        The masks are converted to RGBA and saved in a pool of processes, so the predictor
+        goes on with the next batch while they are encoded.
+
+        Args:
+            image_paths: Paths to the input PNG images
+
+        Returns:
+            List[Future]: Path to the predicted RGBA mask of every image, in the order of image_paths
+        """
+        label_properties = self._inference_label_properties()
+        predictions = self.model_handler.predict_batch(self._predictor, image_paths)
+        if self._mask_writer is None:
+            self._mask_writer = self.model_handler.mask_writer_pool()
+        return [self.model_handler.submit_mask(self._mask_writer, image_path, prediction, label_properties)
+                for image_path, prediction in zip(image_paths, predictions)]
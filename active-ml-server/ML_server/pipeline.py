@@ -0,0 +1,278 @@
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, List, Optional, Tuple
+
+from common.platform_to_task_converter.base import BasePlatformToTaskConverter, DecodedImage
+from common.results_to_platform_converter.base import BaseResultsToPlatformConverter, IncrementalResultUploader, UploadBatchReport
+from ML_server.ml_routines.base import MLRoutinesBase
+from ML_server.metrics import get_metrics
+from ML_server.checkpoint import JobCheckpoint, checkpoint_key
+
+logger = logging.getLogger()
+
+# Marks the end of the stream in a stage queue
+_END = object()
+
+
+class StreamingInferencePipeline:
+    """
+    Runs download, inference and upload of an inference package as concurrent stages.
+
+    The stages are connected by bounded queues: inference starts on the first downloaded
+    image and results are uploaded in batches while later images are still predicted.
+    A full queue blocks the previous stage, so a slow stage never lets the others pile up
+    files on disk or in memory.
+    """
+
+    def __init__(self,
+                 data_processor: BasePlatformToTaskConverter,
+                 ml_routine: MLRoutinesBase,
+                 post_processor: BaseResultsToPlatformConverter,
+                 queue_size: int = 16,
+                 mode: str = '',
+                 checkpoint: Optional[JobCheckpoint] = None,
+                 stop: Optional[threading.Event] = None):
+        self.data_processor = data_processor
+        self.ml_routine = ml_routine
+        self.post_processor = post_processor
+        self.mode = mode
+        self.checkpoint = checkpoint
+        self._images: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._results: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        # Set by the job when the lease is lost, stops all stages like a failure of a stage
+        self._cancel = stop
+        self._download_success = False
+        self._upload_success = True
+        # Images arrive from several download workers at once
+        self._counters_lock = threading.Lock()
+        self.downloaded = 0
+        self.skipped = 0
+        self.predicted = 0
+        # Images that failed prediction or post-processing, any of them fails the package
+        self.failed = 0
+        self.uploaded = 0
+        self.upload_reports: List[UploadBatchReport] = []
+
+    def _stopped(self) -> bool:
+        return self._stop.is_set() or (self._cancel is not None and self._cancel.is_set())
+
+    def _put(self, stage_queue: queue.Queue, item: Any) -> bool:
+        """Put an item into a stage queue, gives up when the pipeline is stopped"""
+        while not self._stopped():
+            try:
+                stage_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, stage_queue: queue.Queue) -> Any:
+        """Take an item from a stage queue, returns the end marker when the pipeline is stopped"""
+        while not self._stopped():
+            try:
+                return stage_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _is_uploaded(self, record_id: str, filename: str) -> bool:
+        """The image was uploaded before the job was interrupted, it is not downloaded again"""
+        if not (self.checkpoint and self.checkpoint.is_uploaded(checkpoint_key(record_id, filename))):
+            return False
+        with self._counters_lock:
+            self.skipped += 1
+        return True
+
+    def _on_image_ready(self, record_id: str, image: DecodedImage) -> None:
+        if self.ml_routine.NEEDS_IMAGE_PATH:
+            # The PNG is written here, so encoding does not hold up the inference stage
+            image.save()
+            image.release()
+        with self._counters_lock:
+            self.downloaded += 1
+        if not self._put(self._images, (record_id, image)):
+            image.release()
+
+    def _download_stage(self, package_url: str, label_properties_url: str, upload_folder: str) -> None:
+        with get_metrics().stage('download', self.mode) as stage:
+            try:
+                self._download_success = self.data_processor.run(
+                    package_url, label_properties_url, upload_folder,
+                    on_image_ready=self._on_image_ready, skip_file=self._is_uploaded
+                )
+            except Exception as e:
+                logger.error(f"Error in download stage: {e}")
+                self._download_success = False
+            finally:
+                self._put(self._images, _END)
+            stage.failed = not self._download_success
+            stage.add(self.downloaded)
+
+    def _upload_stage(self, return_folder: str, result_upload_url: str, package_id: int) -> None:
+        with get_metrics().stage('upload', self.mode) as stage:
+            failed_before = self.failed
+            self._run_upload(return_folder, result_upload_url, package_id)
+            stage.add_failed(self.failed - failed_before)
+            stage.failed = not self._upload_success
+            stage.add(self.uploaded)
+
+    def _run_upload(self, return_folder: str, result_upload_url: str, package_id: int) -> None:
+        uploader = IncrementalResultUploader(
+            self.post_processor, result_upload_url, package_id, return_folder,
+            on_uploaded=self.checkpoint.mark_uploaded if self.checkpoint else None
+        )
+        try:
+            while True:
+                item = self._get(self._results)
+                if item is _END:
+                    break
+                record_id, filename, result = item
+                if isinstance(result, Future):
+                    # Finished by the routine in the background, e.g. a mask being saved
+                    try:
+                        result = result.result()
+                    except Exception as e:
+                        logger.error(f"Error finishing prediction of image {filename}: {e}")
+                        with self._counters_lock:
+                            self.failed += 1
+                        continue
+                uploader.add(record_id, result, key=checkpoint_key(record_id, filename))
+        except Exception as e:
+            logger.error(f"Error in upload stage: {e}")
+            self._upload_success = False
+            self._stop.set()
+        finally:
+            # Batches already handed to the uploader are finished even if the pipeline is stopped
+            self._upload_success = uploader.close() and self._upload_success
+            self.uploaded = uploader.uploaded_files
+            self.upload_reports = uploader.reports
+
+    def _next_batch(self, batch_size: int) -> Tuple[List[Tuple[str, DecodedImage]], bool]:
+        """
+        Take the next images for one predictor call
+
+        Waits for the first image only, the batch is then filled with the images that are
+        already downloaded, so a slow download never holds back images that are ready.
+
+        Returns:
+            Tuple: Images of the batch as (record_id, image) and whether the stream has ended
+        """
+        item = self._get(self._images)
+        if item is _END:
+            return [], True
+        batch = [item]
+        while len(batch) < batch_size:
+            try:
+                item = self._images.get_nowait()
+            except queue.Empty:
+                break
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _predict_batch(self, batch: List[Tuple[str, DecodedImage]]) -> List[Tuple[str, DecodedImage, Any]]:
+        """Predict a batch, images of a failed batch are retried one by one so one bad image does not drop the others"""
+        images = [image for _, image in batch]
+        try:
+            return [(record_id, image, result) for (record_id, image), result
+                    in zip(batch, self.ml_routine.predict_decoded_images(images))]
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error(f"Error predicting image {images[0].filename}: {e}")
+                return []
+            logger.error(f"Error predicting batch of {len(batch)} images, predicting them one by one: {e}")
+        predicted = []
+        for record_id, image in batch:
+            try:
+                predicted.append((record_id, image, self.ml_routine.predict_decoded_images([image])[0]))
+            except Exception as e:
+                logger.error(f"Error predicting image {image.filename}: {e}")
+        return predicted
+
+    def _predict_stage(self, upload_folder: str, return_folder: str, dataset_id: int) -> bool:
+        with get_metrics().stage('predict', self.mode) as stage:
+            try:
+                # The model is loaded while the first images are downloading
+                self.ml_routine.start_inference(upload_folder, return_folder, dataset_id)
+                batch_size = max(1, self.ml_routine.predict_batch_size)
+                ended = False
+                while not ended:
+                    batch, ended = self._next_batch(batch_size)
+                    if not batch:
+                        continue
+                    try:
+                        predicted = self._predict_batch(batch)
+                    finally:
+                        for _, image in batch:
+                            image.release()
+                    failed = len(batch) - len(predicted)
+                    with self._counters_lock:
+                        self.predicted += len(predicted)
+                        self.failed += failed
+                    stage.add(len(predicted))
+                    stage.add_failed(failed)
+                    for record_id, image, result in predicted:
+                        if not self._put(self._results, (record_id, image.filename, result)):
+                            return True
+            except (Exception, SystemExit) as e:
+                logger.error(f"Error in inference stage: {e}")
+                stage.failed = True
+                self._stop.set()
+                return False
+            finally:
+                self.ml_routine.finish_inference()
+        return True
+
+    def run(self, package_url: str, label_properties_url: str, upload_folder: str,
+            return_folder: str, result_upload_url: str, package_id: int, dataset_id: int) -> bool:
+        """
+        Download, predict and upload the package, the inference stage runs in the calling thread
+
+        Args:
+            package_url: URL to download the package data
+            label_properties_url: URL to download the label properties json
+            upload_folder: Directory for downloaded images
+            return_folder: Directory for predictions
+            result_upload_url: URL to upload the results
+            package_id: Package ID
+            dataset_id: Dataset ID
+
+        Returns:
+            bool: True if every stage completed successfully and every downloaded image was predicted
+        """
+        downloader = threading.Thread(
+            target=self._download_stage,
+            args=(package_url, label_properties_url, upload_folder),
+            name=f"pipeline-download-{package_id}",
+            daemon=True
+        )
+        uploader = threading.Thread(
+            target=self._upload_stage,
+            args=(return_folder, result_upload_url, package_id),
+            name=f"pipeline-upload-{package_id}",
+            daemon=True
+        )
+        downloader.start()
+        uploader.start()
+
+        try:
+            predict_success = self._predict_stage(upload_folder, return_folder, dataset_id)
+        finally:
+            self._put(self._results, _END)
+            downloader.join()
+            uploader.join()
+
+        logger.info(f"Pipeline finished: {self.downloaded} images downloaded, {self.predicted} predicted, "
+                    f"{self.failed} failed, {self.uploaded} results uploaded, {self.skipped} uploaded by an earlier run")
+        if self._cancel is not None and self._cancel.is_set():
+            logger.error("Pipeline was cancelled")
+            return False
+        if self.failed or self.predicted != self.downloaded:
+            logger.error(f"{self.failed} of {self.downloaded} images failed, "
+                         f"{self.downloaded - self.predicted} were not predicted")
+            return False
+        return predict_success and self._download_success and self._upload_success and self.predicted + self.skipped > 0
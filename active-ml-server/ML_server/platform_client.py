@@ -0,0 +1,167 @@
+import json
+import time
+import base64
+import logging
+import threading
+from typing import Dict, Optional
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ML_server.config import Config
+
+logger = logging.getLogger()
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+def _token_expiration(token: str) -> float:
+    """
+    Read the expiration time of a JWT without verifying it
+
+    Args:
+        token: Encoded JWT
+
+    Returns:
+        float: Unix time of expiration, 0 if it can not be read
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload)).get('exp', 0))
+    except Exception:
+        return 0.0
+
+
+class PlatformClient:
+    """
+    Client for the platform API shared by the whole ML server.
+
+    Keeps one pooled keep-alive session, caches the access token until it is about
+    to expire and refreshes it with the refresh token. Requests get a timeout and
+    idempotent ones are retried on connection errors and 5xx responses.
+    """
+
+    def __init__(self,
+                 token_url: str = Config().GET_TOKEN_URL,
+                 refresh_url: str = Config().REFRESH_TOKEN_URL,
+                 credentials: Optional[Dict[str, str]] = None,
+                 timeout=Config().REQUEST_TIMEOUT,
+                 retries: int = Config().REQUEST_RETRIES,
+                 pool_size: int = Config().CONNECTION_POOL_SIZE,
+                 token_leeway: int = Config().TOKEN_LEEWAY):
+        self.token_url = token_url
+        self.refresh_url = refresh_url
+        self.credentials = credentials if credentials is not None else Config.data_user
+        self.timeout = tuple(timeout)
+        self.token_leeway = token_leeway
+
+        self._token_lock = threading.Lock()
+        self._access_token: Optional[str] = None
+        self._refresh_token: Optional[str] = None
+        self._access_expires_at = 0.0
+
+        retry_strategy = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS
+        )
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _store_tokens(self, tokens: dict) -> None:
+        self._access_token = tokens["access"]
+        self._refresh_token = tokens.get("refresh", self._refresh_token)
+        self._access_expires_at = _token_expiration(self._access_token)
+
+    def _obtain_tokens(self) -> None:
+        response = self.session.post(self.token_url, json=self.credentials, timeout=self.timeout)
+        response.raise_for_status()
+        self._store_tokens(response.json())
+
+    def _refresh_tokens(self) -> bool:
+        if not self._refresh_token:
+            return False
+        try:
+            response = self.session.post(self.refresh_url, json={"refresh": self._refresh_token}, timeout=self.timeout)
+            if response.status_code != 200:
+                return False
+            self._store_tokens(response.json())
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error refreshing access token: {e}")
+            return False
+
+    def access_token(self) -> str:
+        """Cached access token, refreshed or obtained again when it is about to expire"""
+        with self._token_lock:
+            if self._access_token and time.time() < self._access_expires_at - self.token_leeway:
+                return self._access_token
+            if not self._refresh_tokens():
+                self._obtain_tokens()
+            return self._access_token
+
+    def invalidate_token(self) -> None:
+        with self._token_lock:
+            self._access_token = None
+            self._access_expires_at = 0.0
+
+    def auth_headers(self) -> Dict[str, str]:
+        return {"Authorization": "Bearer " + self.access_token()}
+
+    def request(self, method: str, url: str, authorized: bool = True, **kwargs) -> requests.Response:
+        """
+        Send a request to the platform
+
+        Args:
+            method: HTTP method
+            url: Full URL of the endpoint
+            authorized: Add the access token to the request
+            **kwargs: Arguments of requests.Session.request
+
+        Returns:
+            requests.Response: Response of the platform
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if not authorized:
+            return self.session.request(method, url, **kwargs)
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers.update(self.auth_headers())
+        response = self.session.request(method, url, headers=headers, **kwargs)
+        if response.status_code == 401:
+            # The token may have been revoked or the platform restarted with new keys
+            self.invalidate_token()
+            if "files" not in kwargs:
+                # Uploaded files are already consumed, such requests are left to the caller
+                response.close()
+                headers.update(self.auth_headers())
+                response = self.session.request(method, url, headers=headers, **kwargs)
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+
+_client: Optional[PlatformClient] = None
+_client_lock = threading.Lock()
+
+
+def get_platform_client() -> PlatformClient:
+    """Platform client shared by the server, jobs and converters"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = PlatformClient()
+        return _client
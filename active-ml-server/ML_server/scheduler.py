@@ -0,0 +1,148 @@
+import os
+import queue
+import logging
+import threading
+from typing import Callable, Dict, List, Mapping, Optional
+
+from common.models import TaskPackage, ProcessingMode
+from quantitave_analysis.models.config import Config
+
+logger = logging.getLogger()
+
+
+class JobSlot:
+    """Execution slot with its own workspace and current task"""
+
+    def __init__(self, mode: ProcessingMode, index: int, workspace_root: str):
+        self.mode = mode
+        self.index = index
+        self.workspace = os.path.join(workspace_root, self.name)
+        self.current_task: Optional[TaskPackage] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.mode.value.lower()}_{self.index}"
+
+    @property
+    def is_busy(self) -> bool:
+        return self.current_task is not None
+
+
+class JobScheduler:
+    """
+    Runs claimed packages on a fixed number of slots per processing mode.
+
+    Every slot has a worker thread that takes packages from the queue of its mode,
+    so packages of one mode are processed in claim order. Across all modes at most
+    max_concurrent_jobs packages are queued or running, None leaves only the per-mode limit.
+    """
+
+    def __init__(self,
+                 job_runner: Callable[[TaskPackage, JobSlot], None],
+                 slots_per_mode: Mapping[ProcessingMode, int],
+                 workspace_root: str = Config().JOBS_FOLDER,
+                 max_concurrent_jobs: Optional[int] = 1):
+        self.job_runner = job_runner
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self._lock = threading.Lock()
+        self._capacity_freed = threading.Condition(self._lock)
+        self._queues: Dict[ProcessingMode, queue.Queue] = {}
+        self._slots: Dict[ProcessingMode, List[JobSlot]] = {}
+        self._pending: Dict[ProcessingMode, int] = {}
+        self._threads: List[threading.Thread] = []
+
+        for mode, slots_count in slots_per_mode.items():
+            mode = ProcessingMode(mode)
+            self._queues[mode] = queue.Queue()
+            self._pending[mode] = 0
+            self._slots[mode] = [JobSlot(mode, index, workspace_root) for index in range(max(0, slots_count))]
+
+    def start(self) -> None:
+        """Start a worker thread for every slot"""
+        for slots in self._slots.values():
+            for slot in slots:
+                thread = threading.Thread(target=self._slot_loop, args=(slot,), name=f"job-slot-{slot.name}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        slots_count = {mode.value: len(slots) for mode, slots in self._slots.items()}
+        logger.info(f"Job scheduler started with slots: {slots_count}, at most {self.max_concurrent_jobs} concurrent jobs")
+
+    def free_capacity(self, mode: ProcessingMode) -> int:
+        """Number of packages of the given mode that can be claimed right now"""
+        with self._lock:
+            return self._free_capacity(mode)
+
+    def _free_capacity(self, mode: ProcessingMode) -> int:
+        slots = self._slots.get(mode)
+        if not slots:
+            return 0
+        free_slots = sum(1 for slot in slots if not slot.is_busy)
+        free = free_slots - self._pending[mode]
+        if self.max_concurrent_jobs is not None:
+            busy = sum(1 for mode_slots in self._slots.values() for slot in mode_slots if slot.is_busy)
+            free = min(free, self.max_concurrent_jobs - busy - sum(self._pending.values()))
+        return max(0, free)
+
+    def accepting_modes(self) -> List[ProcessingMode]:
+        """Processing modes that have a free slot"""
+        return [mode for mode in self._slots if self.free_capacity(mode) > 0]
+
+    def wait_for_capacity(self, timeout: float) -> bool:
+        """
+        Block until some slot is free or the timeout expires
+
+        Returns:
+            bool: True if there is free capacity for at least one mode
+        """
+        with self._capacity_freed:
+            return self._capacity_freed.wait_for(
+                lambda: any(self._free_capacity(mode) > 0 for mode in self._slots),
+                timeout=timeout
+            )
+
+    def submit(self, task_package: TaskPackage) -> bool:
+        """
+        Put a claimed package into the queue of its mode
+
+        Returns:
+            bool: False if there is no free slot for the package mode
+        """
+        mode = ProcessingMode(task_package.mode)
+        with self._lock:
+            if self._free_capacity(mode) <= 0:
+                logger.warning(f"No free {mode.value} slot for package {task_package.package_id}")
+                return False
+            self._pending[mode] += 1
+
+        self._queues[mode].put(task_package)
+        logger.info(f"Package {task_package.package_id} queued for {mode.value} processing")
+        return True
+
+    def active_tasks(self) -> Dict[str, Optional[int]]:
+        """Snapshot of slot names and package IDs they are processing"""
+        with self._lock:
+            return {
+                slot.name: slot.current_task.package_id if slot.current_task else None
+                for slots in self._slots.values() for slot in slots
+            }
+
+    def _slot_loop(self, slot: JobSlot) -> None:
+        mode_queue = self._queues[slot.mode]
+        while True:
+            task_package = mode_queue.get()
+            with self._lock:
+                slot.current_task = task_package
+                self._pending[slot.mode] -= 1
+
+            logger.info(f"Slot {slot.name} started package {task_package.package_id}")
+            try:
+                self.job_runner(task_package, slot)
+            except (Exception, SystemExit) as e:
+                # Model handlers may call exit() on fatal errors, the slot must survive it
+                logger.error(f"Slot {slot.name} failed on package {task_package.package_id}: {e}")
+            finally:
+                with self._lock:
+                    slot.current_task = None
+                    self._capacity_freed.notify_all()
+                mode_queue.task_done()
+                logger.info(f"Slot {slot.name} is now free")
@@ -18,6 +18,7 @@ class PackageStatus(str, Enum):
     IN_PROGRESS = "IN_PROGRESS"
     DONE = "DONE"
     ERROR = "ERROR"
+    FAILED = "FAILED"  # Set by the platform after too many failed runs
 
 
 class DigitalAssistantBase(BaseModel):
@@ -1,15 +1,24 @@
 from abc import ABC, abstractmethod
 from typing import Optional, Dict, List, Tuple, Callable
+import io
 import os
 import json
+import numpy as np
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import urllib.parse
 from PIL import Image
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import threading
+import tarfile
+import time
+
+from ML_server.config import Config as ConfigServer
+from ML_server.platform_client import get_platform_client
+from ML_server.metrics import get_metrics
+from common.platform_to_task_converter.image_cache import get_image_cache
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +26,11 @@ MERGED_JSON = 'bbox.json'
 MAPPING_FILE = 'record_files_mapping.json'
 LABEL_PROPERTIES = 'label_properties.json'
 COUNT_DOWNLOAD_FILES = 20  # Count of files for parallel download
+MIN_DOWNLOAD_FILES = 2  # Lower bound of the adaptive download window
+LATENCY_TOLERANCE = 2.0  # The window shrinks when latency grows over this multiple of the baseline
+BASELINE_DECAY = 0.05  # Share of the gap to the current latency the baseline closes after every download
 MAX_RETRIES = 3  # Количество попыток повтора при ошибке
+PNG_COMPRESS_LEVEL = 1  # Fast zlib level for converted images, PNG decoding speed does not depend on it
 
 # Thread-local storage for sessions
 _thread_local = threading.local()
@@ -74,9 +87,114 @@ def decode_filename(filename: str) -> str:
         return filename
 
 
+def image_filename(url: str) -> str:
+    """Name of the PNG the image of the URL is saved as, the name used in the upload journal"""
+    filename = decode_filename(url.split('/')[-1].split('?')[0])
+    return os.path.splitext(filename)[0] + '.png'
+
+
+def drop_skipped_images(urls: List[str], url_to_record_map: Dict[str, str],
+                        skip_file: Optional[Callable[[str, str], bool]]) -> List[str]:
+    """
+    Leave out the images the caller does not need, e.g. uploaded by an interrupted run of the job
+
+    Args:
+        urls: URLs of the package files
+        url_to_record_map: Mapping of URLs to record IDs
+        skip_file: Called with (record_id, filename) of every image, True leaves the image out
+
+    Returns:
+        URLs to download, files other than images are always kept
+    """
+    if skip_file is None:
+        return urls
+    kept = [url for url in urls
+            if url.split('?')[0].endswith('.json') or url not in url_to_record_map
+            or not skip_file(url_to_record_map[url], image_filename(url))]
+    if len(kept) < len(urls):
+        logger.info(f"Skipping {len(urls) - len(kept)} images that are not needed")
+    return kept
+
+
+def decode_image_bytes(content: bytes) -> Image.Image:
+    """
+    Decode an image from the downloaded bytes without touching the disk
+
+    Args:
+        content: Encoded image
+
+    Returns:
+        Decoded PIL image
+    """
+    image = Image.open(io.BytesIO(content))
+    image.load()
+    return image
+
+
+class DecodedImage:
+    """
+    Downloaded image kept in memory.
+
+    The image is decoded on first access to image or array. A PNG file is written
+    to the folder only when a consumer asks for the path, at most once.
+    """
+
+    def __init__(self, content: bytes, filename: str, folder: str, cache_digest: Optional[str] = None):
+        self.filename = os.path.splitext(filename)[0] + '.png'
+        self.folder = folder
+        self.cache_digest = cache_digest
+        self._content: Optional[bytes] = content
+        self._image: Optional[Image.Image] = None
+        self._path: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def image(self) -> Image.Image:
+        with self._lock:
+            if self._image is None:
+                if self._content is None:
+                    raise ValueError(f"Image {self.filename} was released")
+                self._image = decode_image_bytes(self._content)
+            return self._image
+
+    @property
+    def array(self) -> np.ndarray:
+        return np.asarray(self.image)
+
+    @property
+    def path(self) -> str:
+        """Path to the PNG file, written on first access"""
+        return self.save()
+
+    def save(self) -> str:
+        """Write the PNG file unless it is already written, returns its path"""
+        if self._path is not None:
+            return self._path
+
+        path = os.path.join(self.folder, self.filename)
+        cache = get_image_cache()
+        if not (cache and self.cache_digest and cache.get_derived(self.cache_digest, '.png', path)):
+            with get_metrics().stage('convert') as record:
+                self.image.save(path, 'PNG', compress_level=PNG_COMPRESS_LEVEL)
+                record.add(1, os.path.getsize(path))
+            if cache and self.cache_digest:
+                cache.store_derived(self.cache_digest, '.png', path)
+        self._path = path
+        return path
+
+    def release(self) -> None:
+        """Drop the encoded and decoded data, a written path stays valid"""
+        with self._lock:
+            self._content = None
+            if self._image is not None:
+                self._image.close()
+                self._image = None
+
+
 def convert_webp_to_png(file_response: requests.Response, filename: str, upload_folder: str) -> Optional[str]:
     """
     Convert webp file to PNG format
+    The webp is decoded in memory, only the PNG is written
 
     Args:
         file_response: Response object containing webp file
@@ -86,44 +204,20 @@ def convert_webp_to_png(file_response: requests.Response, filename: str, upload_
     Returns:
         PNG filename if conversion successful, None otherwise
     """
-    webp_path = None
+    decoded = DecodedImage(file_response.content, filename, upload_folder,
+                           getattr(file_response, 'cache_digest', None))
     try:
-        webp_path = os.path.join(upload_folder, filename)
-        png_filename = os.path.splitext(filename)[0] + '.png'
-        png_path = os.path.join(upload_folder, png_filename)
-
-        # Save webp file
-        with open(webp_path, 'wb') as f:
-            f.write(file_response.content)
-
-        # Convert to PNG and explicitly close
-        with Image.open(webp_path) as image:
-            image.save(png_path, 'PNG')
-
-        # Remove original webp file
-        if webp_path and os.path.exists(webp_path):
-            os.remove(webp_path)
-
-        return png_filename
+        decoded.save()
+        return decoded.filename
 
     except IOError as e:
         logger.error(f"Error with file operations during webp conversion: {e}")
-        # Clean up on error
-        if webp_path and os.path.exists(webp_path):
-            try:
-                os.remove(webp_path)
-            except:
-                pass
         return None
     except Exception as e:
         logger.error(f"Unexpected error during webp conversion: {e}")
-        # Clean up on error
-        if webp_path and os.path.exists(webp_path):
-            try:
-                os.remove(webp_path)
-            except:
-                pass
         return None
+    finally:
+        decoded.release()
 
 
 def save_json_data(filepath: str, json_data: Dict) -> bool:
@@ -150,20 +244,20 @@ def save_json_data(filepath: str, json_data: Dict) -> bool:
         return False
 
 
-def download_and_save_json(url: str, filepath: str, headers: dict = None) -> bool:
+def download_and_save_json(url: str, filepath: str, authorized: bool = True) -> bool:
     """
     Download JSON from URL and save to file
 
     Args:
         url: URL to download JSON from
         filepath: Path to save the JSON file
-        headers: Optional headers for the request
+        authorized: Send the platform access token with the request
 
     Returns:
         True if successful, False otherwise
     """
     try:
-        response = requests.get(url, headers=headers, timeout=30, verify=False)
+        response = get_platform_client().get(url, authorized=authorized)
         response.raise_for_status()
 
     except requests.exceptions.RequestException as e:
@@ -225,6 +319,7 @@ def save_mapping_file(mapping_data: dict, filepath: str) -> bool:
 def download_file(url: str) -> Tuple[str, Optional[requests.Response]]:
     """
     Download a single file from URL using thread-local session
+    Files in the image cache are revalidated with a conditional GET
 
     Args:
         url: URL to download from
@@ -234,8 +329,25 @@ def download_file(url: str) -> Tuple[str, Optional[requests.Response]]:
     """
     try:
         session = get_session()
-        response = session.get(url, verify=False, timeout=30)
+        cache = get_image_cache()
+        headers = cache.conditional_headers(url) if cache else {}
+        # The body is streamed: the cache writes it to disk chunk by chunk while it is received,
+        # without the cache it is read from the connection when the callback asks for the content
+        response = session.get(url, headers=headers, verify=False, timeout=30, stream=True)
+        if response.status_code == 304:
+            cached = cache.cached_response(url, response)
+            if cached is not None:
+                get_metrics().count_transfer('cache', 1, cache.blob_size(cached.cache_digest))
+                return url, cached
+            # The blob was evicted in the meantime
+            response.close()
+            response = session.get(url, verify=False, timeout=30, stream=True)
         response.raise_for_status()
+        if cache:
+            size = cache.blob_size(cache.store(url, response))
+        else:
+            size = int(response.headers.get('Content-Length') or 0)
+        get_metrics().count_transfer('download', 1, size)
         return url, response
     except requests.exceptions.RequestException as e:
         logger.error(f"Error downloading file from {url}: {e}")
@@ -245,6 +357,120 @@ def download_file(url: str) -> Tuple[str, Optional[requests.Response]]:
         return url, None
 
 
+class AdaptiveConcurrency:
+    """
+    Size of the download window, adjusted to the observed latency and errors.
+
+    The window grows by one file after every window of successful downloads whose
+    average latency stays within LATENCY_TOLERANCE of the baseline, shrinks by one when
+    latency degrades and is halved on an error. The baseline follows a lower latency at
+    once and a higher one slowly, so the window recovers when larger files or a busier
+    platform make the higher latency the new normal.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, smoothing: float = 0.2,
+                 baseline_decay: float = BASELINE_DECAY):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.smoothing = smoothing
+        self.baseline_decay = baseline_decay
+        self.latency: Optional[float] = None
+        self.baseline_latency: Optional[float] = None
+        self._successes = 0
+
+    def observe(self, latency: float, error: bool) -> None:
+        if error:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+            return
+
+        self.latency = latency if self.latency is None else (
+            self.smoothing * latency + (1 - self.smoothing) * self.latency)
+        if self.baseline_latency is None or self.latency < self.baseline_latency:
+            self.baseline_latency = self.latency
+        else:
+            self.baseline_latency += self.baseline_decay * (self.latency - self.baseline_latency)
+
+        if self.latency > self.baseline_latency * LATENCY_TOLERANCE:
+            self.limit = max(self.minimum, self.limit - 1)
+            self._successes = 0
+            return
+
+        self._successes += 1
+        if self._successes >= self.limit:
+            self.limit = min(self.maximum, self.limit + 1)
+            self._successes = 0
+
+
+def _download_and_process(url: str, process_callback: Callable[[str, requests.Response], bool]) -> Tuple[bool, float, bool]:
+    """
+    Download one file and hand it to the callback on the same worker thread
+
+    Returns:
+        Tuple of (processed, download latency, download failed)
+    """
+    start = time.perf_counter()
+    url, response = download_file(url)
+    latency = time.perf_counter() - start
+    if response is None:
+        return False, latency, True
+    try:
+        return bool(process_callback(url, response)), latency, False
+    except Exception as e:
+        logger.error(f"Error processing download result for {url}: {e}")
+        return False, latency, False
+    finally:
+        # Explicitly close response to free resources
+        response.close()
+
+
+def _download_window(
+        urls: List[str],
+        process_callback: Callable[[str, requests.Response], bool],
+        max_workers: int
+) -> Tuple[int, int]:
+    """Keep the adaptive number of downloads in flight on the worker threads until every URL is processed"""
+    concurrency = AdaptiveConcurrency(initial=max(MIN_DOWNLOAD_FILES, max_workers // 2),
+                                      minimum=MIN_DOWNLOAD_FILES, maximum=max_workers)
+    successful = 0
+    failed = 0
+    pending = set()
+    url_iterator = iter(urls)
+    exhausted = False
+
+    # Worker threads keep their pooled keep-alive sessions for the whole download
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download") as executor:
+        while True:
+            while not exhausted and len(pending) < concurrency.limit:
+                url = next(url_iterator, None)
+                if url is None:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(_download_and_process, url, process_callback))
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    processed, latency, error = future.result()
+                except Exception as e:
+                    logger.error(f"Error in download worker: {e}")
+                    processed, latency, error = False, 0.0, True
+                concurrency.observe(latency, error)
+                if processed:
+                    successful += 1
+                else:
+                    failed += 1
+
+                if (successful + failed) % 100 == 0:
+                    logger.info(f"Downloaded {successful + failed}/{len(urls)} files, window {concurrency.limit}")
+
+    return successful, failed
+
+
 def parallel_download(
         urls: List[str],
         process_callback: Callable[[str, requests.Response], bool],
@@ -252,61 +478,157 @@ def parallel_download(
 ) -> Tuple[int, int]:
     """
     Download multiple files in parallel and process them
-    Uses batching to prevent too many open files
+    A sliding window of worker threads keeps downloads in flight without batch boundaries,
+    its size adapts to latency and errors up to max_workers. Every file is processed by the
+    callback on the worker that downloaded it. Bodies are streamed to the image cache on disk
+    (or left on the connection without a cache), so a body is only in memory while the
+    callback reads response.content.
 
     Args:
         urls: List of URLs to download
-        process_callback: Function to process each downloaded file
+        process_callback: Function to process each downloaded file, called from worker threads
                          Takes (url, response) and returns success boolean
-        max_workers: Maximum number of parallel download threads
+        max_workers: Maximum number of parallel downloads
 
     Returns:
         Tuple of (successful_count, failed_count)
     """
-    successful = 0
-    failed = 0
+    successful, failed = _download_window(urls, process_callback, max(1, max_workers))
 
-    # Process in batches to avoid too many open files
-    batch_size = max_workers * 10
+    cache = get_image_cache()
+    if cache:
+        cache.flush()
 
-    for i in range(0, len(urls), batch_size):
-        batch_urls = urls[i:i + batch_size]
-        logger.info(
-            f"Processing batch {i // batch_size + 1}/{(len(urls) - 1) // batch_size + 1} ({len(batch_urls)} files)")
+    logger.info(f"Parallel download completed: {successful} successful, {failed} failed")
+    return successful, failed
 
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all download tasks for this batch
-            future_to_url = {executor.submit(download_file, url): url for url in batch_urls}
 
-            # Process results as they complete
-            for future in as_completed(future_to_url):
-                url = future_to_url[future]
-                try:
-                    url, response = future.result()
-                    if response is not None:
-                        try:
-                            if process_callback(url, response):
-                                successful += 1
-                            else:
-                                failed += 1
-                        finally:
-                            # Explicitly close response to free resources
-                            response.close()
-                    else:
-                        failed += 1
-                except Exception as e:
-                    logger.error(f"Error processing download result for {url}: {e}")
-                    failed += 1
+def archive_member_name(url: str) -> str:
+    """Name of the file of the URL in the package archive of the platform"""
+    return urllib.parse.urlparse(url).path.lstrip('/')
 
-    logger.info(f"Parallel download completed: {successful} successful, {failed} failed")
+
+def _process_archive_member(url: str, content: bytes,
+                            process_callback: Callable[[str, requests.Response], bool]) -> bool:
+    """Hand a file extracted from the package archive to the callback as if it was downloaded by URL"""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = content
+    response._content_consumed = True
+    get_metrics().count_transfer('download', 1, len(content))
+    cache = get_image_cache()
+    if cache:
+        cache.store(url, response)
+    try:
+        return bool(process_callback(url, response))
+    except Exception as e:
+        logger.error(f"Error processing archived file {url}: {e}")
+        return False
+
+
+def archive_download(
+        archive_url: str,
+        urls: List[str],
+        process_callback: Callable[[str, requests.Response], bool],
+        max_workers: int = COUNT_DOWNLOAD_FILES
+) -> Tuple[int, int]:
+    """
+    Download the files of a package as one streamed tar and process them
+    Files are extracted from the stream on the fly and processed by a pool of workers.
+    Files missing from the archive, or left after an interrupted stream, are downloaded by URL.
+
+    Args:
+        archive_url: URL of the package archive
+        urls: List of URLs of the package files
+        process_callback: Function to process each file, called from worker threads
+        max_workers: Maximum number of files processed at the same time
+
+    Returns:
+        Tuple of (successful_count, failed_count)
+    """
+    name_to_url = {archive_member_name(url): url for url in urls}
+    extracted = set()
+    futures = []
+    in_flight = threading.BoundedSemaphore(max(1, max_workers) * 2)
+
+    def process(url: str, content: bytes) -> bool:
+        try:
+            return _process_archive_member(url, content, process_callback)
+        except Exception as e:
+            logger.error(f"Error processing archived file {url}: {e}")
+            return False
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="archive") as executor:
+        response = None
+        try:
+            response = get_platform_client().get(archive_url, stream=True)
+            if response.status_code != 200:
+                logger.error(f"Package archive is not available: HTTP {response.status_code}")
+            else:
+                response.raw.decode_content = True
+                with tarfile.open(fileobj=response.raw, mode='r|') as archive:
+                    for member in archive:
+                        url = name_to_url.get(member.name)
+                        if not member.isfile() or url is None or url in extracted:
+                            continue
+                        content = archive.extractfile(member).read()
+                        extracted.add(url)
+                        in_flight.acquire()
+                        futures.append(executor.submit(process, url, content))
+        except (requests.exceptions.RequestException, tarfile.TarError, OSError) as e:
+            logger.error(f"Error reading package archive {archive_url}: {e}")
+        finally:
+            if response is not None:
+                response.close()
+
+    successful = sum(1 for future in futures if future.result())
+    failed = len(futures) - successful
+    logger.info(f"Package archive: {successful} files processed, {failed} failed")
+
+    missing = [url for url in urls if url not in extracted]
+    if missing:
+        logger.info(f"Downloading {len(missing)} files missing from the package archive")
+        missing_successful, missing_failed = parallel_download(missing, process_callback, max_workers)
+        successful += missing_successful
+        failed += missing_failed
+    else:
+        cache = get_image_cache()
+        if cache:
+            cache.flush()
     return successful, failed
 
 
+def download_package_files(
+        urls: List[str],
+        process_callback: Callable[[str, requests.Response], bool],
+        archive_url: Optional[str] = None,
+        max_workers: int = COUNT_DOWNLOAD_FILES
+) -> Tuple[int, int]:
+    """
+    Download the files of a package, from the package archive when the platform offers one
+
+    Returns:
+        Tuple of (successful_count, failed_count)
+    """
+    if not urls:
+        # Nothing changed in an incremental package
+        return 0, 0
+    if archive_url and ConfigServer().USE_PACKAGE_ARCHIVE:
+        return archive_download(archive_url, urls, process_callback, max_workers)
+    return parallel_download(urls, process_callback, max_workers)
+
+
 class BasePlatformToTaskConverter(ABC):
     """Base class for handling different types of data processing"""
 
     @abstractmethod
-    def run(self, package_url: str, label_properties_url: str, upload_folder: str) -> bool:
+    def run(self, package_url: str, label_properties_url: str, upload_folder: str,
+            on_file_ready: Optional[Callable[[str, str], None]] = None,
+            on_image_ready: Optional[Callable[[str, DecodedImage], None]] = None,
+            skip_file: Optional[Callable[[str, str], bool]] = None) -> bool:
         """
         Download and process data from the package URL
 
@@ -314,6 +636,11 @@ class BasePlatformToTaskConverter(ABC):
             package_url: URL to download the package data
             label_properties_url: URL to download the label properties json
             upload_folder: Directory to store the processed data
+            on_file_ready: Called with (record_id, filename) as soon as an image is saved to upload_folder
+            on_image_ready: Called with (record_id, image) for every downloaded image instead of saving it,
+                            the PNG is written to upload_folder only if the consumer asks for image.path
+            skip_file: Called with (record_id, filename) of every image before the download,
+                       the image is not downloaded if it returns True
 
         Returns:
             bool: True if processing was successful, False otherwise
@@ -2,18 +2,22 @@ import os
 import json
 import requests
 import logging
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 from threading import Lock
 
 from common.platform_to_task_converter.base import BasePlatformToTaskConverter, MERGED_JSON, MAPPING_FILE, COUNT_DOWNLOAD_FILES
-from ML_server.config import Config
+from ML_server.platform_client import get_platform_client
+from common.models import ProcessingMode
+from common.platform_to_task_converter.training_set import prepare_training_package
 from common.platform_to_task_converter.base import (
     decode_filename,
+    DecodedImage,
     convert_webp_to_png,
     ensure_directory_exists,
     save_mapping_file,
     save_json_data,
-    parallel_download
+    download_package_files,
+    drop_skipped_images
 )
 
 logger = logging.getLogger(__name__)
@@ -102,12 +106,17 @@ class DetectionPlatformToTaskConverter(BasePlatformToTaskConverter):
             logger.error(f"Error building record files map: {e}")
             return {}
 
-    def _create_file_processor(self, upload_folder: str):
+    def _create_file_processor(self, upload_folder: str, url_to_record_map: Optional[Dict[str, str]] = None,
+                               on_file_ready: Optional[Callable[[str, str], None]] = None,
+                               on_image_ready: Optional[Callable[[str, DecodedImage], None]] = None):
         """
         Create a callback function for processing downloaded files
 
         Args:
             upload_folder: Directory to save files
+            url_to_record_map: Mapping of URLs to record IDs
+            on_file_ready: Called with (record_id, filename) for every saved image
+            on_image_ready: Called with (record_id, image) for every downloaded image, which is not saved then
 
         Returns:
             Callback function
@@ -120,9 +129,20 @@ class DetectionPlatformToTaskConverter(BasePlatformToTaskConverter):
                 filename = decode_filename(filename)
 
                 # Process based on file type
-                if filename.endswith('.webp'):
+                if filename.endswith('.webp') and on_image_ready:
+                    # The consumer decides whether the PNG is written at all
+                    if url_to_record_map and url in url_to_record_map:
+                        on_image_ready(url_to_record_map[url], DecodedImage(
+                            file_response.content, filename, upload_folder, getattr(file_response, 'cache_digest', None)))
+                    return True
+
+                elif filename.endswith('.webp'):
                     png_filename = convert_webp_to_png(file_response, filename, upload_folder)
-                    return png_filename is not None
+                    if png_filename is None:
+                        return False
+                    if on_file_ready and url_to_record_map and url in url_to_record_map:
+                        on_file_ready(url_to_record_map[url], png_filename)
+                    return True
 
                 elif filename.endswith('.json'):
                     return self._process_json_file(file_response, filename)
@@ -151,7 +171,10 @@ class DetectionPlatformToTaskConverter(BasePlatformToTaskConverter):
                 all_urls.extend(urls)
         return all_urls
 
-    def run(self, package_url: str, label_properties_url: str, upload_folder: str) -> bool:
+    def run(self, package_url: str, label_properties_url: str, upload_folder: str,
+            on_file_ready: Optional[Callable[[str, str], None]] = None,
+            on_image_ready: Optional[Callable[[str, DecodedImage], None]] = None,
+            skip_file: Optional[Callable[[str, str], bool]] = None) -> bool:
         """
         Download and process detection data
 
@@ -159,6 +182,9 @@ class DetectionPlatformToTaskConverter(BasePlatformToTaskConverter):
             package_url: URL to download the package data
             label_properties_url: URL to download the label properties json
             upload_folder: Directory to store the processed data
+            on_file_ready: Called with (record_id, filename) as soon as an image is saved to upload_folder
+            on_image_ready: Called with (record_id, image) for every downloaded image instead of saving it
+            skip_file: Called with (record_id, filename) of every image, the image is not downloaded if it returns True
 
         Returns:
             bool: True if processing was successful, False otherwise
@@ -173,7 +199,7 @@ class DetectionPlatformToTaskConverter(BasePlatformToTaskConverter):
         # Download package data
         try:
             logger.info("Downloading package data...")
-            response = requests.get(package_url, headers=Config().authorization(), verify=False)
+            response = get_platform_client().get(package_url)
             response.raise_for_status()
 
         except requests.exceptions.RequestException as e:
@@ -194,21 +220,40 @@ class DetectionPlatformToTaskConverter(BasePlatformToTaskConverter):
                 logger.error("Missing 'records' key in package data")
                 return False
 
+            # An incremental training package is completed from the retained training set
+            try:
+                data, training_set, kept = prepare_training_package(data, ProcessingMode.DETECTION.value)
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logger.error(f"Error downloading the full training set: {e}")
+                return False
+
             # Build record files mapping
             record_files_map = self._build_record_files_map(data['records'])
+            if kept:
+                for record_id, files in training_set.restore(upload_folder, kept).items():
+                    record_files_map[record_id] = files[0]
+                    if on_file_ready:
+                        on_file_ready(record_id, files[0])
+                self.merged_json.update(training_set.restored_annotations(kept))
 
             # Collect all URLs for parallel download
             all_urls = self._collect_all_urls(data['records'])
+            url_to_record_map = {
+                url: record_id for record in data['records'] for record_id, urls in record.items() for url in urls
+            }
+            # Images uploaded by an interrupted run of the job are not downloaded again
+            all_urls = drop_skipped_images(all_urls, url_to_record_map, skip_file)
 
             logger.info(f"Starting parallel download of {len(all_urls)} files...")
 
             # Create file processor callback
-            file_processor = self._create_file_processor(upload_folder)
+            file_processor = self._create_file_processor(upload_folder, url_to_record_map, on_file_ready, on_image_ready)
 
             # Download and process all files in parallel
-            successful, failed = parallel_download(
+            successful, failed = download_package_files(
                 urls=all_urls,
                 process_callback=file_processor,
+                archive_url=data.get('archive'),
                 max_workers=COUNT_DOWNLOAD_FILES
             )
 
@@ -222,7 +267,10 @@ class DetectionPlatformToTaskConverter(BasePlatformToTaskConverter):
             mapping_success = save_mapping_file(record_files_map, mapping_file_path)
 
             # Consider successful if most files downloaded and mappings saved
-            return json_success and mapping_success and (failed == 0 or successful > 0)
+            success = json_success and mapping_success and (failed == 0 or successful > 0)
+            if success and training_set is not None:
+                training_set.save(upload_folder, record_files_map, data['watermark'], annotations=self.merged_json)
+            return success
 
         except Exception as e:
             logger.error(f"Unexpected error in detection processing: {e}")
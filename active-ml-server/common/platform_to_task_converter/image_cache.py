@@ -0,0 +1,376 @@
+import os
+import json
+import time
+import stat
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+import requests
+
+from quantitave_analysis.models.config import Config
+from common.tools.file_routines import link_or_copy
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+STREAM_CHUNK_SIZE = 64 * 1024  # Bytes of a streamed download hashed and written at a time
+EVICTION_LOW_WATER = 0.9  # Share of max_bytes the cache is trimmed to, so eviction does not run on every store
+DIGEST_LENGTH = 64  # Length of a hex sha256 digest, the name of a blob
+
+
+class _BlobBody:
+    """Body of a cached response, read from the blob file only when the consumer asks for the content"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._file.read(size)
+        if not chunk:
+            # requests does not close the body once it is consumed
+            self._file.close()
+        return chunk
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_body_from_blob(response: requests.Response, path: str) -> None:
+    """Serve the content of the response from the blob file instead of memory"""
+    original = response.raw
+    response.raw = _BlobBody(path)
+    response._content = False
+    response._content_consumed = False
+    release_conn = getattr(original, 'release_conn', None)
+    if release_conn is not None:
+        release_conn()
+
+
+class ImageCache:
+    """
+    Persistent content-addressed cache of downloaded package files.
+
+    Files are stored once under the sha256 of their content. The index remembers
+    the digest and the validators (ETag, Last-Modified) of every URL, so a repeated
+    download becomes a conditional GET answered with 304 by the platform. Files
+    derived from a blob (the PNG converted from a WebP image) are cached next to it
+    and hard-linked into the job folders. Blobs are read-only, so a job can not
+    modify the cache through a link. The least recently used blobs are evicted when
+    the cache grows over max_bytes.
+
+    The index is written by flush() at the end of a download. Blobs written after the
+    last flush are found again in the blob folder when the cache is opened.
+    """
+
+    def __init__(self, root: str = Config().IMAGE_CACHE_FOLDER, max_bytes: int = Config().IMAGE_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._blobs_folder = os.path.join(root, 'blobs')
+        self._index_path = os.path.join(root, INDEX_FILE)
+        self._lock = threading.Lock()
+        self._dirty = False
+        os.makedirs(self._blobs_folder, exist_ok=True)
+        self._urls: Dict[str, Dict] = {}
+        # Blobs in the order of their last use, the least recently used first
+        self._blobs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._blob_urls: Dict[str, Set[str]] = {}
+        self._load_index()
+        self._total_bytes = sum(self._blob_size(blob) for blob in self._blobs.values())
+
+    @staticmethod
+    def _blob_size(blob: Dict) -> int:
+        return blob['size'] + sum(blob['derived'].values())
+
+    def _load_index(self) -> None:
+        """Read the index and reconcile it with the blobs on disk"""
+        urls, blobs = {}, {}
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            urls = index.get('urls', {})
+            blobs = index.get('blobs', {})
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, IOError) as e:
+            logger.warning(f"Image cache index is unreadable, rebuilding it from the blobs: {e}")
+
+        on_disk = self._scan_blobs()
+        recovered = 0
+        for digest, files in on_disk.items():
+            blob = blobs.get(digest)
+            if blob is None:
+                # Written after the last flush, the URLs are lost but the content can be reused
+                blob = blobs[digest] = {'size': 0, 'derived': {}, 'last_used': files['last_used']}
+                recovered += 1
+            blob['size'] = files['size']
+            blob['derived'] = {suffix: size for suffix, size in files['derived'].items()}
+        missing = [digest for digest in blobs if digest not in on_disk]
+        for digest in missing:
+            del blobs[digest]
+
+        self._blobs = OrderedDict(sorted(blobs.items(), key=lambda item: item[1]['last_used']))
+        self._urls = {url: entry for url, entry in urls.items() if entry['digest'] in self._blobs}
+        for url, entry in self._urls.items():
+            self._blob_urls.setdefault(entry['digest'], set()).add(url)
+        if recovered or missing or len(self._urls) != len(urls):
+            logger.info(f"Image cache index reconciled: {recovered} blobs recovered, {len(missing)} missing blobs dropped")
+            self._dirty = True
+
+    def _scan_blobs(self) -> Dict[str, Dict]:
+        """Blobs and their derived files in the blob folder, leftovers of interrupted writes are removed"""
+        blobs: Dict[str, Dict] = {}
+        derived = []
+        for folder, _, files in os.walk(self._blobs_folder):
+            for name in files:
+                path = os.path.join(folder, name)
+                if name.endswith('.tmp') or len(name) < DIGEST_LENGTH:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    file_stat = os.stat(path)
+                except OSError:
+                    continue
+                digest, suffix = name[:DIGEST_LENGTH], name[DIGEST_LENGTH:]
+                if suffix:
+                    derived.append((digest, suffix, file_stat.st_size))
+                else:
+                    blobs[digest] = {'size': file_stat.st_size, 'derived': {}, 'last_used': file_stat.st_mtime}
+        for digest, suffix, size in derived:
+            if digest in blobs:
+                blobs[digest]['derived'][suffix] = size
+            else:
+                try:
+                    os.remove(self.blob_path(digest, suffix))
+                except OSError:
+                    pass
+        return blobs
+
+    def flush(self) -> None:
+        """Write the index to disk"""
+        with self._lock:
+            if not self._dirty:
+                return
+            index = {'urls': self._urls, 'blobs': self._blobs}
+            self._dirty = False
+        temp_path = self._index_path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(temp_path, self._index_path)
+        except IOError as e:
+            logger.error(f"Error saving image cache index: {e}")
+
+    def blob_path(self, digest: str, suffix: str = '') -> str:
+        return os.path.join(self._blobs_folder, digest[:2], digest + suffix)
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """Validators of the cached copy of the URL for a conditional GET"""
+        with self._lock:
+            entry = self._urls.get(url)
+            if not entry or entry['digest'] not in self._blobs or not os.path.exists(self.blob_path(entry['digest'])):
+                return {}
+            headers = {}
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            return headers
+
+    def _touch(self, digest: str) -> None:
+        self._blobs[digest]['last_used'] = time.time()
+        self._blobs.move_to_end(digest)
+        self._dirty = True
+
+    def cached_response(self, url: str, response: requests.Response) -> Optional[requests.Response]:
+        """
+        Fill a 304 response with the cached content of the URL
+
+        Args:
+            url: Requested URL
+            response: Response with status 304
+
+        Returns:
+            Response with status 200 and the cached content, None if the blob is gone
+        """
+        with self._lock:
+            entry = self._urls.get(url)
+            if not entry or entry['digest'] not in self._blobs:
+                return None
+            digest = entry['digest']
+            self._touch(digest)
+        try:
+            read_body_from_blob(response, self.blob_path(digest))
+        except IOError:
+            return None
+        response.status_code = 200
+        response.cache_digest = digest
+        return response
+
+    def store(self, url: str, response: requests.Response) -> str:
+        """
+        Save the content of a downloaded file
+
+        The body of a streamed response is hashed and written to the blob chunk by chunk as it
+        arrives. It is not kept in memory: response.content reads it back from the blob when
+        the consumer asks for it.
+
+        Args:
+            url: Requested URL
+            response: Response with status 200
+
+        Returns:
+            str: Digest of the content, also set as response.cache_digest
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        streamed = not response._content_consumed
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self._blobs_folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = sha256.hexdigest()
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        if streamed:
+            # Opened before eviction can remove the blob
+            read_body_from_blob(response, path)
+
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None:
+                blob = self._blobs[digest] = {'size': size, 'derived': {}, 'last_used': 0.0}
+                self._total_bytes += size
+            previous = self._urls.get(url)
+            if previous and previous['digest'] != digest:
+                self._blob_urls.get(previous['digest'], set()).discard(url)
+            self._blob_urls.setdefault(digest, set()).add(url)
+            self._urls[url] = {
+                'digest': digest,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+            self._touch(digest)
+        response.cache_digest = digest
+        self._evict()
+        return digest
+
+    def blob_size(self, digest: str) -> int:
+        """Size of a cached blob, 0 if it is not cached"""
+        with self._lock:
+            blob = self._blobs.get(digest)
+            return blob['size'] if blob else 0
+
+    def get_derived(self, digest: str, suffix: str, destination: str) -> bool:
+        """
+        Link the cached file derived from a blob to the destination
+
+        Args:
+            digest: Digest of the source blob
+            suffix: Suffix of the derived file, for example '.png'
+            destination: Path to place the file at
+
+        Returns:
+            bool: True if the derived file was cached
+        """
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if not blob or suffix not in blob['derived']:
+                return False
+            self._touch(digest)
+        derived_path = self.blob_path(digest, suffix)
+        try:
+            link_or_copy(derived_path, destination)
+            return True
+        except OSError:
+            return False
+
+    def store_derived(self, digest: str, suffix: str, source: str) -> None:
+        """
+        Cache a file derived from a blob
+
+        Args:
+            digest: Digest of the source blob
+            suffix: Suffix of the derived file, for example '.png'
+            source: Path to the derived file
+        """
+        with self._lock:
+            if digest not in self._blobs:
+                return
+        derived_path = self.blob_path(digest, suffix)
+        try:
+            if not os.path.exists(derived_path):
+                temp_path = derived_path + '.tmp'
+                shutil.copyfile(source, temp_path)
+                os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.replace(temp_path, derived_path)
+        except OSError as e:
+            logger.warning(f"Could not cache {source}: {e}")
+            return
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None or suffix in blob['derived']:
+                return
+            blob['derived'][suffix] = os.path.getsize(derived_path)
+            self._total_bytes += blob['derived'][suffix]
+            self._dirty = True
+        self._evict()
+
+    def _evict(self) -> None:
+        """Remove the least recently used blobs when the cache grows over max_bytes, down to the low-water mark"""
+        with self._lock:
+            if self._total_bytes <= self.max_bytes:
+                return
+            target = self.max_bytes * EVICTION_LOW_WATER
+            evicted = []
+            while self._blobs and self._total_bytes > target:
+                digest, blob = self._blobs.popitem(last=False)
+                self._total_bytes -= self._blob_size(blob)
+                for url in self._blob_urls.pop(digest, ()):
+                    self._urls.pop(url, None)
+                evicted.append((digest, list(blob['derived'])))
+            self._dirty = True
+
+        for digest, suffixes in evicted:
+            for suffix in [''] + suffixes:
+                try:
+                    os.remove(self.blob_path(digest, suffix))
+                except OSError:
+                    pass
+        logger.info(f"Evicted {len(evicted)} files from image cache")
+
+
+_image_cache: Optional[ImageCache] = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache() -> Optional[ImageCache]:
+    """Image cache shared by all jobs of the process, None if it is disabled"""
+    global _image_cache
+    if not Config().IMAGE_CACHE_MAX_BYTES:
+        return None
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache()
+        return _image_cache
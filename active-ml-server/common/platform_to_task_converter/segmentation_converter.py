@@ -2,18 +2,22 @@ import os
 import json
 import requests
 import logging
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 from threading import Lock
 
 from common.platform_to_task_converter.base import BasePlatformToTaskConverter, MAPPING_FILE, LABEL_PROPERTIES, COUNT_DOWNLOAD_FILES
-from ML_server.config import Config
+from ML_server.platform_client import get_platform_client
+from common.models import ProcessingMode
+from common.platform_to_task_converter.training_set import prepare_training_package
 from common.platform_to_task_converter.base import (
+    DecodedImage,
     decode_filename,
     convert_webp_to_png,
     download_and_save_json,
     ensure_directory_exists,
     save_mapping_file,
-    parallel_download
+    download_package_files,
+    drop_skipped_images
 )
 
 logger = logging.getLogger(__name__)
@@ -26,13 +30,17 @@ class SegmentationPlatformToTaskConverter(BasePlatformToTaskConverter):
         self.record_files_map = {}
         self.record_files_lock = Lock()
 
-    def _create_file_processor(self, upload_folder: str, url_to_record_map: Dict[str, str]):
+    def _create_file_processor(self, upload_folder: str, url_to_record_map: Dict[str, str],
+                               on_file_ready: Optional[Callable[[str, str], None]] = None,
+                               on_image_ready: Optional[Callable[[str, DecodedImage], None]] = None):
         """
         Create a callback function for processing downloaded files
 
         Args:
             upload_folder: Directory to save files
             url_to_record_map: Mapping of URLs to record IDs
+            on_file_ready: Called with (record_id, filename) for every saved image
+            on_image_ready: Called with (record_id, image) for every downloaded image, which is not saved then
 
         Returns:
             Callback function
@@ -48,8 +56,14 @@ class SegmentationPlatformToTaskConverter(BasePlatformToTaskConverter):
                 original_filename = url.split('/')[-1].split('?')[0]
                 original_filename = decode_filename(original_filename)
 
-                # Convert to PNG
-                png_filename = convert_webp_to_png(img_response, original_filename, upload_folder)
+                if on_image_ready:
+                    # The consumer decides whether the PNG is written at all
+                    image = DecodedImage(img_response.content, original_filename, upload_folder,
+                                         getattr(img_response, 'cache_digest', None))
+                    png_filename = image.filename
+                else:
+                    # Convert to PNG
+                    png_filename = convert_webp_to_png(img_response, original_filename, upload_folder)
 
                 if png_filename:
                     # Thread-safe addition to record_files_map
@@ -57,6 +71,10 @@ class SegmentationPlatformToTaskConverter(BasePlatformToTaskConverter):
                         if record_id not in self.record_files_map:
                             self.record_files_map[record_id] = []
                         self.record_files_map[record_id].append(png_filename)
+                    if on_image_ready:
+                        on_image_ready(record_id, image)
+                    elif on_file_ready:
+                        on_file_ready(record_id, png_filename)
                     return True
                 else:
                     logger.error(f"Failed to convert file {original_filename} for record {record_id}")
@@ -94,7 +112,10 @@ class SegmentationPlatformToTaskConverter(BasePlatformToTaskConverter):
             logger.error(f"Error building URL to record map: {e}")
             return {}, []
 
-    def run(self, package_url: str, label_properties_url: str, upload_folder: str) -> bool:
+    def run(self, package_url: str, label_properties_url: str, upload_folder: str,
+            on_file_ready: Optional[Callable[[str, str], None]] = None,
+            on_image_ready: Optional[Callable[[str, DecodedImage], None]] = None,
+            skip_file: Optional[Callable[[str, str], bool]] = None) -> bool:
         """
         Download and process segmentation data
 
@@ -102,6 +123,9 @@ class SegmentationPlatformToTaskConverter(BasePlatformToTaskConverter):
             package_url: URL to download the package data
             label_properties_url: URL to download the label properties json
             upload_folder: Directory to store the processed data
+            on_file_ready: Called with (record_id, filename) as soon as an image is saved to upload_folder
+            on_image_ready: Called with (record_id, image) for every downloaded image instead of saving it
+            skip_file: Called with (record_id, filename) of every image, the image is not downloaded if it returns True
 
         Returns:
             bool: True if processing was successful, False otherwise
@@ -115,14 +139,14 @@ class SegmentationPlatformToTaskConverter(BasePlatformToTaskConverter):
 
         # Download and save label properties
         label_properties_path = os.path.join(upload_folder, LABEL_PROPERTIES)
-        if not download_and_save_json(label_properties_url, label_properties_path, Config().authorization()):
+        if not download_and_save_json(label_properties_url, label_properties_path):
             logger.error("Failed to download label properties")
             return False
 
         # Download package data
         try:
             logger.info("Downloading package data...")
-            response = requests.get(package_url, headers=Config().authorization(), verify=False)
+            response = get_platform_client().get(package_url)
             response.raise_for_status()
 
         except requests.exceptions.RequestException as e:
@@ -143,35 +167,55 @@ class SegmentationPlatformToTaskConverter(BasePlatformToTaskConverter):
                 logger.error("Missing 'records' key in package data")
                 return False
 
+            # An incremental training package is completed from the retained training set
+            try:
+                data, training_set, kept = prepare_training_package(data, ProcessingMode.SEGMENTATION.value)
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logger.error(f"Error downloading the full training set: {e}")
+                return False
+
+            if kept:
+                for record_id, files in training_set.restore(upload_folder, kept).items():
+                    self.record_files_map[record_id] = files
+                    if on_file_ready:
+                        for filename in files:
+                            on_file_ready(record_id, filename)
+
             # Build URL to record mapping and collect all URLs
             url_to_record_map, all_urls = self._build_url_to_record_map(data['records'])
 
-            if not all_urls:
+            if not all_urls and not kept:
                 logger.error("No URLs found in package data")
                 return False
 
+            # Images uploaded by an interrupted run of the job are not downloaded again
+            urls_to_download = drop_skipped_images(all_urls, url_to_record_map, skip_file)
+            skipped = len(all_urls) - len(urls_to_download)
+            all_urls = urls_to_download
+
             logger.info(f"Starting parallel download of {len(all_urls)} files...")
 
             # Create file processor callback
-            file_processor = self._create_file_processor(upload_folder, url_to_record_map)
+            file_processor = self._create_file_processor(upload_folder, url_to_record_map, on_file_ready, on_image_ready)
 
             # Download and process all files in parallel
-            successful, failed = parallel_download(
+            successful, failed = download_package_files(
                 urls=all_urls,
                 process_callback=file_processor,
+                archive_url=data.get('archive'),
                 max_workers=COUNT_DOWNLOAD_FILES
             )
 
             logger.info(f"Downloaded {successful} files successfully, {failed} failed")
 
-            if not self.record_files_map:
+            if not self.record_files_map and not skipped:
                 logger.error("No records were successfully processed")
                 return False
 
             # Log warnings for records with no files
             for record in data['records']:
                 for record_id in record.keys():
-                    if record_id not in self.record_files_map or not self.record_files_map[record_id]:
+                    if not skipped and not self.record_files_map.get(record_id):
                         logger.warning(f"No files were successfully processed for record {record_id}")
 
         except Exception as e:
@@ -184,5 +228,8 @@ class SegmentationPlatformToTaskConverter(BasePlatformToTaskConverter):
             logger.error("Failed to save mapping file")
             return False
 
+        if training_set is not None:
+            training_set.save(upload_folder, self.record_files_map, data['watermark'])
+
         logger.info(f"Successfully processed {len(self.record_files_map)} records")
         return True
@@ -0,0 +1,203 @@
+import os
+import json
+import shutil
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from common.tools.file_routines import link_or_copy
+from ML_server.config import Config as ConfigServer
+from ML_server.platform_client import get_platform_client
+from quantitave_analysis.models.config import Config
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'state.json'
+FILES_FOLDER = 'files'
+
+
+def _parse_watermark(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+class RetainedTrainingSet:
+    """
+    Files of the last training package of a dataset, kept between jobs.
+
+    An incremental training package carries only the records changed since the
+    watermark of the previous training package, the list of all record IDs of the
+    training set and the deleted records. The unchanged records are hard-linked from
+    the retained set into the upload folder, so they are not downloaded again.
+    state.json stores the watermark, the files of every record and, for detection,
+    the boxes of every record.
+    """
+
+    def __init__(self, dataset_id: int, mode: str, root: str = Config().TRAINING_SETS_FOLDER):
+        self.folder = os.path.join(root, str(mode), str(dataset_id))
+        self.watermark: Optional[str] = None
+        self.records: Dict[str, List[str]] = {}
+        self.annotations: Dict[str, Dict[str, Any]] = {}
+        self._state_path = os.path.join(self.folder, STATE_FILE)
+        self._files_folder = os.path.join(self.folder, FILES_FOLDER)
+
+    def load(self) -> bool:
+        """
+        Load the retained set
+
+        Returns:
+            bool: True if there is a retained set
+        """
+        try:
+            with open(self._state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (json.JSONDecodeError, IOError) as e:
+            logger.warning(f"Retained training set {self.folder} is unreadable: {e}")
+            return False
+
+        self.watermark = state.get('watermark')
+        self.records = state.get('records', {})
+        self.annotations = state.get('annotations', {})
+        return True
+
+    def kept_records(self, data: Dict) -> Optional[List[str]]:
+        """
+        IDs of the retained records an incremental package is built on
+
+        Args:
+            data: Package data with 'since', 'records' and 'record_ids'
+
+        Returns:
+            Record IDs to restore, None if the retained set is not the base of the package
+        """
+        since = _parse_watermark(data.get('since'))
+        if since is None or since != _parse_watermark(self.watermark):
+            return None
+
+        changed = {str(record_id) for record in data['records'] for record_id in record}
+        kept = [str(record_id) for record_id in data.get('record_ids', []) if str(record_id) not in changed]
+        for record_id in kept:
+            files = self.records.get(record_id)
+            if not files or not all(os.path.exists(os.path.join(self._files_folder, name)) for name in files):
+                return None
+        return kept
+
+    def restore(self, upload_folder: str, record_ids: List[str]) -> Dict[str, List[str]]:
+        """
+        Link the files of retained records into the upload folder
+
+        Args:
+            upload_folder: Folder of the job
+            record_ids: Records to restore
+
+        Returns:
+            Mapping of record IDs to their files
+        """
+        restored = {}
+        for record_id in record_ids:
+            for name in self.records[record_id]:
+                link_or_copy(os.path.join(self._files_folder, name), os.path.join(upload_folder, name))
+            restored[record_id] = list(self.records[record_id])
+        return restored
+
+    def save(self, upload_folder: str, record_files_map: Dict[str, Union[str, List[str]]], watermark: str,
+             annotations: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Replace the retained set with the training set of a finished download
+
+        Args:
+            upload_folder: Folder of the job holding the files
+            record_files_map: Mapping of record IDs to their files
+            watermark: Watermark of the package
+            annotations: Boxes keyed by image name, for detection
+        """
+        new_folder = self._files_folder + '.new'
+        records = {}
+        record_annotations = {}
+        try:
+            shutil.rmtree(new_folder, ignore_errors=True)
+            os.makedirs(new_folder)
+            for record_id, files in record_files_map.items():
+                files = [files] if isinstance(files, str) else list(files)
+                try:
+                    for name in files:
+                        link_or_copy(os.path.join(upload_folder, name), os.path.join(new_folder, name))
+                except OSError:
+                    # Left out, an incremental package relying on it falls back to the full training set
+                    continue
+                records[str(record_id)] = files
+                if annotations is not None:
+                    record_annotations[str(record_id)] = {
+                        os.path.splitext(name)[0]: annotations[os.path.splitext(name)[0]]
+                        for name in files if os.path.splitext(name)[0] in annotations
+                    }
+
+            # The old state is dropped first, an interrupted save leaves no retained set instead of a broken one
+            if os.path.exists(self._state_path):
+                os.remove(self._state_path)
+            shutil.rmtree(self._files_folder, ignore_errors=True)
+            os.replace(new_folder, self._files_folder)
+
+            temp_path = self._state_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'watermark': watermark, 'records': records, 'annotations': record_annotations}, f)
+            os.replace(temp_path, self._state_path)
+        except OSError as e:
+            logger.error(f"Error saving retained training set {self.folder}: {e}")
+            return
+
+        self.watermark = watermark
+        self.records = records
+        self.annotations = record_annotations
+        logger.info(f"Retained training set {self.folder}: {len(records)} records")
+
+    def restored_annotations(self, record_ids: List[str]) -> Dict[str, Any]:
+        """Boxes of the retained records keyed by image name"""
+        merged = {}
+        for record_id in record_ids:
+            merged.update(self.annotations.get(record_id, {}))
+        return merged
+
+
+def prepare_training_package(data: Dict, mode: str) -> Tuple[Dict, Optional[RetainedTrainingSet], List[str]]:
+    """
+    Resolve an incremental training package against the retained training set
+
+    Packages without a watermark (inference, platforms without incremental packages)
+    are returned unchanged. If the retained set is not the base of an incremental
+    package, the full training set is requested from the platform instead.
+
+    Args:
+        data: Package data
+        mode: Processing mode of the package
+
+    Returns:
+        Tuple of (package data to download, retained set to update or None, IDs of records to restore)
+    """
+    if 'watermark' not in data:
+        return data, None, []
+
+    training_set = None
+    if ConfigServer().RETAIN_TRAINING_SETS:
+        training_set = RetainedTrainingSet(data['dataset_id'], mode)
+    if not data.get('since'):
+        return data, training_set, []
+
+    kept = None
+    if training_set is not None and training_set.load():
+        kept = training_set.kept_records(data)
+    if kept is not None:
+        logger.info(f"Incremental training package: {len(data['records'])} changed, {len(kept)} retained, "
+                    f"{len(data.get('deleted', []))} deleted records")
+        return data, training_set, kept
+
+    logger.info("Retained training set does not match the package, downloading the full training set")
+    response = get_platform_client().get(data['full'])
+    response.raise_for_status()
+    full = response.json()
+    data = dict(data, records=full['records'], record_ids=full['record_ids'], archive=full.get('archive'), since=None)
+    return data, training_set, []
@@ -1,15 +1,26 @@
 from abc import ABC, abstractmethod
 import os
 import json
+import time
 import requests
 from PIL import Image
 import logging
-from typing import Dict, List, Tuple, Optional, Any
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, List, Tuple, Optional, Any
+from pydantic import BaseModel
+
+from ML_server.platform_client import get_platform_client
+from ML_server.metrics import get_metrics
 
 logger = logging.getLogger(__name__)
 
 RESULTS_JSON = 'output.json'
+RESULTS_JSONL = 'output.jsonl'  # Detection results written one image per line
 MAPPING_FILE = 'record_files_mapping.json'
+PARALLEL_UPLOAD_BATCHES = 4  # Count of batches converted and uploaded at the same time
+UPLOAD_ATTEMPTS = 3  # Attempts to upload a batch before it is reported as failed
+UPLOAD_RETRY_DELAY = 2.0  # Delay before the first retry, doubled for every next one
 
 
 def load_mapping_file(mapping_file_path: str) -> Optional[Dict[str, Any]]:
@@ -112,8 +123,15 @@ def convert_png_to_webp(png_path: str, webp_path: str, quality: int = 90) -> boo
         return False
 
 
-def upload_files_to_platform(files: List[Tuple], upload_url: str, task_mode: str,
-                             package_id: int, headers: Dict[str, str]) -> bool:
+def _uploaded_size(file: Tuple) -> int:
+    """Size of a (field, (filename, file object, content type)) upload tuple"""
+    try:
+        return os.fstat(file[1][1].fileno()).st_size
+    except (AttributeError, IndexError, OSError, TypeError):
+        return 0
+
+
+def upload_files_to_platform(files: List[Tuple], upload_url: str, task_mode: str, package_id: int) -> bool:
     """
     Upload files to platform
 
@@ -122,7 +140,6 @@ def upload_files_to_platform(files: List[Tuple], upload_url: str, task_mode: str
         upload_url: URL to upload files to
         task_mode: Task mode identifier
         package_id: Package ID
-        headers: Request headers
 
     Returns:
         True if upload successful, False otherwise
@@ -132,18 +149,17 @@ def upload_files_to_platform(files: List[Tuple], upload_url: str, task_mode: str
         return True
 
     try:
-        response = requests.post(
+        response = get_platform_client().post(
             upload_url,
             files=files,
-            data={'mode': task_mode, 'package_id': package_id},
-            headers=headers,
-            verify=False
+            data={'mode': task_mode, 'package_id': package_id}
         )
 
         if response.status_code != 200:
             logger.error(f"Failed to upload results: HTTP {response.status_code}")
             return False
 
+        get_metrics().count_transfer('upload', len(files), sum(_uploaded_size(file) for file in files))
         return True
 
     except requests.exceptions.RequestException as e:
@@ -189,7 +205,9 @@ class BaseResultsToPlatformConverter(ABC):
     """Base class for handling post-processing of results"""
 
     @abstractmethod
-    def run(self, return_folder: str, upload_folder: str, result_upload_url: str, package_id: int) -> bool:
+    def run(self, return_folder: str, upload_folder: str, result_upload_url: str, package_id: int,
+            is_uploaded: Optional[Callable[[str], bool]] = None,
+            on_uploaded: Optional[Callable[[List[str]], None]] = None) -> bool:
         """
         Process results and upload them to the platform
 
@@ -198,9 +216,184 @@ class BaseResultsToPlatformConverter(ABC):
             upload_folder: Directory containing the input data
             result_upload_url: URL to upload the results
             package_id: Package ID
+            is_uploaded: Called with the upload journal key of an image, True if its result is already uploaded
+            on_uploaded: Called with the journal keys of every uploaded batch
 
         Returns:
             bool: True if processing was successful, False otherwise
         """
         pass
 
+    @abstractmethod
+    def prepare_result(self, record_id: str, result: Any, return_folder: str) -> Optional[Tuple[str, str, str]]:
+        """
+        Turn the prediction of one image into a file ready for upload
+
+        Args:
+            record_id: Record ID of the image
+            result: Prediction returned by the ML routine for the image
+            return_folder: Directory to store the file
+
+        Returns:
+            Tuple (record_id, filename, file_path) or None if the result can not be prepared
+        """
+        pass
+
+    @abstractmethod
+    def upload_batch(self, file_batch: List[Tuple[str, str, str]], result_upload_url: str, package_id: int) -> bool:
+        """
+        Upload a batch of prepared files to the platform
+
+        Args:
+            file_batch: List of tuples (record_id, filename, file_path)
+            result_upload_url: URL to upload the results
+            package_id: Package ID
+
+        Returns:
+            bool: True if upload was successful, False otherwise
+        """
+        pass
+
+
+class UploadBatchReport(BaseModel):
+    batch_number: int
+    files: int
+    # Results of the batch that could not be prepared for upload
+    failed_files: int = 0
+    # The prepared files were sent to the platform
+    uploaded: bool
+    # Every result of the batch was uploaded and journaled
+    success: bool
+    attempts: int
+
+
+class IncrementalResultUploader:
+    """
+    Uploads results of a package while they are still being produced.
+
+    Results are collected into batches of converter.batch_size. Every full batch is
+    prepared (converted to the upload format) and uploaded on a worker thread, failed
+    uploads are retried with exponential backoff. add() blocks while too many batches
+    are in flight, so a slow platform holds back the producer instead of piling up files.
+    """
+
+    def __init__(self,
+                 converter: BaseResultsToPlatformConverter,
+                 result_upload_url: str,
+                 package_id: int,
+                 return_folder: str,
+                 parallel_batches: int = PARALLEL_UPLOAD_BATCHES,
+                 attempts: int = UPLOAD_ATTEMPTS,
+                 retry_delay: float = UPLOAD_RETRY_DELAY,
+                 on_uploaded: Optional[Callable[[List[str]], None]] = None):
+        self.converter = converter
+        self.result_upload_url = result_upload_url
+        self.package_id = package_id
+        self.return_folder = return_folder
+        self.attempts = max(1, attempts)
+        self.retry_delay = retry_delay
+        self.on_uploaded = on_uploaded
+        self.reports: List[UploadBatchReport] = []
+
+        self._executor = ThreadPoolExecutor(max_workers=parallel_batches, thread_name_prefix=f"upload-{package_id}")
+        self._in_flight = threading.BoundedSemaphore(parallel_batches * 2)
+        self._reports_lock = threading.Lock()
+        self._futures: List[Future] = []
+        self._pending: List[Tuple[str, Any, str]] = []
+        self._batch_number = 0
+
+    def add(self, record_id: str, result: Any, key: Optional[str] = None) -> None:
+        """
+        Add the prediction of one image, it is prepared with converter.prepare_result
+
+        Args:
+            record_id: Record ID of the image
+            result: Prediction returned by the ML routine for the image
+            key: Passed to on_uploaded once the result is uploaded, the record ID by default
+        """
+        self._pending.append((record_id, result, key or record_id))
+        if len(self._pending) >= self.converter.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Send collected results as a batch even if it is not full"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self._batch_number += 1
+        self._in_flight.acquire()
+        self._futures.append(self._executor.submit(self._process_batch, self._batch_number, batch))
+
+    def _process_batch(self, batch_number: int, batch: List[Tuple[str, Any, str]]) -> None:
+        try:
+            file_batch = []
+            keys = []
+            failed_files = 0
+            for record_id, result, key in batch:
+                try:
+                    file_info = self.converter.prepare_result(record_id, result, self.return_folder)
+                except Exception as e:
+                    logger.error(f"Error preparing result of record {record_id}: {e}")
+                    file_info = None
+                if file_info:
+                    file_batch.append(file_info)
+                    keys.append(key)
+                else:
+                    failed_files += 1
+
+            success = False
+            attempt = 0
+            while file_batch and attempt < self.attempts and not success:
+                if attempt:
+                    time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                attempt += 1
+                try:
+                    success = self.converter.upload_batch(file_batch, self.result_upload_url, self.package_id)
+                except Exception as e:
+                    logger.error(f"Error uploading batch {batch_number}: {e}")
+
+            report = UploadBatchReport(batch_number=batch_number, files=len(file_batch), failed_files=failed_files,
+                                       uploaded=success, success=success and not failed_files, attempts=attempt)
+            if report.uploaded:
+                logger.info(f"Uploaded batch {batch_number} ({report.files} files, {report.attempts} attempts)")
+                if self.on_uploaded and keys:
+                    try:
+                        self.on_uploaded(keys)
+                    except Exception as e:
+                        # The files are on the platform, but a resumed job would not know it
+                        logger.error(f"Error recording upload of batch {batch_number}: {e}")
+                        report.success = False
+            elif file_batch:
+                logger.error(f"Failed to upload batch {batch_number} ({report.files} files) after {report.attempts} attempts")
+            if failed_files:
+                logger.error(f"{failed_files} results of batch {batch_number} could not be prepared for upload")
+            with self._reports_lock:
+                self.reports.append(report)
+        finally:
+            self._in_flight.release()
+
+    @property
+    def uploaded_files(self) -> int:
+        with self._reports_lock:
+            return sum(report.files for report in self.reports if report.uploaded)
+
+    def close(self) -> bool:
+        """
+        Upload the remaining results and wait for all batches
+
+        Returns:
+            bool: True if every batch was uploaded
+        """
+        self.flush()
+        errors = 0
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Error in upload batch: {e}")
+                errors += 1
+        self._executor.shutdown(wait=True)
+
+        failed = [report.batch_number for report in self.reports if not report.success]
+        logger.info(f"Uploaded {self.uploaded_files} files in {len(self.reports)} batches, failed batches: {failed}")
+        return not failed and not errors
@@ -1,10 +1,9 @@
 import os
 import logging
 import json
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Optional
 
-from common.results_to_platform_converter.base import BaseResultsToPlatformConverter, RESULTS_JSON, MAPPING_FILE
-from ML_server.config import Config
+from common.results_to_platform_converter.base import BaseResultsToPlatformConverter, IncrementalResultUploader, RESULTS_JSON, RESULTS_JSONL, MAPPING_FILE
 from common.results_to_platform_converter.base import (
     load_mapping_file,
     load_json_file,
@@ -13,6 +12,8 @@ from common.results_to_platform_converter.base import (
     close_opened_files,
     create_filename_to_record_map
 )
+from quantitave_analysis.utils.jsonl import iter_jsonl
+from ML_server.checkpoint import checkpoint_key
 
 logger = logging.getLogger(__name__)
 
@@ -29,22 +30,24 @@ class DetectionResultsToPlatformConverter(BaseResultsToPlatformConverter):
         """
         self.batch_size = batch_size
 
-    def _process_detection_results(self, output_data: Dict, filename_to_record: Dict[str, str],
-                                   return_folder: str) -> List[Tuple[str, str, str]]:
+    def _process_detection_results(self, output_data: Iterable[Tuple[str, List]], filename_to_record: Dict[str, str],
+                                   uploader: IncrementalResultUploader,
+                                   is_uploaded: Optional[Callable[[str], bool]] = None) -> int:
         """
-        Process detection results and create file info for upload
+        Pass detection results of every image to the uploader
 
         Args:
-            output_data: Detection results data
+            output_data: (image_name, detections) pairs
             filename_to_record: Mapping from filename to record ID
-            return_folder: Directory to save temporary files
+            uploader: Uploader that saves and uploads the results
+            is_uploaded: Called with the upload journal key of an image, True if it is already uploaded
 
         Returns:
-            List of tuples (record_id, json_filename, temp_json_path)
+            Number of results passed to the uploader
         """
-        file_info = []
+        added = 0
 
-        for image_name, detections in output_data.items():
+        for image_name, detections in output_data:
             try:
                 base_image_name = image_name.split('_bbox')[0] + '.png'
 
@@ -53,27 +56,66 @@ class DetectionResultsToPlatformConverter(BaseResultsToPlatformConverter):
                     continue
 
                 record_id = filename_to_record[base_image_name]
-
-                # Create individual JSON for this detection
-                individual_json = {
-                    image_name.split('_bbox')[0]: detections
-                }
-
-                json_filename = f"{image_name.split('_bbox')[0]}_bbox.json"
-                temp_json_path = os.path.join(return_folder, json_filename)
-
-                # Save temporary JSON file
-                if not save_json_file(individual_json, temp_json_path):
-                    logger.error(f"Failed to save detection JSON for {image_name}")
+                key = checkpoint_key(record_id, base_image_name)
+                if is_uploaded and is_uploaded(key):
                     continue
 
-                file_info.append((record_id, json_filename, temp_json_path))
+                uploader.add(record_id, {image_name: detections}, key=key)
+                added += 1
 
             except Exception as e:
                 logger.error(f"Error processing detection result for {image_name}: {e}")
                 continue
 
-        return file_info
+        return added
+
+    def _save_detection_json(self, record_id: str, image_name: str, detections: List,
+                             return_folder: str) -> Optional[Tuple[str, str, str]]:
+        """
+        Save the detections of one image to an individual JSON file
+
+        Args:
+            record_id: Record ID of the image
+            image_name: Image name as it appears in the results
+            detections: Detections of the image
+            return_folder: Directory to save temporary files
+
+        Returns:
+            Tuple (record_id, json_filename, temp_json_path) or None if saving failed
+        """
+        # Create individual JSON for this detection
+        individual_json = {
+            image_name.split('_bbox')[0]: detections
+        }
+
+        json_filename = f"{image_name.split('_bbox')[0]}_bbox.json"
+        temp_json_path = os.path.join(return_folder, json_filename)
+
+        # Save temporary JSON file
+        if not save_json_file(individual_json, temp_json_path):
+            logger.error(f"Failed to save detection JSON for {image_name}")
+            return None
+
+        return record_id, json_filename, temp_json_path
+
+    def prepare_result(self, record_id: str, result: Dict, return_folder: str) -> Optional[Tuple[str, str, str]]:
+        """
+        Save the detections of one image for upload
+
+        Args:
+            record_id: Record ID of the image
+            result: Detections of the image keyed by the image name
+            return_folder: Directory to save temporary files
+
+        Returns:
+            Tuple (record_id, json_filename, temp_json_path) or None if saving failed
+        """
+        for image_name, detections in result.items():
+            return self._save_detection_json(record_id, image_name, detections, return_folder)
+        return None
+
+    def upload_batch(self, file_batch: List[Tuple[str, str, str]], result_upload_url: str, package_id: int) -> bool:
+        return self._upload_file_batch(file_batch, result_upload_url, "Detection", package_id)
 
     def _upload_file_batch(self, file_batch: List[Tuple[str, str, str]],
                           result_upload_url: str, task_mode: str, package_id: int) -> bool:
@@ -117,8 +159,7 @@ class DetectionResultsToPlatformConverter(BaseResultsToPlatformConverter):
                 files,
                 result_upload_url,
                 task_mode,
-                package_id,
-                Config().authorization()
+                package_id
             )
 
             if not upload_success:
@@ -136,59 +177,34 @@ class DetectionResultsToPlatformConverter(BaseResultsToPlatformConverter):
             # Always close opened files
             close_opened_files(opened_files)
 
-    def _upload_files_in_batches(self, file_info: List[Tuple[str, str, str]],
-                                 result_upload_url: str, task_mode: str, package_id: int) -> bool:
-        """
-        Upload files in batches
-
-        Args:
-            file_info: List of tuples (record_id, json_filename, temp_json_path)
-            result_upload_url: URL to upload the results
-            task_mode: Task mode identifier
-            package_id: Package ID
-
-        Returns:
-            bool: True if all uploads were successful, False otherwise
+    def _iter_detection_results(self, return_folder: str) -> Optional[Iterator[Tuple[str, List]]]:
         """
-        total_files = len(file_info)
-        logger.info(f"Starting batch upload of {total_files} files in batches of {self.batch_size}")
+        Read detection results one image at a time
 
-        # Process files in batches
-        for i in range(0, total_files, self.batch_size):
-            batch_end = min(i + self.batch_size, total_files)
-            file_batch = file_info[i:batch_end]
-
-            batch_num = (i // self.batch_size) + 1
-            total_batches = (total_files + self.batch_size - 1) // self.batch_size
-
-            logger.info(f"Processing batch {batch_num}/{total_batches} ({len(file_batch)} files)")
-
-            if not self._upload_file_batch(file_batch, result_upload_url, task_mode, package_id):
-                logger.error(f"Failed to upload batch {batch_num}")
-                return False
-
-        logger.info(f"Successfully completed batch upload of all {total_files} files")
-        return True
-
-    def _load_detection_results(self, return_folder: str) -> Optional[Dict]:
-        """
-        Load detection results from JSON file
+        Results are streamed from output.jsonl, output.json written by older models is
+        loaded as a whole.
 
         Args:
             return_folder: Directory containing results
 
         Returns:
-            Detection results data or None if not found/invalid
+            Iterator of (image_name, detections) or None if no results were found
         """
-        json_path = os.path.join(return_folder, RESULTS_JSON)
+        jsonl_path = os.path.join(return_folder, RESULTS_JSONL)
+        if os.path.exists(jsonl_path):
+            return (item for line in iter_jsonl(jsonl_path) for item in line.items())
 
+        json_path = os.path.join(return_folder, RESULTS_JSON)
         if not os.path.exists(json_path):
-            logger.warning(f"Results JSON file not found: {json_path}")
+            logger.warning(f"Results file not found: {jsonl_path}")
             return None
 
-        return load_json_file(json_path)
+        output_data = load_json_file(json_path)
+        return iter(output_data.items()) if output_data is not None else None
 
-    def run(self, return_folder: str, upload_folder: str, result_upload_url: str, package_id: int) -> bool:
+    def run(self, return_folder: str, upload_folder: str, result_upload_url: str, package_id: int,
+            is_uploaded: Optional[Callable[[str], bool]] = None,
+            on_uploaded: Optional[Callable[[List[str]], None]] = None) -> bool:
         """
         Process and upload detection results
 
@@ -197,6 +213,8 @@ class DetectionResultsToPlatformConverter(BaseResultsToPlatformConverter):
             upload_folder: Directory containing the input data
             result_upload_url: URL to upload the results
             package_id: Package ID
+            is_uploaded: Called with the upload journal key of an image, True if its result is already uploaded
+            on_uploaded: Called with the journal keys of every uploaded batch
 
         Returns:
             bool: True if processing was successful, False otherwise
@@ -215,34 +233,24 @@ class DetectionResultsToPlatformConverter(BaseResultsToPlatformConverter):
             logger.error("Failed to create filename to record mapping")
             return False
 
-        # Load detection results
-        output_data = self._load_detection_results(return_folder)
+        # Read detection results
+        output_data = self._iter_detection_results(return_folder)
         if output_data is None:
             logger.error("Failed to load detection results")
             return False
 
-        # Process detection results
-        file_info = self._process_detection_results(
-            output_data, filename_to_record, return_folder
-        )
+        # Process detection results and upload them in parallel batches
+        uploader = IncrementalResultUploader(self, result_upload_url, package_id, return_folder, on_uploaded=on_uploaded)
+        added = self._process_detection_results(output_data, filename_to_record, uploader, is_uploaded)
+        upload_success = uploader.close()
 
-        if not file_info:
+        if not added:
             logger.warning("No files to upload")
             return True
 
-        # Upload files to platform
-        task_mode = "Detection"  # Extract from task package in real implementation
-
-        upload_success = self._upload_files_in_batches(
-            file_info,
-            result_upload_url,
-            task_mode,
-            package_id
-        )
-
         if not upload_success:
             logger.error("Failed to upload detection results")
             return False
 
-        logger.info(f"Successfully uploaded {len(file_info)} detection result files")
+        logger.info(f"Successfully uploaded {uploader.uploaded_files} detection result files")
         return True
\ No newline at end of file
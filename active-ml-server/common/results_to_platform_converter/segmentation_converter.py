@@ -1,9 +1,9 @@
 import os
 import logging
-from typing import Dict, List, Tuple
+from typing import Callable, List, Optional, Tuple
 
-from common.results_to_platform_converter.base import BaseResultsToPlatformConverter, MAPPING_FILE
-from ML_server.config import Config
+from common.results_to_platform_converter.base import BaseResultsToPlatformConverter, IncrementalResultUploader, MAPPING_FILE
+from ML_server.checkpoint import checkpoint_key
 from common.results_to_platform_converter.base import (
     load_mapping_file,
     convert_png_to_webp,
@@ -26,51 +26,57 @@ class SegmentationResultsToPlatformConverter(BaseResultsToPlatformConverter):
         """
         self.batch_size = batch_size
 
-    def _process_segmentation_masks(self, record_files_map: Dict[str, List[str]],
-                                    return_folder: str) -> List[Tuple[str, str, str]]:
+    def _convert_mask(self, record_id: str, base_filename: str, return_folder: str) -> Optional[Tuple[str, str, str]]:
         """
-        Process segmentation masks and prepare file info for upload
+        Convert the PNG mask of one image to WebP
 
         Args:
-            record_files_map: Mapping from record ID to list of filenames
+            record_id: Record ID of the image
+            base_filename: Image filename without extension
             return_folder: Directory containing result files
 
         Returns:
-            List of tuples (record_id, webp_filename, webp_mask_path)
+            Tuple (record_id, webp_filename, webp_mask_path) or None if conversion failed
         """
-        file_info = []
+        png_mask_path = os.path.join(return_folder, base_filename + '_mask.png')
+        webp_mask_path = os.path.join(return_folder, base_filename + '_mask.webp')
 
-        for record_id, filenames in record_files_map.items():
-            for filename in filenames:
-                try:
-                    base_filename = os.path.splitext(filename)[0]
-                    png_mask_path = os.path.join(return_folder, base_filename + '_mask.png')
-                    webp_mask_path = os.path.join(return_folder, base_filename + '_mask.webp')
+        # Check if PNG mask exists
+        if not os.path.exists(png_mask_path):
+            logger.warning(f"PNG mask not found: {png_mask_path}")
+            return None
 
-                    # Check if PNG mask exists
-                    if not os.path.exists(png_mask_path):
-                        logger.warning(f"PNG mask not found: {png_mask_path}")
-                        continue
+        # Convert PNG to WebP
+        if not convert_png_to_webp(png_mask_path, webp_mask_path, quality=90):
+            logger.error(f"Failed to convert PNG to WebP for {base_filename}")
+            return None
 
-                    # Convert PNG to WebP
-                    if not convert_png_to_webp(png_mask_path, webp_mask_path, quality=90):
-                        logger.error(f"Failed to convert PNG to WebP for {base_filename}")
-                        continue
+        # Remove original PNG file after successful conversion
+        try:
+            os.remove(png_mask_path)
+        except OSError as e:
+            logger.warning(f"Could not remove PNG file {png_mask_path}: {e}")
 
-                    # Remove original PNG file after successful conversion
-                    try:
-                        os.remove(png_mask_path)
-                    except OSError as e:
-                        logger.warning(f"Could not remove PNG file {png_mask_path}: {e}")
+        webp_filename = base_filename + '_mask.webp'
+        return record_id, webp_filename, webp_mask_path
 
-                    webp_filename = base_filename + '_mask.webp'
-                    file_info.append((record_id, webp_filename, webp_mask_path))
+    def prepare_result(self, record_id: str, result: str, return_folder: str) -> Optional[Tuple[str, str, str]]:
+        """
+        Convert the predicted mask of one image to WebP
 
-                except Exception as e:
-                    logger.error(f"Error processing mask for {filename} in record {record_id}: {e}")
-                    continue
+        Args:
+            record_id: Record ID of the image
+            result: Path to the predicted PNG mask
+            return_folder: Directory containing result files
 
-        return file_info
+        Returns:
+            Tuple (record_id, webp_filename, webp_mask_path) or None if conversion failed
+        """
+        base_filename = os.path.basename(result)[:-len('_mask.png')]
+        return self._convert_mask(record_id, base_filename, return_folder)
+
+    def upload_batch(self, file_batch: List[Tuple[str, str, str]], result_upload_url: str, package_id: int) -> bool:
+        return self._upload_file_batch(file_batch, result_upload_url, "Segmentation", package_id)
 
     def _upload_file_batch(self, file_batch: List[Tuple[str, str, str]],
                           result_upload_url: str, task_mode: str, package_id: int) -> bool:
@@ -114,8 +120,7 @@ class SegmentationResultsToPlatformConverter(BaseResultsToPlatformConverter):
                 files,
                 result_upload_url,
                 task_mode,
-                package_id,
-                Config().authorization()
+                package_id
             )
 
             if not upload_success:
@@ -133,41 +138,9 @@ class SegmentationResultsToPlatformConverter(BaseResultsToPlatformConverter):
             # Always close opened files
             close_opened_files(opened_files)
 
-    def _upload_files_in_batches(self, file_info: List[Tuple[str, str, str]],
-                                 result_upload_url: str, task_mode: str, package_id: int) -> bool:
-        """
-        Upload files in batches
-
-        Args:
-            file_info: List of tuples (record_id, webp_filename, webp_mask_path)
-            result_upload_url: URL to upload the results
-            task_mode: Task mode identifier
-            package_id: Package ID
-
-        Returns:
-            bool: True if all uploads were successful, False otherwise
-        """
-        total_files = len(file_info)
-        logger.info(f"Starting batch upload of {total_files} segmentation files in batches of {self.batch_size}")
-
-        # Process files in batches
-        for i in range(0, total_files, self.batch_size):
-            batch_end = min(i + self.batch_size, total_files)
-            file_batch = file_info[i:batch_end]
-
-            batch_num = (i // self.batch_size) + 1
-            total_batches = (total_files + self.batch_size - 1) // self.batch_size
-
-            logger.info(f"Processing batch {batch_num}/{total_batches} ({len(file_batch)} segmentation files)")
-
-            if not self._upload_file_batch(file_batch, result_upload_url, task_mode, package_id):
-                logger.error(f"Failed to upload batch {batch_num}")
-                return False
-
-        logger.info(f"Successfully completed batch upload of all {total_files} segmentation files")
-        return True
-
-    def run(self, return_folder: str, upload_folder: str, result_upload_url: str, package_id: int) -> bool:
+    def run(self, return_folder: str, upload_folder: str, result_upload_url: str, package_id: int,
+            is_uploaded: Optional[Callable[[str], bool]] = None,
+            on_uploaded: Optional[Callable[[List[str]], None]] = None) -> bool:
         """
         Process and upload segmentation results
 
@@ -176,6 +149,8 @@ class SegmentationResultsToPlatformConverter(BaseResultsToPlatformConverter):
             upload_folder: Directory containing the input data
             result_upload_url: URL to upload the results
             package_id: Package ID
+            is_uploaded: Called with the upload journal key of an image, True if its result is already uploaded
+            on_uploaded: Called with the journal keys of every uploaded batch
 
         Returns:
             bool: True if processing was successful, False otherwise
@@ -198,26 +173,28 @@ class SegmentationResultsToPlatformConverter(BaseResultsToPlatformConverter):
             logger.error(f"Error validating mapping structure: {e}")
             return False
 
-        # Process segmentation masks to get file info
-        file_info = self._process_segmentation_masks(record_files_map, return_folder)
+        # Masks are converted to WebP and uploaded in parallel batches
+        uploader = IncrementalResultUploader(self, result_upload_url, package_id, return_folder, on_uploaded=on_uploaded)
+        skipped = 0
+        for record_id, filenames in record_files_map.items():
+            for filename in filenames:
+                key = checkpoint_key(record_id, filename)
+                if is_uploaded and is_uploaded(key):
+                    skipped += 1
+                    continue
+                base_filename = os.path.splitext(filename)[0]
+                uploader.add(record_id, os.path.join(return_folder, base_filename + '_mask.png'), key=key)
+        upload_success = uploader.close()
 
-        if not file_info:
+        if skipped:
+            logger.info(f"{skipped} segmentation masks were uploaded by an earlier run")
+        if not skipped and not any(report.files for report in uploader.reports):
             logger.warning("No segmentation masks were processed successfully")
             return False
 
-        # Upload files in batches
-        task_mode = "Segmentation"  # Extract from task package in real implementation
-
-        upload_success = self._upload_files_in_batches(
-            file_info,
-            result_upload_url,
-            task_mode,
-            package_id
-        )
-
         if not upload_success:
             logger.error("Failed to upload segmentation results")
             return False
 
-        logger.info(f"Successfully uploaded {len(file_info)} segmentation result files")
+        logger.info(f"Successfully uploaded {uploader.uploaded_files} segmentation result files")
         return True
@@ -12,6 +12,14 @@ def clear_cuda_memory() -> None:
         torch.cuda.synchronize()
         logger.info("CUDA memory cache cleared")
 
+def log_gpu_memory() -> None:
+    """Log the memory of the GPU, called once at server start instead of on import of the models"""
+    if not torch.cuda.is_available():
+        logger.info("CUDA is not available, models run on CPU")
+        return
+    logger.info(f"Available GPU memory: {torch.cuda.get_device_properties(0).total_memory / 1024 ** 3:.2f}GB")
+    logger.info(f"Currently allocated: {torch.cuda.memory_allocated(0) / 1024 ** 3:.2f}GB")
+
 def clear_python_objects(*objs: object) -> None:
     for obj in objs:
         if obj is None:
@@ -0,0 +1,12 @@
+import os
+import shutil
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    """Hard-link the file, copy it when linking is not possible (other file system)"""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
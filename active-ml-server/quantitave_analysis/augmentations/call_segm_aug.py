@@ -15,7 +15,8 @@ MASK_POSTFIX = Config().MASK_POSTFIX
 SEG_IMAGES_AFTER_AUG = Config().SEG_IMAGES_AFTER_AUG
 SEG_MASKS_AFTER_AUG = Config().SEG_MASKS_AFTER_AUG
 
-def process_all_samples(processor, data_table, input_path):
+def process_all_samples(processor, input_path):
+    rows = []
     files = sorted(os.listdir(input_path))
     image_files = [f for f in files if f.endswith(SUPPORTED_IMAGE_TYPES) and MASK_POSTFIX not in f]
 
@@ -26,22 +27,23 @@ def process_all_samples(processor, data_table, input_path):
 
         if os.path.exists(mask_full_path):
             base_name = filename.split('.')[0]
-            processor.process(
+            rows.extend(processor.process(
                 img_file=img_full_path,
                 mask_file=mask_full_path,
-                base_name=base_name,
-                data_frame=data_table
-            )
+                base_name=base_name
+            ))
+    return rows
 
 def main():
     print("Calling the segmentation augmentations main function...")
 
     processor = SampleProcessor()
     self_columns = ["index", "image", "label"]
-    data_table = pd.DataFrame(columns=self_columns)
     input_path = UPLOAD_FOLDER
 
-    process_all_samples(processor, data_table, input_path)
+    rows = process_all_samples(processor, input_path)
+    data_table = pd.DataFrame.from_records(rows, columns=self_columns[1:])
+    data_table.insert(0, 'index', range(len(data_table)))
 
     print("Finished calling main function.")
     
@@ -1,20 +1,32 @@
+import os
 import random
 import cv2
 import logging
 from typing import List, Dict, Tuple
 import numpy as np
 
+from common.tools.file_routines import link_or_copy
+from quantitave_analysis.augmentations.manifest import IDENTITY
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+SCALE_RANGE = (0.95, 1.05)
+BRIGHTNESS_FACTOR = 1.5
+FLIP_CODES = {"flip_hor": 1, "flip_vert": 0, "flip_both": -1}
+ROTATIONS = {
+    "rotate_90": cv2.ROTATE_90_CLOCKWISE,
+    "rotate_180": cv2.ROTATE_180,
+    "rotate_270": cv2.ROTATE_90_COUNTERCLOCKWISE
+}
+# Augmentations of every training image, in the order they are added to the dataset
+AUGMENTATIONS = [IDENTITY, "scale", *FLIP_CODES, *ROTATIONS, "bright"]
+
+
 class DetectionAugmentationProcessor:
 
     @staticmethod
-    def scale(image: np.ndarray, bboxes: List[Dict], scale_range: Tuple[float, float] = (0.95, 1.05)) -> Tuple[np.ndarray, List[Dict]]:
-        scale_factor = random.uniform(*scale_range)
-        new_width = int(image.shape[1] * scale_factor)
-        new_height = int(image.shape[0] * scale_factor)
-        scaled_image = cv2.resize(image, (new_width, new_height))
-        scaled_bboxes = [
+    def scale_bboxes(bboxes: List[Dict], scale_factor: float) -> List[Dict]:
+        return [
             {
                 **bbox,
                 "bbox_x": int(bbox["bbox_x"] * scale_factor),
@@ -24,13 +36,20 @@ class DetectionAugmentationProcessor:
             }
             for bbox in bboxes
         ]
+
+    @staticmethod
+    def scale(image: np.ndarray, bboxes: List[Dict], scale_range: Tuple[float, float] = SCALE_RANGE,
+              rng: random.Random = random) -> Tuple[np.ndarray, List[Dict]]:
+        scale_factor = rng.uniform(*scale_range)
+        new_width = int(image.shape[1] * scale_factor)
+        new_height = int(image.shape[0] * scale_factor)
+        scaled_image = cv2.resize(image, (new_width, new_height))
+        scaled_bboxes = DetectionAugmentationProcessor.scale_bboxes(bboxes, scale_factor)
         #logging.info(f"Scaled image by factor {scale_factor}. New dimensions: {new_width}x{new_height}")
         return scaled_image, scaled_bboxes
 
     @staticmethod
-    def flip(image: np.ndarray, bboxes: List[Dict], flip_code: int, image_width: int, image_height: int) -> Tuple[np.ndarray, List[Dict]]:
-        flip_types = {0: "vertical", 1: "horizontal", -1: "both"}
-        flipped_image = cv2.flip(image, flip_code)
+    def flip_bboxes(bboxes: List[Dict], flip_code: int, image_width: int, image_height: int) -> List[Dict]:
         flipped_bboxes = []
         for bbox in bboxes:
             new_bbox = {**bbox}
@@ -39,18 +58,18 @@ class DetectionAugmentationProcessor:
             if flip_code in (0, -1):  # Vertical flip
                 new_bbox["bbox_y"] = image_height - bbox["bbox_y"] - bbox["bbox_height"]
             flipped_bboxes.append(new_bbox)
+        return flipped_bboxes
+
+    @staticmethod
+    def flip(image: np.ndarray, bboxes: List[Dict], flip_code: int, image_width: int, image_height: int) -> Tuple[np.ndarray, List[Dict]]:
+        flip_types = {0: "vertical", 1: "horizontal", -1: "both"}
+        flipped_image = cv2.flip(image, flip_code)
+        flipped_bboxes = DetectionAugmentationProcessor.flip_bboxes(bboxes, flip_code, image_width, image_height)
         #logging.info(f"Applied {flip_types[flip_code]} flip to image")
         return flipped_image, flipped_bboxes
 
     @staticmethod
-    def rotate(image: np.ndarray, bboxes: List[Dict], angle: int, image_width: int, image_height: int) -> Tuple[np.ndarray, List[Dict]]:
-        angle_map = {
-            cv2.ROTATE_90_CLOCKWISE: 90,
-            cv2.ROTATE_180: 180,
-            cv2.ROTATE_90_COUNTERCLOCKWISE: 270
-        }
-        rotated_image = cv2.rotate(image, angle)
-        new_width, new_height = (image_height, image_width) if angle in (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE) else (image_width, image_height)
+    def rotate_bboxes(bboxes: List[Dict], angle: int, image_width: int, image_height: int) -> List[Dict]:
         rotated_bboxes = []
         for bbox in bboxes:
             x, y, w, h = bbox["bbox_x"], bbox["bbox_y"], bbox["bbox_width"], bbox["bbox_height"]
@@ -61,19 +80,103 @@ class DetectionAugmentationProcessor:
             elif angle == cv2.ROTATE_90_COUNTERCLOCKWISE:
                 new_bbox = {"bbox_x": image_height - y - h, "bbox_y": x, "bbox_width": h, "bbox_height": w}
             rotated_bboxes.append(new_bbox)
+        return rotated_bboxes
+
+    @staticmethod
+    def rotate(image: np.ndarray, bboxes: List[Dict], angle: int, image_width: int, image_height: int) -> Tuple[np.ndarray, List[Dict]]:
+        angle_map = {
+            cv2.ROTATE_90_CLOCKWISE: 90,
+            cv2.ROTATE_180: 180,
+            cv2.ROTATE_90_COUNTERCLOCKWISE: 270
+        }
+        rotated_image = cv2.rotate(image, angle)
+        rotated_bboxes = DetectionAugmentationProcessor.rotate_bboxes(bboxes, angle, image_width, image_height)
         #logging.info(f"Rotated image by {angle_map[angle]} degrees")
         return rotated_image, rotated_bboxes
 
     @staticmethod
-    def adjust_brightness(image: np.ndarray, bboxes: List[Dict], factor: float = 1.5) -> Tuple[np.ndarray, List[Dict]]:
+    def adjust_brightness(image: np.ndarray, bboxes: List[Dict], factor: float = BRIGHTNESS_FACTOR) -> Tuple[np.ndarray, List[Dict]]:
         bright_image = cv2.convertScaleAbs(image, alpha=factor, beta=0)
         #logging.info(f"Adjusted brightness by factor {factor}")
         return bright_image, bboxes.copy()
 
+    @staticmethod
+    def transform_bboxes(transform: str, seed: int, bboxes: List[Dict], image_width: int,
+                         image_height: int) -> Tuple[List[Dict], int, int]:
+        """
+        Boxes and size of an augmented image, computed without the image
+
+        Args:
+            transform: Name from AUGMENTATIONS
+            seed: Seed of the random parameters of the augmentation
+            bboxes: Boxes of the original image
+            image_width: Width of the original image
+            image_height: Height of the original image
+
+        Returns:
+            Tuple of (boxes, width, height) of the augmented image
+        """
+        if transform == "scale":
+            scale_factor = random.Random(seed).uniform(*SCALE_RANGE)
+            return (DetectionAugmentationProcessor.scale_bboxes(bboxes, scale_factor),
+                    int(image_width * scale_factor), int(image_height * scale_factor))
+        if transform in FLIP_CODES:
+            return (DetectionAugmentationProcessor.flip_bboxes(bboxes, FLIP_CODES[transform], image_width, image_height),
+                    image_width, image_height)
+        if transform in ROTATIONS:
+            angle = ROTATIONS[transform]
+            rotated_bboxes = DetectionAugmentationProcessor.rotate_bboxes(bboxes, angle, image_width, image_height)
+            if angle == cv2.ROTATE_180:
+                return rotated_bboxes, image_width, image_height
+            return rotated_bboxes, image_height, image_width
+        return list(bboxes), image_width, image_height
+
+    @staticmethod
+    def transform_image(image: np.ndarray, transform: str, seed: int) -> np.ndarray:
+        """Augmented image, the counterpart of transform_bboxes"""
+        if transform == "scale":
+            return DetectionAugmentationProcessor.scale(image, [], rng=random.Random(seed))[0]
+        if transform in FLIP_CODES:
+            return cv2.flip(image, FLIP_CODES[transform])
+        if transform in ROTATIONS:
+            return cv2.rotate(image, ROTATIONS[transform])
+        if transform == "bright":
+            return DetectionAugmentationProcessor.adjust_brightness(image, [])[0]
+        return image
+
     @staticmethod
     def fix_bbox(bbox: Dict, image_width: int, image_height: int) -> List[int]:
         x = max(0, min(bbox["bbox_x"], image_width - 1))
         y = max(0, min(bbox["bbox_y"], image_height - 1))
         w = max(1, min(bbox["bbox_width"], image_width - x))
         h = max(1, min(bbox["bbox_height"], image_height - y))
-        return [x, y, w, h]
\ No newline at end of file
+        return [x, y, w, h]
+
+def materialize_image(image_entry: Dict, image_dir: str) -> Tuple[Dict, List[str]]:
+    """
+    Write the augmented image of a COCO image entry with 'source', 'transform' and 'seed'
+
+    Args:
+        image_entry: COCO image entry
+        image_dir: Folder of the dataset images
+
+    Returns:
+        Tuple of (the entry, the files written)
+    """
+    source = image_entry.get("source")
+    target = os.path.join(image_dir, os.path.basename(image_entry["file_name"]))
+    if not source or os.path.exists(target):
+        return image_entry, []
+
+    transform = image_entry.get("transform", IDENTITY)
+    if transform == IDENTITY:
+        # Originals are hard links, they cost no space and are kept
+        link_or_copy(source, target)
+        return image_entry, []
+
+    image = cv2.imread(source)
+    if image is None:
+        logging.warning(f"Source image {source} not found!")
+        return image_entry, []
+    cv2.imwrite(target, DetectionAugmentationProcessor.transform_image(image, transform, image_entry.get("seed", 0)))
+    return image_entry, [target]
@@ -0,0 +1,109 @@
+import os
+import zlib
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from quantitave_analysis.models.config import Config
+
+IDENTITY = 'original'  # Transform of a sample used as it is
+TRANSFORM_SEPARATOR = '|'  # Separates the steps of a composed transform, e.g. 'flip_x|rotate_90'
+TRANSFORM_COLUMN = 'transform'
+SEED_COLUMN = 'seed'
+AUGMENTATION_WORKERS = Config().AUGMENTATION_WORKERS
+
+
+def compose_transform(transform: str, step: str) -> str:
+    """Transform followed by one more step"""
+    return step if transform == IDENTITY else f"{transform}{TRANSFORM_SEPARATOR}{step}"
+
+
+def transform_steps(transform: str) -> List[str]:
+    """Steps of a composed transform in the order they are applied"""
+    return [] if not transform or transform == IDENTITY else transform.split(TRANSFORM_SEPARATOR)
+
+
+def transform_seed(source: str, transform: str) -> int:
+    """
+    Seed of the random parameters of an augmented sample
+
+    The seed depends only on the file name of the source and the transform, so a sample is
+    materialised the same way in every process and on every run.
+    """
+    return zlib.crc32(f"{os.path.basename(source)}:{transform}".encode('utf-8'))
+
+
+def augmented_name(source: str, transform: str, extension: str = '.png') -> str:
+    """File name of a materialised sample"""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    if transform == IDENTITY:
+        return f"{stem}{extension}"
+    return f"{stem}_{transform.replace(TRANSFORM_SEPARATOR, '_')}{extension}"
+
+
+def augmentation_pool(workers: int = AUGMENTATION_WORKERS) -> Optional[ProcessPoolExecutor]:
+    """
+    Process pool materialising augmented samples, None for a single worker
+
+    The pool is spawned, so the workers import only the augmentation modules and not
+    the CUDA state of the training process. The caller shuts it down.
+    """
+    if workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+class MaterializationCache:
+    """
+    Augmented samples written to disk for one training stage.
+
+    A training set is stored as a manifest: every row names its source files and the
+    transform to apply. Only the samples of the current stage are written, and they are
+    removed again when the stage is done, so the disk use stays close to the raw data.
+    With an executor the samples are augmented in its worker processes, the write function
+    must then be picklable (a module-level function or a functools.partial of one).
+    """
+
+    def __init__(self, executor: Optional[Executor] = None):
+        self.executor = executor
+        self._paths: List[str] = []
+
+    def __enter__(self) -> "MaterializationCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.evict()
+
+    def materialize(self, items: Iterable[Any], write: Callable[[Any], Tuple[Any, List[str]]]) -> List[Any]:
+        """
+        Write the samples of the stage
+
+        Args:
+            items: Manifest entries of the samples
+            write: Writes one sample, returns its entry for training and the files it created
+
+        Returns:
+            Entries for training in the order of the items
+        """
+        items = list(items)
+        if self.executor is None or len(items) < 2:
+            results = map(write, items)
+        else:
+            results = self.executor.map(write, items)
+        materialized = []
+        for entry, created in results:
+            self._paths.extend(created)
+            materialized.append(entry)
+        return materialized
+
+    def evict(self) -> None:
+        """Remove the files written for the stage"""
+        for path in self._paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"Failed to remove materialised sample {path}: {e}")
+        self._paths = []
@@ -1,7 +1,6 @@
 import numpy as np
-import pandas as pd
 import logging
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 from PIL import Image
 import os
 
@@ -9,167 +8,227 @@ from quantitave_analysis.utils.image_processing import SegmentataionMaskSaver
 from quantitave_analysis.utils.file_converter import ConvertorRgb2Palette
 from quantitave_analysis.utils.image_processing import LabelPropertiesLoader
 from quantitave_analysis.models.config import Config
+from quantitave_analysis.augmentations.manifest import (
+    IDENTITY,
+    SEED_COLUMN,
+    TRANSFORM_COLUMN,
+    augmented_name,
+    compose_transform,
+    transform_seed,
+    transform_steps
+)
 
 MIN_INTENSITY_THRESHOLD = Config().MIN_INTENSITY_THRESHOLD
+UPLOAD_FOLDER = Config().UPLOAD_FOLDER
+PROCESSED_FOLDER = Config().PROCESSED_FOLDER
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+FLIP_AXES = {'flip_x': (1,), 'flip_y': (0,), 'flip_xy': (1, 0)}  # Horizontal, vertical and both flips
+SCALES = [0.5, 1.5]  # Example scales
+ANGLES = [90, 180, 270]  # Example angles
+
+
 class ImageAugmenter:
+    def transforms(self, do_flip: bool = True, do_scale: bool = False, do_rotate: bool = False) -> List[str]:
+        """
+        Names of the augmentations of a sample, in the order augment() returns them
+
+        Scaling is applied to all previous transforms, rotation to all previous ones
+        including the scaled ones. The original sample always comes first.
+        """
+        transforms = [IDENTITY]
+        if do_flip:
+            transforms.extend(FLIP_AXES)
+        if do_scale:
+            transforms.extend([compose_transform(transform, f"scale_{scale}") for transform in transforms for scale in SCALES])
+        if do_rotate:
+            transforms.extend([compose_transform(transform, f"rotate_{angle}") for transform in transforms for angle in ANGLES])
+        return transforms
+
+    def apply(self, image: np.ndarray, mask: np.ndarray, transform: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Apply one named augmentation to an image and its mask
+
+        Args:
+            image: RGB image
+            mask: RGB mask or 2D array of palette indices
+            transform: Name from transforms()
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: augmented image and mask
+        """
+        for step in transform_steps(transform):
+            if step in FLIP_AXES:
+                for axis in FLIP_AXES[step]:
+                    image = np.flip(image, axis=axis)
+                    mask = np.flip(mask, axis=axis)
+            elif step.startswith('scale_'):
+                # PIL resize for better quality
+                scale = float(step[len('scale_'):])
+                h, w = image.shape[:2]
+                new_size = (int(w * scale), int(h * scale))
+                image = np.array(Image.fromarray(np.ascontiguousarray(image)).resize(new_size, Image.BILINEAR))
+                mask = np.array(Image.fromarray(np.ascontiguousarray(mask)).resize(new_size, Image.NEAREST))
+            elif step.startswith('rotate_'):
+                angle = int(step[len('rotate_'):])
+                image = np.array(Image.fromarray(np.ascontiguousarray(image)).rotate(angle, Image.BILINEAR, expand=False))
+                mask = np.array(Image.fromarray(np.ascontiguousarray(mask)).rotate(angle, Image.NEAREST, expand=False))
+            else:
+                raise ValueError(f"Unknown augmentation step: {step}")
+        return image, mask
+
     def augment(self, image: np.ndarray, mask: np.ndarray,
                 do_flip: bool = True, do_scale: bool = False, do_rotate: bool = False) -> Tuple[
         List[np.ndarray], List[np.ndarray]]:
         """Single interface for all augmentations."""
+        logging.debug("Starting augmentation process")
         augmented_images = []
         augmented_masks = []
-        logging.debug("Starting augmentation process")
-
-        # Base case: always include the original image unless all augmentations are off
-        if not (do_flip or do_scale or do_rotate):
-            augmented_images.append(image)
-            augmented_masks.append(mask)
-            return augmented_images, augmented_masks
-
-        # Flipping
-        if do_flip:
-            logging.debug("Applying flip augmentations")
-            # Horizontal flip
-            flip_x = np.flip(image, axis=1)
-            # Vertical flip
-            flip_y = np.flip(image, axis=0)
-            # Both horizontal and vertical flip
-            flip_xy = np.flip(np.flip(image, axis=1), axis=0)
-
-            # Same for masks
-            mask_x = np.flip(mask, axis=1)
-            mask_y = np.flip(mask, axis=0)
-            mask_xy = np.flip(np.flip(mask, axis=1), axis=0)
-
-            flips = [image, flip_x, flip_y, flip_xy]
-            mask_flips = [mask, mask_x, mask_y, mask_xy]
-            augmented_images.extend(flips)
-            augmented_masks.extend(mask_flips)
-        else:
-            augmented_images.append(image)
-            augmented_masks.append(mask)
-
-        # Scaling (applied to all previous images)
-        if do_scale:
-            logging.debug("Applying scale augmentations")
-            scales = [0.5, 1.5]  # Example scales
-            scaled_images = []
-            scaled_masks = []
-            for img, msk in zip(augmented_images[:], augmented_masks[:]):  # Copy to avoid modifying during iteration
-                for scale in scales:
-                    # PIL resize for better quality
-                    h, w = img.shape[:2]
-                    new_h, new_w = int(h * scale), int(w * scale)
-
-                    # Convert numpy to PIL, resize, then back to numpy
-                    pil_img = Image.fromarray(img)
-                    pil_mask = Image.fromarray(msk)
-
-                    scaled_pil_img = pil_img.resize((new_w, new_h), Image.BILINEAR)
-                    scaled_pil_mask = pil_mask.resize((new_w, new_h), Image.NEAREST)
-
-                    scaled_img = np.array(scaled_pil_img)
-                    scaled_mask = np.array(scaled_pil_mask)
-
-                    scaled_images.append(scaled_img)
-                    scaled_masks.append(scaled_mask)
-            augmented_images.extend(scaled_images)
-            augmented_masks.extend(scaled_masks)
-
-        # Rotation (applied to all previous images)
-        if do_rotate:
-            logging.debug("Applying rotation augmentations")
-            angles = [90, 180, 270]  # Example angles
-            rotated_images = []
-            rotated_masks = []
-            for img, msk in zip(augmented_images[:], augmented_masks[:]):  # Copy to avoid modifying during iteration
-                for angle in angles:
-                    # Convert numpy to PIL, rotate, then back to numpy
-                    pil_img = Image.fromarray(img)
-                    pil_mask = Image.fromarray(msk)
-
-                    rotated_pil_img = pil_img.rotate(angle, Image.BILINEAR, expand=False)
-                    rotated_pil_mask = pil_mask.rotate(angle, Image.NEAREST, expand=False)
-
-                    rotated_img = np.array(rotated_pil_img)
-                    rotated_mask = np.array(rotated_pil_mask)
-
-                    rotated_images.append(rotated_img)
-                    rotated_masks.append(rotated_mask)
-            augmented_images.extend(rotated_images)
-            augmented_masks.extend(rotated_masks)
-
+        for transform in self.transforms(do_flip, do_scale, do_rotate):
+            augmented_image, augmented_mask = self.apply(image, mask, transform)
+            augmented_images.append(augmented_image)
+            augmented_masks.append(augmented_mask)
         return augmented_images, augmented_masks
 
 
 class SampleProcessor:
-    def __init__(self):
+    def __init__(self, upload_folder: str = UPLOAD_FOLDER, processed_folder: str = PROCESSED_FOLDER,
+                 label_properties: Optional[dict] = None):
+        self.upload_folder = upload_folder
+        self.processed_folder = processed_folder
         self.augmenter = ImageAugmenter()
-        self.storage = SegmentataionMaskSaver()
+        self.storage = SegmentataionMaskSaver(processed_folder)
+        self.label_properties_path = os.path.join(upload_folder, "label_properties.json")
+        self.label_properties = label_properties
 
-    def process(self, img_file: str, mask_file: str, base_name: str, data_frame: pd.DataFrame) -> None:
+    def load_label_properties(self) -> Optional[dict]:
+        """Label properties of the dataset, read from label_properties.json once"""
+        if self.label_properties is None:
+            self.label_properties = LabelPropertiesLoader.load_label_properties(self.label_properties_path)
+            logging.info(f"Loaded label properties: {self.label_properties}")
+
+            # Check if we have valid label properties
+            if not self.label_properties:
+                logging.warning("No label properties found. Defaulting to single-class segmentation.")
+        return self.label_properties
+
+    def rgb_image(self, img_file: str, base_name: str) -> str:
+        """
+        Path of the sample image in RGB
+
+        Samples used as they are go to training without being materialised, so an RGBA,
+        grayscale or palette upload is converted once into the images folder, like the
+        augmented copies. An RGB upload is used in place.
+        """
+        with Image.open(img_file) as image:
+            if image.mode == 'RGB':
+                return img_file
+            rgb_path = os.path.join(self.storage.images_path, f'{base_name}.png')
+            image.convert('RGB').save(rgb_path, format='PNG')
+        return rgb_path
+
+    def process(self, img_file: str, mask_file: str, base_name: str) -> List[Dict[str, str]]:
+        """
+        Convert the mask of a sample to a palette image and list its augmentations
+
+        Augmented copies are not written here: every row names the source image, the
+        palette mask and the transform, and the copies are materialised while training.
+        The image of the untransformed row is converted to RGB if the upload is not RGB.
+
+        Args:
+            img_file: path to the image
+            mask_file: path to the RGB mask
+            base_name: name of the sample, the palette mask is saved under it
+
+        Returns:
+            List[Dict[str, str]]: manifest rows {'image', 'label', 'transform', 'seed'} of the sample
+        """
         logging.info(f"Processing sample: image={img_file}, mask={mask_file}")
+        rows = []
         try:
-            # Open images with PIL in RGB mode
-            pil_image = Image.open(img_file).convert('RGB')
-            pil_mask = Image.open(mask_file).convert('RGB')
-
-            # Convert PIL images to numpy arrays
-            image = np.array(pil_image)
-            mask = np.array(pil_mask)
-
-            if image is None or mask is None:
-                raise FileNotFoundError(f"Image or mask file not found: {img_file}, {mask_file}")
-            logging.debug("Image and mask loaded successfully")
+            if not os.path.exists(img_file):
+                raise FileNotFoundError(f"Image file not found: {img_file}")
+            mask = np.array(Image.open(mask_file).convert('RGB'))
 
             # Toggle augmentations here (delete/comment lines to disable)
             do_flip = True  # Delete this line to disable flipping
             do_scale = False  # Delete or set True to enable scaling
             do_rotate = False  # Delete or set True to enable rotation
 
-            # Apply augmentations via single interface
-            img_flips, mask_flips = self.augmenter.augment(image, mask, do_flip, do_scale, do_rotate)
-            logging.info(f"Generated {len(img_flips)} augmentations for {base_name}")
+            transforms = self.augmenter.transforms(do_flip, do_scale, do_rotate)
+            logging.info(f"Listed {len(transforms)} augmentations for {base_name}")
 
-            # Load label properties
-            label_properties_path = os.path.join(Config().UPLOAD_FOLDER, "label_properties.json")
-            label_properties = LabelPropertiesLoader.load_label_properties(label_properties_path)
-            logging.info(f"Loaded label properties: {label_properties}")
+            # Creating a mask for the background (black color)
+            # Define pixels with intensity below the threshold as background
+            is_background = np.mean(mask, axis=2) < MIN_INTENSITY_THRESHOLD
 
-            # Check if we have valid label properties
-            if label_properties is None:
-                logging.warning("No label properties found. Defaulting to single-class segmentation.")
+            # Setting the background to black, the original colors of the elements are kept
+            mask[is_background] = [0, 0, 0]
 
-            for idx, (flip_img, flip_mask) in enumerate(zip(img_flips, mask_flips)):
-                logging.debug(f"Processing augmentation {idx} for {base_name}")
+            # Flips, scaling and rotation commute with the per-pixel palette conversion,
+            # so the mask is converted once and its augmentations are taken from the palette image
+            mask_path = os.path.join(self.storage.masks_path, f'{base_name}.png')
+            ConvertorRgb2Palette(label_properties = self.load_label_properties(), output = mask_path, image_array = mask).execute()
+            # ConvertorRgb2Palette(label_properties = {'Standart_label': '#FF0000', 'Second_label': '#14FF00'}, output = mask_path, image_array = mask).execute()
 
-                # Creating a mask for the background (black color)
-                # Define pixels with intensity below the threshold as background
-                is_background = np.mean(flip_mask, axis=2) < MIN_INTENSITY_THRESHOLD
+            rgb_file = self.rgb_image(img_file, base_name)
+            for transform in transforms:
+                rows.append({
+                    'image': rgb_file if transform == IDENTITY else img_file,
+                    'label': mask_path,
+                    TRANSFORM_COLUMN: transform,
+                    SEED_COLUMN: transform_seed(img_file, transform)
+                })
+            logging.debug(f"Added {len(rows)} samples of {base_name}")
 
-                # Making an output image where we keep the original colors of the elements and set the background to black
-                mask_output = flip_mask.copy()
+        except Exception as e:
+            logging.error(f"Error processing sample {img_file} and {mask_file}: {e}")
+        return rows
 
-                # Setting the background to black
-                mask_output[is_background] = [0, 0, 0]
 
-                # Convert numpy arrays to PIL for saving
-                pil_img_to_save = Image.fromarray(flip_img)
-                pil_mask_to_save = Image.fromarray(mask_output)
+def materialize_sample(row: Dict, images_path: str, masks_path: str) -> Tuple[Dict, List[str]]:
+    """
+    Write the augmented image and palette mask of a manifest row
 
-                # Save images using the storage class
-                img_path = self.storage.save_image(np.array(pil_img_to_save), base_name, idx)
-                mask_path = self.storage.save_mask(np.array(pil_mask_to_save), base_name, idx)
+    Args:
+        row: manifest row {'image', 'label', 'transform', 'seed'}
+        images_path: folder for augmented images
+        masks_path: folder for augmented masks
 
-                ConvertorRgb2Palette(label_properties = label_properties, output = mask_path, image_array = mask_output).execute()
-                # ConvertorRgb2Palette(label_properties = {'Standart_label': '#FF0000', 'Second_label': '#14FF00'}, output = mask_path, image_array = mask_output).execute()
+    Returns:
+        Tuple[Dict, List[str]]: the row with the paths of the written files, the written files
+    """
+    transform = row.get(TRANSFORM_COLUMN, IDENTITY)
+    if not isinstance(transform, str) or transform == IDENTITY:
+        return row, []
 
-                row_id = len(data_frame)
-                data_frame.loc[row_id] = {'index': row_id, 'image': img_path, 'label': mask_path}
-                logging.debug(f"Added row {row_id} to DataFrame: {img_path}, {mask_path}")
+    image = np.array(Image.open(row['image']).convert('RGB'))
+    mask_image = Image.open(row['label'])
+    image, mask = ImageAugmenter().apply(image, np.array(mask_image), transform)
 
-        except Exception as e:
-            logging.error(f"Error processing sample {img_file} and {mask_file}: {e}")
+    img_path = os.path.join(images_path, augmented_name(row['image'], transform))
+    mask_path = os.path.join(masks_path, augmented_name(row['label'], transform))
+    Image.fromarray(np.ascontiguousarray(image)).save(img_path, format='PNG')
+    augmented_mask = Image.fromarray(np.ascontiguousarray(mask))
+    palette = mask_image.getpalette()
+    if palette is not None:
+        augmented_mask = augmented_mask.convert('P')
+        augmented_mask.putpalette(palette)
+    augmented_mask.save(mask_path, format='PNG')
+    return dict(row, image=img_path, label=mask_path), [img_path, mask_path]
+
+
+# Sample processor of a dataset preparation worker process
+_worker_processor: Optional[SampleProcessor] = None
+
+
+def init_sample_worker(upload_folder: str, processed_folder: str, label_properties: Optional[dict]) -> None:
+    """Initializer of the dataset preparation processes, the label properties are passed in once"""
+    global _worker_processor
+    _worker_processor = SampleProcessor(upload_folder, processed_folder, label_properties)
+
+
+def process_sample(sample: Tuple[str, str, str]) -> List[Dict[str, str]]:
+    """Process one (image, mask, base_name) sample in a dataset preparation process"""
+    return _worker_processor.process(*sample)
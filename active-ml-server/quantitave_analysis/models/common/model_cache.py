@@ -0,0 +1,143 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from common.tools.clear_routines import clear_memory
+from quantitave_analysis.models.config import Config
+
+logger = logging.getLogger(__name__)
+
+# (dataset_id, model_name, model_directory)
+CacheKey = Tuple[int, str, str]
+
+
+def directory_size(path: str) -> int:
+    """Size of all files in the directory, used as an estimate of the memory a loaded model takes"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                continue
+    return total
+
+
+class ModelCache:
+    """
+    Keeps loaded predictors warm between jobs.
+
+    Predictors are keyed by (dataset_id, model_name, model_directory). Loading a newer
+    version of a model drops the older versions of the same dataset and model, and the
+    least recently used predictors are evicted when the estimated size of the cached
+    models exceeds the memory budget. The size of a model is estimated by the size of its
+    files on disk, not measured in GPU memory, so training clears the cache before it starts.
+    """
+
+    def __init__(self, memory_budget: int = Config().MODEL_CACHE_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self._entries: "OrderedDict[CacheKey, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading_locks: Dict[CacheKey, threading.Lock] = {}
+
+    @property
+    def used_memory(self) -> int:
+        with self._lock:
+            return sum(size for _, size in self._entries.values())
+
+    def get_or_load(self, dataset_id: int, model_name: str, model_directory: str,
+                    loader: Callable[[], Any]) -> Any:
+        """
+        Return the cached predictor or load it with the loader
+
+        Args:
+            dataset_id: Dataset ID
+            model_name: Name of the model
+            model_directory: Directory of the model version
+            loader: Loads the predictor from model_directory
+
+        Returns:
+            Loaded predictor
+        """
+        key = (dataset_id, model_name, os.path.normpath(model_directory))
+        with self._lock:
+            loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        # Jobs asking for the same model wait for one load instead of loading it twice
+        with loading_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    logger.info(f"Using cached {model_name} model of dataset {dataset_id}: {model_directory}")
+                    return self._entries[key][0]
+
+            self.invalidate(dataset_id, model_name, keep_directory=key[2])
+            predictor = loader()
+            self._store(key, predictor)
+            return predictor
+
+    def _store(self, key: CacheKey, predictor: Any) -> None:
+        size = directory_size(key[2])
+        if size > self.memory_budget:
+            logger.warning(f"Model {key[2]} ({size} bytes) exceeds the cache budget and is not cached")
+            return
+
+        evicted = []
+        with self._lock:
+            while self._entries and sum(entry_size for _, entry_size in self._entries.values()) + size > self.memory_budget:
+                evicted.append(self._entries.popitem(last=False))
+                logger.info(f"Evicted model {evicted[-1][0][2]} from cache")
+            self._entries[key] = (predictor, size)
+
+        if evicted:
+            # References are dropped before collecting, so the memory is actually released
+            evicted.clear()
+            clear_memory()
+
+    def invalidate(self, dataset_id: int, model_name: str, keep_directory: Optional[str] = None) -> None:
+        """
+        Drop cached versions of the dataset model
+
+        Args:
+            dataset_id: Dataset ID
+            model_name: Name of the model
+            keep_directory: Version that stays in the cache
+        """
+        if keep_directory:
+            keep_directory = os.path.normpath(keep_directory)
+        evicted = []
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == dataset_id and key[1] == model_name and key[2] != keep_directory:
+                    evicted.append(self._entries.pop(key)[0])
+                    self._loading_locks.pop(key, None)
+                    logger.info(f"Dropped outdated model {key[2]} from cache")
+
+        if evicted:
+            # References are dropped before collecting, so the memory is actually released
+            evicted.clear()
+            clear_memory()
+
+    def clear(self) -> None:
+        """Drop all cached predictors and release the memory they hold"""
+        with self._lock:
+            evicted = [predictor for predictor, _ in self._entries.values()]
+            self._entries.clear()
+            self._loading_locks.clear()
+        evicted.clear()
+        clear_memory()
+
+
+_model_cache: Optional[ModelCache] = None
+_model_cache_lock = threading.Lock()
+
+
+def get_model_cache() -> ModelCache:
+    """Model cache shared by all jobs of the process"""
+    global _model_cache
+    with _model_cache_lock:
+        if _model_cache is None:
+            _model_cache = ModelCache()
+        return _model_cache
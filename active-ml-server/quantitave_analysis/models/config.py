@@ -9,18 +9,28 @@ class Config(BaseModel):
     PROCESSED_FOLDER: str = os.path.join(storage_root, 'data', 'processed')
     MODELS_DIRECTORY: str = os.path.join(storage_root,'data', 'models')
     ALL_MODELS_FOLDER: str = os.path.join(storage_root, 'saved_models')
+    JOBS_FOLDER: str = os.path.join(storage_root, 'data', 'jobs')
+    PACKAGE_WORKSPACES_FOLDER: str = os.path.join(storage_root, 'data', 'jobs', 'packages')
+    IMAGE_CACHE_FOLDER: str = os.path.join(storage_root, 'data', 'image_cache')
+    TRAINING_SETS_FOLDER: str = os.path.join(storage_root, 'data', 'training_sets')
     MIN_INTENSITY_THRESHOLD: int = 5
     SHARED_FOLDER_AFTER_AUG: str = os.path.join('data', 'processed')
     SEG_IMAGES_AFTER_AUG: str = 'all_images'
     SEG_MASKS_AFTER_AUG: str = 'all_masks'
     MASK_POSTFIX: str = '_mask'
+    SEG_DATASET_WORKERS: int = max(1, (os.cpu_count() or 2) // 2)  # Processes augmenting segmentation samples
+    AUGMENTATION_WORKERS: int = max(1, (os.cpu_count() or 2) // 2)  # Processes materialising augmented samples of a training stage
     SPLIT_FRACTIONS: list = [0.9, 0.1]
     CONFIDENCE_THRESHOLD: float = 0.2
     OUTPUT_JSON_NAME: str = 'output.json'
+    OUTPUT_JSONL_NAME: str = 'output.jsonl'  # Detection results, one line {image_name: detections} per image
     SUPPORTED_IMAGE_TYPES: str = ".png"
     IMAGE_TYPES_FROM_FRONT: str = '.webp'
     DEFAULT_CREATE_DATASET_RATIO: float = 0.9
     INTERSECTION_THRESHOLD: float = 0.4
+    NMS_CLASS_AWARE: bool = False  # Overlapping boxes of different classes are both kept
+    MODEL_CACHE_MEMORY_BUDGET: int = 16 * 1024 ** 3  # Loaded models kept between jobs, estimated by their size on disk
+    IMAGE_CACHE_MAX_BYTES: int = 20 * 1024 ** 3  # Disk space of downloaded images, 0 disables the cache
 
     # Optional: Add validation for fields
     class Settings:
@@ -0,0 +1,98 @@
+"""
+Compare the vectorized overlap suppression with the pure-Python loop it replaced.
+
+    python -m quantitave_analysis.models.detection.benchmark_nms --boxes 500 2000 8000
+
+Every run checks that both implementations keep the same boxes in the same order.
+"""
+import time
+import random
+import argparse
+import logging
+
+from quantitave_analysis.models.detection.nms import suppress_overlaps
+from quantitave_analysis.models.detection.results_processor import (
+    INTERSECTION_THRESHOLD,
+    Rectangle,
+    is_touching_or_contained
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def reference_filter(rectangles):
+    """The O(n²) loop of filter_overlapping_rectangles before vectorization"""
+    rectangles = sorted(rectangles, key=lambda r: r.score, reverse=True)
+    keep = []
+    while rectangles:
+        current = rectangles.pop(0)
+        keep.append(current.detection)
+        rectangles = [rect for rect in rectangles if not is_touching_or_contained(current, rect)]
+    return keep
+
+
+def random_rectangles(count: int, image_size: int, box_size: int, seed: int):
+    """Dense cell-like boxes: clusters of jittered boxes with some nested and some duplicated"""
+    rng = random.Random(seed)
+    rectangles = []
+    for index in range(count):
+        if rectangles and rng.random() < 0.3:
+            base = rng.choice(rectangles)
+            x = base.x + rng.uniform(-box_size / 4, box_size / 4)
+            y = base.y + rng.uniform(-box_size / 4, box_size / 4)
+            width = base.width * rng.uniform(0.5, 1.2)
+            height = base.height * rng.uniform(0.5, 1.2)
+        else:
+            x = rng.uniform(0, image_size)
+            y = rng.uniform(0, image_size)
+            width = rng.uniform(box_size / 2, box_size * 1.5)
+            height = rng.uniform(box_size / 2, box_size * 1.5)
+        score = round(rng.random(), 2)  # Rounded, so equal scores are tested as well
+        rectangles.append(Rectangle(x, y, width, height, score, {"index": index}))
+    return rectangles
+
+
+def vectorized_filter(rectangles, grid_min_boxes):
+    keep = suppress_overlaps(
+        [(rect.x, rect.y, rect.width, rect.height) for rect in rectangles],
+        [rect.score for rect in rectangles],
+        INTERSECTION_THRESHOLD,
+        grid_min_boxes=grid_min_boxes
+    )
+    return [rectangles[index].detection for index in keep]
+
+
+def run(counts, image_size: int, box_size: int, seed: int) -> bool:
+    identical = True
+    for count in counts:
+        rectangles = random_rectangles(count, image_size, box_size, seed)
+
+        start = time.perf_counter()
+        expected = reference_filter(rectangles)
+        reference_time = time.perf_counter() - start
+
+        timings = []
+        for name, grid_min_boxes in (("vectorized", None), ("grid", 0)):
+            start = time.perf_counter()
+            kept = vectorized_filter(rectangles, grid_min_boxes)
+            timings.append(f"{name} {time.perf_counter() - start:.4f}s")
+            if kept != expected:
+                identical = False
+                logger.error(f"{count} boxes: {name} kept {len(kept)} boxes, reference kept {len(expected)}")
+
+        logger.info(f"{count} boxes, {len(expected)} kept: reference {reference_time:.4f}s, {', '.join(timings)}")
+    return identical
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--image-size", type=int, default=4000)
+    parser.add_argument("--box-size", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if not run(args.boxes, args.image_size, args.box_size, args.seed):
+        raise SystemExit(1)
+    logger.info("Outputs are identical")
@@ -47,4 +47,5 @@ class DetectionModelConfig(BaseModelConfig):
 
     inference_data_folder: str = UPLOAD_FOLDER
     results_folder: str = RETURN_FOLDER
+    predict_batch_size: int = 32  # Images submitted to the predictor in one COCO manifest
     single_json_per_image: bool = False
@@ -1,15 +1,14 @@
 import os
-import csv
 import json
 import random
-import cv2
 import logging
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
-from quantitave_analysis.utils.file_converter import ConvertorBboxJson2Csv
 from quantitave_analysis.models.config import Config  
-from quantitave_analysis.augmentations.detection_augmentations import DetectionAugmentationProcessor # flip, scale, rotate, adjust_brightness, fix_bbox
+from quantitave_analysis.augmentations.detection_augmentations import AUGMENTATIONS, DetectionAugmentationProcessor # flip, scale, rotate, adjust_brightness, fix_bbox
+from common.tools.file_routines import link_or_copy
+from quantitave_analysis.augmentations.manifest import IDENTITY, transform_seed
 
 PROCESSED_FOLDER = Config().PROCESSED_FOLDER
 UPLOAD_FOLDER = Config().UPLOAD_FOLDER
@@ -35,94 +34,60 @@ class DetectionDatasetPipeline:
             logging.warning("No JSON files found in input directory.")
             return
         logging.info(f"Found {len(json_files)} original JSON files")
+        images_data = {}
         for json_file in json_files:
-            converter = ConvertorBboxJson2Csv(input_path / json_file, input_folder)
-            converter.execute()
-
-        csv_files = [f for f in os.listdir(input_path) if f.endswith('.csv')]
-        if not csv_files:
-            logging.warning("No CSV files found in input directory.")
+            images_data.update(self._read_annotations(input_path / json_file))
+        if not images_data:
+            logging.warning("No annotated images found in JSON files.")
             return
-        images_data = {}
-        for csv_file in csv_files:
-            with (input_path / csv_file).open('r') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    image_name = row["image_name"]
-                    if image_name not in images_data:
-                        images_data[image_name] = {
-                            "bboxes": [],
-                            "label_names": [],
-                            "image_width": int(row["image_width"]),
-                            "image_height": int(row["image_height"])
-                        }
-                    images_data[image_name]["bboxes"].append({
-                        "bbox_x": int(float(row["bbox_x"])),
-                        "bbox_y": int(float(row["bbox_y"])),
-                        "bbox_width": int(float(row["bbox_width"])),
-                        "bbox_height": int(float(row["bbox_height"]))
-                    })
-                    images_data[image_name]["label_names"].append(row["label_name"])
         
         logging.info(f"Found {len(images_data)} original images")
 
+        # Only the boxes of the augmented images are computed here, the images are
+        # materialised from source, transform and seed while training
         all_images_pool = []
         processor = DetectionAugmentationProcessor()
-        augmentation_funcs = {
-            "original": lambda img, bbs, w, h: (img, bbs),
-            "scale": lambda img, bbs, w, h: processor.scale(img, bbs),
-            "flip_hor": lambda img, bbs, w, h: processor.flip(img, bbs, 1, w, h),
-            "flip_vert": lambda img, bbs, w, h: processor.flip(img, bbs, 0, w, h),
-            "flip_both": lambda img, bbs, w, h: processor.flip(img, bbs, -1, w, h),
-            "rotate_90": lambda img, bbs, w, h: processor.rotate(img, bbs, cv2.ROTATE_90_CLOCKWISE, w, h),
-            "rotate_180": lambda img, bbs, w, h: processor.rotate(img, bbs, cv2.ROTATE_180, w, h),
-            "rotate_270": lambda img, bbs, w, h: processor.rotate(img, bbs, cv2.ROTATE_90_COUNTERCLOCKWISE, w, h),
-            "bright": lambda img, bbs, w, h: processor.adjust_brightness(img, bbs)
-        }
 
         for image_name, img_info in images_data.items():
-            image_path = Path(UPLOAD_FOLDER) / (image_name + '.png')
+            image_path = input_path / (image_name + '.png')
             if not image_path.exists():
                 logging.warning(f"Image {image_path.name} not found!")
                 continue
 
-            image = cv2.imread(str(image_path))
             original_bboxes = img_info["bboxes"]
             label_names = img_info["label_names"]
             image_width, image_height = img_info["image_width"], img_info["image_height"]
 
-            for aug_name, aug_func in augmentation_funcs.items():
-                aug_image, aug_bboxes = aug_func(image, original_bboxes, image_width, image_height)
-                aug_filename = f"{aug_name}_{image_path.stem}.png" if aug_name != "original" else image_path.name
-                aug_image_path = images_folder / aug_filename
-                cv2.imwrite(str(aug_image_path), aug_image)
-                #logging.info(f"Saved augmented image: {aug_image_path}")
+            for aug_name in AUGMENTATIONS:
+                seed = transform_seed(image_path.name, aug_name)
+                aug_bboxes, aug_width, aug_height = processor.transform_bboxes(
+                    aug_name, seed, original_bboxes, image_width, image_height
+                )
+                aug_filename = f"{aug_name}_{image_path.stem}.png" if aug_name != IDENTITY else image_path.name
+                if aug_name == IDENTITY:
+                    link_or_copy(str(image_path), str(images_folder / aug_filename))
 
                 all_images_pool.append({
                     "image_name": aug_filename,
-                    "width": aug_image.shape[1],
-                    "height": aug_image.shape[0],
+                    "width": aug_width,
+                    "height": aug_height,
                     "bboxes": aug_bboxes,
-                    "label_names": label_names
+                    "label_names": label_names,
+                    "source": str(image_path.resolve()),
+                    "transform": aug_name,
+                    "seed": seed
                 })
 
         random.shuffle(all_images_pool)
         train_size = int(self.train_ratio * len(all_images_pool))
-        train_pool = all_images_pool[:train_size]
-        test_pool = all_images_pool[train_size:]
 
-        train_json = self._pool_to_coco(train_pool)
-        test_json = self._pool_to_coco(test_pool)
+        # Built once, so train and test share the category IDs
+        train_json, test_json = self._split_coco(self._pool_to_coco(all_images_pool), train_size)
 
-        train_json_string = json.dumps(train_json, indent=4)
-        train_json_string = train_json_string.replace("\n", "")
-        train_json_string = train_json_string.replace(" ", "")
-        
         annotations_folder = output_path / "Annotations"
         annotations_folder.mkdir(parents=True, exist_ok=True) 
 
         with (annotations_folder / "train.json").open('w') as f:
-            #f.write(train_json_string)
             json.dump(train_json, f, indent=4)
         with (annotations_folder / "test.json").open('w') as f:
             json.dump(test_json, f, indent=4)
@@ -130,6 +95,64 @@ class DetectionDatasetPipeline:
         logging.info(f"Dataset completed: {len(train_json['images'])} augmented images in train.json, "
                     f"{len(test_json['images'])} augmented images in test.json")
     
+    @staticmethod
+    def _read_annotations(json_path: Path) -> Dict[str, Dict]:
+        """
+        Boxes of every image of a bbox JSON {image_name: [annotation, ...]}
+
+        Entries that are strings (label_properties.json) and images without boxes are skipped.
+
+        Args:
+            json_path: Path to the JSON file
+
+        Returns:
+            Dict[str, Dict]: image name to its boxes, label names and size
+        """
+        with json_path.open('r') as f:
+            data = json.load(f)
+
+        if not isinstance(data, dict):
+            raise ValueError("Expected JSON data to be a dictionary")
+
+        images_data = {}
+        for image_name, annotations in data.items():
+            if isinstance(annotations, str):
+                continue
+            if not isinstance(annotations, list):
+                raise ValueError(f"Expected annotations for {image_name} to be a list")
+            if not annotations:
+                continue
+
+            for ann in annotations:
+                if not isinstance(ann, dict):
+                    raise ValueError(f"Expected annotation to be a dictionary, got {type(ann)}")
+            images_data[image_name] = {
+                "bboxes": [
+                    {
+                        "bbox_x": int(float(ann["bbox_x"])),
+                        "bbox_y": int(float(ann["bbox_y"])),
+                        "bbox_width": int(float(ann["bbox_width"])),
+                        "bbox_height": int(float(ann["bbox_height"]))
+                    }
+                    for ann in annotations
+                ],
+                "label_names": [str(ann["label_name"]) for ann in annotations],
+                "image_width": int(annotations[0]["image_width"]),
+                "image_height": int(annotations[0]["image_height"])
+            }
+        return images_data
+
+    @staticmethod
+    def _split_coco(coco_data: Dict, train_size: int) -> Tuple[Dict, Dict]:
+        """Split a COCO dict into the first train_size images and the rest, categories are shared"""
+        train_images = coco_data["images"][:train_size]
+        train_ids = {image["id"] for image in train_images}
+        train_json = {"images": train_images, "annotations": [], "categories": coco_data["categories"]}
+        test_json = {"images": coco_data["images"][train_size:], "annotations": [], "categories": coco_data["categories"]}
+        for annotation in coco_data["annotations"]:
+            (train_json if annotation["image_id"] in train_ids else test_json)["annotations"].append(annotation)
+        return train_json, test_json
+
     def _pool_to_coco(self, pool: List[Dict]) -> Dict:
         coco_data = {
             "images": [],
@@ -158,7 +181,9 @@ class DetectionDatasetPipeline:
                 "id": image_id,
                 "file_name": f"images/{item['image_name']}",
                 "width": item["width"],
-                "height": item["height"]
+                "height": item["height"],
+                # Manifest of the augmented image, see materialize_image
+                **{key: item[key] for key in ("source", "transform", "seed") if key in item}
             })
 
             for i, bbox in enumerate(item["bboxes"]):
@@ -5,18 +5,23 @@ import glob
 import random
 import warnings
 import gc
+from functools import partial
 import json
 import logging
+from typing import List
 import torch
 
 from quantitave_analysis.models.config import Config
 from quantitave_analysis.utils.temporary_storage import TemporaryStorageManager, DataHandler
 from common.tools.clear_routines import clear_memory
 from quantitave_analysis.models.common.base_model import ModelHandlerBase
+from quantitave_analysis.models.common.model_cache import get_model_cache
 from quantitave_analysis.models.detection.results_processor import ResultProcessor
 from quantitave_analysis.models.detection.detection_config import DetectionModelConfig
 from quantitave_analysis.models.detection.dino_model_manager import DinoModelManager
 from quantitave_analysis.models.detection.dino_data_processor import DinoDataProcessor
+from quantitave_analysis.augmentations.manifest import MaterializationCache, augmentation_pool
+from quantitave_analysis.augmentations.detection_augmentations import materialize_image
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -27,8 +32,6 @@ logging.basicConfig(
 )
 
 # torch.cuda.set_per_process_memory_fraction(0.8)
-print(f"Available GPU memory: {torch.cuda.get_device_properties(0).total_memory/1024**3:.2f}GB")
-print(f"Currently allocated: {torch.cuda.memory_allocated(0)/1024**3:.2f}GB")
 # At start of your training script
 torch.backends.cudnn.benchmark = True
 torch.backends.cudnn.deterministic = False
@@ -63,9 +66,29 @@ class DinoDetectionModelHandler(ModelHandlerBase):
         )
         self._model_manager = DinoModelManager()
 
+    def configure_folders(self, train_data_folder: str = None, inference_data_folder: str = None,
+                          results_folder: str = None) -> None:
+        """Point the handler and its helpers to the folders of the current job."""
+        folders = {
+            "train_data_folder": train_data_folder,
+            "inference_data_folder": inference_data_folder,
+            "results_folder": results_folder
+        }
+        self.model_handler_config = self.model_handler_config.model_copy(
+            update={name: folder for name, folder in folders.items() if folder}
+        )
+        self._data_processor = DinoDataProcessor(
+            model_handler_config=self.model_handler_config,
+            temp_manager=self.temp_manager,
+            result_processor=self.result_processor
+        )
+        self._model_manager = DinoModelManager(model_handler_config=self.model_handler_config)
+
     def run_train(self, dataset_id: int):
         """Train the detection model using iterative batches of 30 images per stage."""
         logger.info("Training detection model...")
+        # Cached predictors hold GPU memory that training needs
+        get_model_cache().clear()
         clear_memory()
 
         # Paths and configuration
@@ -131,25 +154,32 @@ class DinoDetectionModelHandler(ModelHandlerBase):
             
             predictor, temp_version_path  = self._model_manager.initialize_predictor(models_base_folder)
 
+            # Augmented images of a stage are written by worker processes
+            pool = augmentation_pool()
             try:
                 # Training iterations
                 for stage in range(n_stages):
                     self.check_memory_available(min_gb=4)
 
-                    # Select batch of images for the current stage
-                    selected_images = self._data_processor.select_batch_images(images, batch_size, image_dir, stage, shuffled_images)
+                    with MaterializationCache(pool) as cache:
+                        # The augmented images of the stage exist only while it is trained on
+                        cache.materialize(shuffled_images[stage * batch_size:(stage + 1) * batch_size],
+                                          partial(materialize_image, image_dir=image_dir))
+
+                        # Select batch of images for the current stage
+                        selected_images = self._data_processor.select_batch_images(images, batch_size, image_dir, stage, shuffled_images)
 
-                    # Create batch COCO JSON with corrected paths
-                    batch_json_path = self._data_processor.create_batch_coco_json(selected_images, coco_data, temp_dir, stage, image_dir)
+                        # Create batch COCO JSON with corrected paths
+                        batch_json_path = self._data_processor.create_batch_coco_json(selected_images, coco_data, temp_dir, stage, image_dir)
 
-                    # Train on batch
-                    logger.info(f"Training on batch {stage + 1}...")
+                        # Train on batch
+                        logger.info(f"Training on batch {stage + 1}...")
 
-                    predictor.fit(
-                        train_data=batch_json_path,
-                        # time_limit=self.model_handler_config.hyperparameters["time_limit"],
-                        save_path=temp_version_path,
-                    )
+                        predictor.fit(
+                            train_data=batch_json_path,
+                            # time_limit=self.model_handler_config.hyperparameters["time_limit"],
+                            save_path=temp_version_path,
+                        )
                     logger.info(f"Completed training for batch {stage + 1}")
                     logger.info(f"{n_stages - stage - 1} batches left.")
             
@@ -165,6 +195,9 @@ class DinoDetectionModelHandler(ModelHandlerBase):
                 self.temp_manager.delete_storage(temp_version_path)
                 gc.collect()
                 clear_memory()
+            finally:
+                if pool is not None:
+                    pool.shutdown()
 
             # Create labels.txt in the final version
             labels_path = os.path.join(final_version_path, "labels.txt")
@@ -177,6 +210,9 @@ class DinoDetectionModelHandler(ModelHandlerBase):
             shutil.move(class_mapping_path, new_class_mapping_path)
         
             logger.info(f"class_mapping.json moved to final version {final_version_path}.")
+
+            # Release the previous version right away instead of on the next inference
+            get_model_cache().invalidate(dataset_id, self.model_handler_config.model_name, keep_directory=final_version_path)
             logger.info("Training complete.")
             
         except Exception as e:
@@ -191,15 +227,27 @@ class DinoDetectionModelHandler(ModelHandlerBase):
             if not image_files:
                 raise FileNotFoundError("No images found in inference folder")
                 
-            result_paths = self._data_processor.process_predictions(image_files, dataset_id)
+            predicted = self._data_processor.process_predictions(image_files, dataset_id)
             
             logging.info("Detection inference completed successfully")
-            return result_paths
+            return predicted
             
         except Exception as e:
             logging.error(f"Inference failed: {str(e)}")
             raise
             
+    def load_predictor(self, dataset_id: int):
+        """Load the latest detection model once for per-image inference."""
+        return self._data_processor.load_predictor(dataset_id)
+
+    def predict_image(self, predictor, model_dir: str, image_path: str) -> dict:
+        """Detect objects on one image, returns {image_name: detections}."""
+        return self._data_processor.predict_image(predictor, model_dir, image_path)
+
+    def predict_batch(self, predictor, model_dir: str, image_paths: List[str]) -> dict:
+        """Detect objects on several images in one predictor call, returns {image_name: detections}."""
+        return self._data_processor.predict_batch(predictor, model_dir, image_paths)
+
     def check_memory_available(self, *, min_gb=4):
         free, total = torch.cuda.mem_get_info()
         free_gb = free / (1024**3)
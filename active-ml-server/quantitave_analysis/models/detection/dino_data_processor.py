@@ -1,7 +1,8 @@
 import os
 import shutil
 import json
-from typing import List, Dict
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
 import time
 import logging
 from autogluon.multimodal import MultiModalPredictor
@@ -10,8 +11,10 @@ from abc import ABC
 from common.models import DigitalAssistantBase
 from quantitave_analysis.models.config import Config 
 from quantitave_analysis.utils.temporary_storage import TemporaryStorageManager, DataHandler
+from quantitave_analysis.utils.jsonl import JsonlWriter, iter_jsonl
 from quantitave_analysis.models.detection.detection_config import DetectionModelConfig
 from quantitave_analysis.models.detection.results_processor import ResultProcessor
+from quantitave_analysis.models.common.model_cache import get_model_cache
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -113,14 +116,10 @@ class DinoDataProcessor(ABC, DigitalAssistantBase):
         class_names = [cat['name'] for cat in categories]
         return class_names
 
-    def process_predictions(self, image_files: list, dataset_id: int) -> list:
-        result_paths = []
+    def load_predictor(self, dataset_id: int) -> Tuple[MultiModalPredictor, str]:
+        """Load the latest detection model of the dataset, returns the predictor and its directory."""
         models_base_folder = os.path.join(Config().ALL_MODELS_FOLDER, str(dataset_id))
 
-        # Initialize lists and variables to track timing
-        inference_times = []  # Store inference time for each image
-        total_inference_time = 0.0  # Track total inference time
-
         try:
             model_dir = DataHandler.get_latest_model_path(
                 base_folder=models_base_folder,
@@ -140,55 +139,120 @@ class DinoDataProcessor(ABC, DigitalAssistantBase):
             else:
                 logger.warning(f"labels.txt not found in {model_dir}")
 
-            logger.info(f"Loading model from: {model_dir}")
-            predictor = MultiModalPredictor(
-                problem_type="object_detection",
-                sample_data_path=self.model_handler_config.train_data_folder
-            ).load(model_dir)
-            
-            predictor.set_num_gpus(1)
+            def load_model():
+                logger.info(f"Loading model from: {model_dir}")
+                predictor = MultiModalPredictor(
+                    problem_type="object_detection",
+                    sample_data_path=self.model_handler_config.train_data_folder
+                ).load(model_dir)
+                predictor.set_num_gpus(1)
+                return predictor
+
+            predictor = get_model_cache().get_or_load(
+                dataset_id, self.model_handler_config.model_name, model_dir, load_model
+            )
             
         except Exception as e:  
             logger.error(f"Failed to load model: {str(e)}")
             raise
 
-        glob_json_str = "{"
-
-        for image_path in image_files:
-            data = {
-                "images": [{"id": 0, "width": -1, "height": -1, "file_name": image_path}],
-                "categories": []
-            }
-            temp_json = os.path.join(self.model_handler_config.results_folder, os.path.basename(image_path) + ".json")
+        return predictor, model_dir
 
-            with open(temp_json, "w") as f:
-                json.dump(data, f)
-
-            # Measure inference time for this image
+    def write_predict_manifest(self, image_paths: List[str], manifest_path: str) -> None:
+        """Write a COCO manifest listing the images to predict."""
+        data = {
+            "images": [
+                {"id": image_id, "width": -1, "height": -1, "file_name": image_path}
+                for image_id, image_path in enumerate(image_paths)
+            ],
+            "categories": []
+        }
+        with open(manifest_path, "w") as f:
+            json.dump(data, f)
+
+    def predict_batch(self, predictor: MultiModalPredictor, model_dir: str, image_paths: List[str]) -> Dict[str, list]:
+        """
+        Run detection on a batch of images in one predictor call.
+
+        The images are submitted in one COCO manifest with a unique name, so concurrent jobs
+        do not share files, and the predictions are returned in memory.
+
+        Args:
+            predictor: Loaded predictor, anything with predict(manifest_path, as_pandas=True)
+                returning rows with "image" and "bboxes"
+            model_dir: Directory of the model with class_mapping.json
+            image_paths: Paths to the images
+
+        Returns:
+            Dict[str, list]: Detections keyed by the image name without extension
+        """
+        os.makedirs(self.model_handler_config.results_folder, exist_ok=True)
+        fd, manifest_path = tempfile.mkstemp(suffix=".json", prefix="predict_", dir=self.model_handler_config.results_folder)
+        os.close(fd)
+        try:
+            self.write_predict_manifest(image_paths, manifest_path)
+            predictions = predictor.predict(manifest_path, as_pandas=True, save_results=False)
+        finally:
+            os.remove(manifest_path)
+        return self.result_processor.process_predictions(predictions, model_dir)
+
+    def predict_images(self, predictor: MultiModalPredictor, model_dir: str, image_paths: List[str],
+                       batch_size: Optional[int] = None) -> Iterator[Dict[str, list]]:
+        """Run detection on the images in chunks of batch_size, yields the detections of every chunk."""
+        batch_size = max(1, batch_size or self.model_handler_config.predict_batch_size)
+        for start in range(0, len(image_paths), batch_size):
+            batch = image_paths[start:start + batch_size]
             start_time = time.time()
-            res = predictor.predict(temp_json, save_results=True)
-            end_time = time.time()
-            inference_time = end_time - start_time
-            inference_times.append(inference_time)
-            total_inference_time += inference_time
-            logger.info(f"Inference time for {image_path}: {inference_time:.4f} seconds")
-
-            # Pass the temp_json or prediction result instead of self
-            result_path = self.result_processor.process_combined_results(model_dir)
-            glob_json_str += result_path
-            glob_json_str += "," if image_files[-1] != image_path else "}"
-
-            result_paths.append(result_path)
-
-        # Calculate and log average inference time
-        if inference_times:
-            avg_inference_time = total_inference_time / len(inference_times)
-            logger.info(f"Total inference time for {len(inference_times)} images: {total_inference_time:.4f} seconds")
-            logger.info(f"Average inference time per image: {avg_inference_time:.4f} seconds")
-
-        output_json_path = os.path.join(self.model_handler_config.results_folder, "output.json")
-
-        with open(output_json_path, "w") as f:
-            f.write(glob_json_str)
-        
-        return result_paths
\ No newline at end of file
+            results = self.predict_batch(predictor, model_dir, batch)
+            inference_time = time.time() - start_time
+            logger.info(f"Inference time for {len(batch)} images: {inference_time:.4f} seconds "
+                        f"({inference_time / len(batch):.4f} seconds per image)")
+            yield results
+
+    def predict_image(self, predictor: MultiModalPredictor, model_dir: str, image_path: str) -> Dict[str, list]:
+        """Run detection on one image, returns {image_name: [detections]}."""
+        return self.predict_batch(predictor, model_dir, [image_path])
+
+    def process_predictions(self, image_files: list, dataset_id: int,
+                            predictor: Optional[MultiModalPredictor] = None, model_dir: Optional[str] = None,
+                            batch_size: Optional[int] = None) -> int:
+        """
+        Run detection on all images and append the results to output.jsonl in the results folder.
+
+        Every image is written as one line {image_name: detections} as soon as its batch is
+        predicted, so memory does not grow with the package and the lines written before a
+        crash can be uploaded. Images already in output.jsonl are not predicted again.
+
+        Args:
+            image_files: Paths to the images
+            dataset_id: Dataset ID, used to load the model if no predictor is given
+            predictor: Predictor to use instead of the latest model of the dataset
+            model_dir: Directory of the given predictor with class_mapping.json
+            batch_size: Images per predictor call, predict_batch_size of the config by default
+
+        Returns:
+            int: Number of images written to output.jsonl by this call
+        """
+        output_jsonl_path = os.path.join(self.model_handler_config.results_folder, Config().OUTPUT_JSONL_NAME)
+        if os.path.exists(output_jsonl_path):
+            done = {image_name for line in iter_jsonl(output_jsonl_path) for image_name in line}
+            image_files = [path for path in image_files if os.path.splitext(os.path.basename(path))[0] not in done]
+            logger.info(f"{len(done)} images already predicted, {len(image_files)} left")
+        if not image_files:
+            return 0
+
+        if predictor is None:
+            predictor, model_dir = self.load_predictor(dataset_id)
+
+        start_time = time.time()
+        written = 0
+        with JsonlWriter(output_jsonl_path) as writer:
+            for batch_results in self.predict_images(predictor, model_dir or "", image_files, batch_size):
+                for image_name, detections in batch_results.items():
+                    writer.write({image_name: detections})
+                    written += 1
+
+        total_inference_time = time.time() - start_time
+        logger.info(f"Total inference time for {len(image_files)} images: {total_inference_time:.4f} seconds")
+        logger.info(f"Average inference time per image: {total_inference_time / len(image_files):.4f} seconds")
+        return written
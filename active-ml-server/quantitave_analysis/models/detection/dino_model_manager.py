@@ -21,7 +21,7 @@ class DinoModelManager(ABC, DigitalAssistantBase):
 
     def initialize_predictor(self, models_base_folder: str):
         try:
-            if (DataHandler.get_number_of_version(models_base_folder, self.model_handler_config.model_name) == -1 or not DinoModelManager().check_classes_consistency(models_base_folder)):
+            if (DataHandler.get_number_of_version(models_base_folder, self.model_handler_config.model_name) == -1 or not self.check_classes_consistency(models_base_folder)):
                 # Create a temporary folder for the new version
                 temp_version_path = DataHandler.save_model_path(
                     base_folder=models_base_folder,
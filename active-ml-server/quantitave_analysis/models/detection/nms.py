@@ -0,0 +1,128 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+GRID_MIN_BOXES = 2000  # From this many boxes candidates are looked up in a spatial grid
+GRID_CELL_SCALE = 2.0  # Grid cell side as a multiple of the median box side
+
+
+def _overlaps(boxes: np.ndarray, areas: np.ndarray, index: int, candidates: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Candidates suppressed by the box: one contains the other or IoU is over the threshold
+
+    Args:
+        boxes: Boxes as [x1, y1, x2, y2]
+        areas: Areas of the boxes
+        index: Index of the kept box
+        candidates: Indices of the boxes to test
+        threshold: IoU threshold
+
+    Returns:
+        Boolean mask over candidates
+    """
+    box = boxes[index]
+    others = boxes[candidates]
+
+    contained = (
+        (box[0] >= others[:, 0]) & (box[2] <= others[:, 2]) & (box[1] >= others[:, 1]) & (box[3] <= others[:, 3])
+    ) | (
+        (others[:, 0] >= box[0]) & (others[:, 2] <= box[2]) & (others[:, 1] >= box[1]) & (others[:, 3] <= box[3])
+    )
+
+    width = np.minimum(box[2], others[:, 2]) - np.maximum(box[0], others[:, 0])
+    height = np.minimum(box[3], others[:, 3]) - np.maximum(box[1], others[:, 1])
+    intersecting = (width > 0) & (height > 0)
+    intersection = np.where(intersecting, width * height, 0.0)
+    union = areas[index] + areas[candidates] - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(intersecting, intersection / union, 0.0)
+    return contained | (iou > threshold)
+
+
+class _Grid:
+    """Uniform grid over the boxes, every box is registered in each cell its closed extent touches"""
+
+    def __init__(self, boxes: np.ndarray, indices: np.ndarray):
+        sides = np.maximum(boxes[indices, 2] - boxes[indices, 0], boxes[indices, 3] - boxes[indices, 1])
+        median = float(np.median(sides)) if len(sides) else 0.0
+        self.cell = max(median * GRID_CELL_SCALE, 1e-6)
+        self.first = np.floor(boxes[:, :2] / self.cell).astype(np.int64)
+        self.last = np.floor(boxes[:, 2:] / self.cell).astype(np.int64)
+        self.cells: Dict[tuple, List[int]] = defaultdict(list)
+        for index in indices:
+            for cx in range(self.first[index, 0], self.last[index, 0] + 1):
+                for cy in range(self.first[index, 1], self.last[index, 1] + 1):
+                    self.cells[(cx, cy)].append(index)
+
+    def neighbours(self, index: int) -> np.ndarray:
+        """Boxes sharing a cell with the box, the only ones that can intersect or contain it"""
+        found = set()
+        for cx in range(self.first[index, 0], self.last[index, 0] + 1):
+            for cy in range(self.first[index, 1], self.last[index, 1] + 1):
+                found.update(self.cells.get((cx, cy), ()))
+        return np.fromiter(found, dtype=np.int64, count=len(found))
+
+
+def _suppress(boxes: np.ndarray, areas: np.ndarray, order: np.ndarray, threshold: float,
+              grid_min_boxes: Optional[int]) -> List[int]:
+    """Greedy suppression over the boxes in order, returns the kept indices in that order"""
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    rank = np.empty(len(boxes), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    grid = _Grid(boxes, order) if grid_min_boxes is not None and len(order) >= grid_min_boxes else None
+
+    keep = []
+    for position, index in enumerate(order):
+        if suppressed[index]:
+            continue
+        keep.append(int(index))
+        if grid is None:
+            candidates = order[position + 1:]
+        else:
+            candidates = grid.neighbours(index)
+            candidates = candidates[rank[candidates] > position]
+        candidates = candidates[~suppressed[candidates]]
+        if len(candidates):
+            suppressed[candidates[_overlaps(boxes, areas, index, candidates, threshold)]] = True
+    return keep
+
+
+def suppress_overlaps(boxes: Sequence[Sequence[float]], scores: Sequence[float], threshold: float,
+                      classes: Optional[Sequence] = None,
+                      grid_min_boxes: Optional[int] = GRID_MIN_BOXES) -> List[int]:
+    """
+    Vectorized greedy suppression of overlapping boxes, the box with the highest score wins
+
+    A box is dropped when it overlaps a kept box with a higher score: one of them contains
+    the other or their IoU is over the threshold. Boxes with equal scores keep their input
+    order, so the result matches filter_overlapping_rectangles.
+
+    Args:
+        boxes: Boxes as [x, y, width, height]
+        scores: Scores of the boxes
+        threshold: IoU threshold
+        classes: Class of every box, boxes of different classes do not suppress each other
+        grid_min_boxes: Number of boxes from which candidates are looked up in a spatial grid, None disables it
+
+    Returns:
+        Indices of the kept boxes in order of descending score
+    """
+    if len(scores) == 0:
+        return []
+    xywh = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    corners = np.concatenate([xywh[:, :2], xywh[:, :2] + xywh[:, 2:]], axis=1)
+    areas = xywh[:, 2] * xywh[:, 3]
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='stable')
+
+    if classes is None:
+        return _suppress(corners, areas, order, threshold, grid_min_boxes)
+
+    labels = np.asarray(classes)[order]
+    keep = []
+    for label in dict.fromkeys(labels.tolist()):
+        keep.extend(_suppress(corners, areas, order[labels == label], threshold, grid_min_boxes))
+    # Classes are merged back into one ranking by score
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return sorted(keep, key=lambda index: rank[index])
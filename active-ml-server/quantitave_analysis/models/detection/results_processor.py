@@ -1,16 +1,19 @@
 import os
 import json
 import logging
-import cv2
+import threading
+from typing import Dict, Tuple
 
-from quantitave_analysis.utils.temporary_storage import DataHandler
 from quantitave_analysis.models.config import Config
+from quantitave_analysis.utils.parse_detection_results import image_size, read_result_rows
+from quantitave_analysis.models.detection.nms import suppress_overlaps
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 CONFIDENCE_THRESHOLD = Config().CONFIDENCE_THRESHOLD
 INTERSECTION_THRESHOLD = Config().INTERSECTION_THRESHOLD  # Configurable IoU threshold
+NMS_CLASS_AWARE = Config().NMS_CLASS_AWARE
 
 
 class Rectangle:
@@ -68,125 +71,122 @@ def is_touching_or_contained(rect1, rect2):
 
     return contained or intersection
 
-def filter_overlapping_rectangles(rectangles):
+def filter_overlapping_rectangles(rectangles, class_aware=NMS_CLASS_AWARE):
     """Filters overlapping rectangles, keeping the one with the highest score"""
     if not rectangles:
         return []
-    
-    # logging.info(f"Starting with {len(rectangles)} rectangles")
-    # Sort by score in descending order
-    rectangles.sort(key=lambda r: r.score, reverse=True)
-    keep = []
-    
-    while rectangles:
-        # Take the rectangle with the highest score
-        current = rectangles.pop(0)
-        keep.append(current.detection)
-        # logging.info(f"Keeping rectangle at ({current.x}, {current.y}) with score {current.score}")
-        
-        # Get rid of all the rectangles that overlap with the current one.
-        remaining = []
-        for rect in rectangles:
-            if not is_touching_or_contained(current, rect):
-                remaining.append(rect)
-            # else:
-            #     logging.info(f"Removing rectangle at ({rect.x}, {rect.y}) due to overlap")
-        
-        rectangles = remaining
-    
-    # logging.info(f"Kept {len(keep)} rectangles after filtering")
-    return keep
+
+    keep = suppress_overlaps(
+        [(rect.x, rect.y, rect.width, rect.height) for rect in rectangles],
+        [rect.score for rect in rectangles],
+        INTERSECTION_THRESHOLD,
+        classes=[rect.detection["label_name"] for rect in rectangles] if class_aware else None
+    )
+    return [rectangles[index].detection for index in keep]
+
+
+# Reverse class mappings keyed by the model directory, with the mtime of class_mapping.json they were read at
+_class_mappings: Dict[str, Tuple[float, dict]] = {}
+_class_mappings_lock = threading.Lock()
+
 
 class ResultProcessor:
     @staticmethod
-    def process_single_result(txt_path: str, model_dir) -> dict:
-        # Open and read the result.txt file
-        with open(txt_path, "r") as file:
-            lines = file.readlines()
+    def build_detections(image_path: str, bboxes: list, reverse_class_mapping: dict) -> dict:
+        """
+        Convert the boxes predicted for one image to platform detections
+
+        Boxes under the confidence threshold are dropped and overlapping boxes are filtered.
+
+        Args:
+            image_path: Path to the image
+            bboxes: Predicted boxes, dicts with "class", "bbox" as [x1, y1, x2, y2] and "score"
+            reverse_class_mapping: Mapping of model class aliases to the real class names
+
+        Returns:
+            dict: {image name without extension: detections}
+        """
+        image_name = os.path.basename(image_path.strip())
+        width, height = image_size(image_path.strip())
+
+        detections = []
+        boxes = []
+        scores = []
+        for elems in bboxes:
+            if elems["score"] <= CONFIDENCE_THRESHOLD:
+                continue
+            label = elems["class"]
+            box = (elems["bbox"][0], elems["bbox"][1],
+                   elems["bbox"][2] - elems["bbox"][0], elems["bbox"][3] - elems["bbox"][1])
+            detections.append({
+                "label_name": reverse_class_mapping.get(label, label),
+                "bbox_x": box[0],
+                "bbox_y": box[1],
+                "bbox_width": box[2],
+                "bbox_height": box[3],
+                "image_name": image_name,
+                "image_width": width,
+                "image_height": height,
+                "score": elems["score"]
+            })
+            boxes.append(box)
+            scores.append(elems["score"])
 
-        # Skip the header
-        rows = lines[1:]
+        # Filtering overlapping boxes
+        keep = suppress_overlaps(
+            boxes, scores, INTERSECTION_THRESHOLD,
+            classes=[detection["label_name"] for detection in detections] if NMS_CLASS_AWARE else None
+        )
+        return {image_name[:-4]: [detections[index] for index in keep]}
 
+    @staticmethod
+    def process_single_result(txt_path: str, model_dir) -> dict:
         # Uploading the reverse mapping
         reverse_class_mapping = ResultProcessor.load_reverse_class_mapping(model_dir)
 
-        results = []
-        for i in range(len(rows)):
-            image_path, bboxes_str = rows[i].split(",", 1)
-            image = cv2.imread(image_path)
-            width, height = image.shape[1], image.shape[0]
-            image_name = os.path.basename(image_path.strip())
-
-            # Convert the bounding boxes string to a Python list
-            bboxes = eval(bboxes_str.strip())
-            bboxes = "{ '" + image_name + "': " + bboxes + '}'
-            bboxes = bboxes.replace("'", '"')
-            bboxes = json.loads(bboxes)
-
-            detections = []
-            rectangles = []
-            for bbox in bboxes:
-                for elems in bboxes[bbox]:
-                    label = elems["class"]
-                    real_label = reverse_class_mapping.get(label, label)
-                    
-                    detection = {
-                        "label_name": real_label,
-                        "bbox_x": elems["bbox"][0],
-                        "bbox_y": elems["bbox"][1],
-                        "bbox_width": elems["bbox"][2] - elems["bbox"][0],
-                        "bbox_height": elems["bbox"][3] - elems["bbox"][1],
-                        "image_name": image_name,
-                        "image_width": width,
-                        "image_height": height,
-                        "score": elems["score"]
-                    }
-                    
-                    if elems["score"] > CONFIDENCE_THRESHOLD:
-                        detections.append(detection)
-                        # Creating a Rectangle object to check for intersections
-                        rectangles.append(Rectangle(
-                            x=elems["bbox"][0],
-                            y=elems["bbox"][1],
-                            width=elems["bbox"][2] - elems["bbox"][0],
-                            height=elems["bbox"][3] - elems["bbox"][1],
-                            score=elems["score"],
-                            detection=detection
-                        ))
-
-            # Filtering overlapping rectangles
-            filtered_detections = filter_overlapping_rectangles(rectangles)
-
-            results.append({
-                image_name[:-4]: filtered_detections
-            })
+        results = [
+            ResultProcessor.build_detections(image_path, bboxes, reverse_class_mapping)
+            for image_path, bboxes in read_result_rows(txt_path)
+        ]
         return results[0]
 
     @staticmethod
     def load_reverse_class_mapping(model_dir):
+        """Reverse class mapping of the model version, read once per version of class_mapping.json"""
         mapping_path = os.path.join(model_dir, "class_mapping.json")
-        if os.path.exists(mapping_path):
-            with open(mapping_path, 'r') as f:
-                mappings = json.load(f)
-                return mappings["reverse"]
-        logging.warning(f"Class mapping not found at {mapping_path}")
-        return {}
+        try:
+            mtime = os.path.getmtime(mapping_path)
+        except OSError:
+            logging.warning(f"Class mapping not found at {mapping_path}")
+            return {}
+
+        with _class_mappings_lock:
+            cached = _class_mappings.get(model_dir)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+        with open(mapping_path, 'r') as f:
+            reverse_class_mapping = json.load(f)["reverse"]
+        with _class_mappings_lock:
+            _class_mappings[model_dir] = (mtime, reverse_class_mapping)
+        return reverse_class_mapping
 
     @staticmethod
-    def process_combined_results(model_dir) -> str:
-        """Process result.txt and create one combined JSON file."""
-        project_folder = os.path.abspath(os.path.join(Config().storage_root, '../'))
-        base_path = os.path.join(project_folder, "AutogluonModels")
-        
-        latest_txt_file = DataHandler.get_latest_result_txt(base_path)
-        logging.info(f"Latest result.txt folder: {latest_txt_file}")
-
-        result_txt_path = os.path.join(latest_txt_file, "result.txt")
-
-        if os.path.exists(result_txt_path):
-            results_json = ResultProcessor.process_single_result(result_txt_path, model_dir)
-            results_json_str = json.dumps(results_json)
-            results_json_str = results_json_str[1:-1]  # Remove starting and ending {}
-        else:
-            raise FileNotFoundError("result.txt not found in the latest model folder.")
-        return results_json_str
\ No newline at end of file
+    def process_predictions(predictions, model_dir) -> dict:
+        """
+        Convert the predictions of a batch to platform detections in memory
+
+        Args:
+            predictions: Output of predictor.predict, a DataFrame or a list of rows with "image" and "bboxes"
+            model_dir: Directory of the model with class_mapping.json
+
+        Returns:
+            dict: {image name without extension: detections} for every predicted image
+        """
+        reverse_class_mapping = ResultProcessor.load_reverse_class_mapping(model_dir)
+        rows = predictions.to_dict("records") if hasattr(predictions, "to_dict") else predictions
+
+        results = {}
+        for row in rows:
+            results.update(ResultProcessor.build_detections(row["image"], row["bboxes"] or [], reverse_class_mapping))
+        return results
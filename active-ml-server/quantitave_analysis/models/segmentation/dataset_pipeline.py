@@ -1,9 +1,17 @@
 from tqdm import tqdm
 import pandas as pd
 import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 
-from quantitave_analysis.augmentations.segmentation_augmentations import SampleProcessor
+from quantitave_analysis.augmentations.segmentation_augmentations import (
+    SampleProcessor,
+    init_sample_worker,
+    process_sample
+)
+from quantitave_analysis.augmentations.manifest import SEED_COLUMN, TRANSFORM_COLUMN
 from quantitave_analysis.utils.temporary_storage import TemporaryStorageManager
 from quantitave_analysis.models.config import Config
 
@@ -15,13 +23,15 @@ UPLOAD_FOLDER = Config().UPLOAD_FOLDER
 MASK_POSTFIX = Config().MASK_POSTFIX
 SEG_IMAGES_AFTER_AUG = Config().SEG_IMAGES_AFTER_AUG
 SEG_MASKS_AFTER_AUG = Config().SEG_MASKS_AFTER_AUG
+SEG_DATASET_WORKERS = Config().SEG_DATASET_WORKERS
 
 
 class SegmentationDatasetPreparer:
     def __init__(self):
         self.processor = SampleProcessor()
         #self.output_path = SHARED_FOLDER_AFTER_AUG
-        self.columns = ["index", "image", "label"]
+        # Manifest columns, the augmented copies are materialised from image, label and transform while training
+        self.columns = ["index", "image", "label", TRANSFORM_COLUMN, SEED_COLUMN]
         # self.split_fractions = [0.9, 0.1]
         self.split_fractions = [1, 0]
         self.storage = TemporaryStorageManager()
@@ -31,36 +41,74 @@ class SegmentationDatasetPreparer:
     def create_dataset(self, input_path: str, output_path: str) -> None:
         logging.info("Starting main execution segmentation_prepare_dataset")
         logging.info(f"Starting dataset preparation for {input_path}")
+        self.processor = SampleProcessor(input_path, output_path)
+        self.images_path = os.path.join(output_path, SEG_IMAGES_AFTER_AUG)
+        self.masks_path = os.path.join(output_path, SEG_MASKS_AFTER_AUG)
         try:
             self.storage.create_storage(self.images_path)
             self.storage.create_storage(self.masks_path)
 
-            data_table = pd.DataFrame(columns=self.columns)
             files = sorted(os.listdir(input_path))
             image_files = [f for f in files if f.endswith(SUPPORTED_IMAGE_TYPES) and MASK_POSTFIX not in f]
 
             logging.info(f"Found {len(image_files)} potential image files in {input_path}")
-            for filename in tqdm(image_files):
+            samples = []
+            for filename in image_files:
                 img_full_path = os.path.join(input_path, filename)
                 mask_filename = f"{filename.split('.')[0]}{MASK_POSTFIX}.png"
                 mask_full_path = os.path.join(input_path, mask_filename)
 
                 if os.path.exists(mask_full_path):
                     base_name = filename.split('.')[0]
-                    self.processor.process(img_full_path, mask_full_path, base_name, data_table)
+                    samples.append((img_full_path, mask_full_path, base_name))
                 else:
                     logging.warning(f"Mask file not found for image: {filename}")
 
+            rows = self._process_samples(samples)
+            data_table = pd.DataFrame.from_records(rows, columns=self.columns[1:])
+            data_table.insert(0, 'index', range(len(data_table)))
+
             if data_table.empty:
                 logging.warning("No valid image-mask pairs found to process.")
             else:
                 logging.info(f"Processed {len(data_table)} augmented samples")
-                self._split_and_save(data_table)
+                self._split_and_save(data_table, output_path)
                 logging.info("Segmentation dataset preparation completed successfully")
             
         except Exception as e:
             logging.critical(f"Critical error in dataset preparation: {e}")
 
+    def _process_samples(self, samples: List[Tuple[str, str, str]],
+                         workers: int = SEG_DATASET_WORKERS) -> List[Dict[str, str]]:
+        """
+        Convert the masks of the samples and list their augmentations in a process pool
+
+        Samples are independent, every worker gets the label properties once and returns
+        the rows of its samples. The rows are concatenated in the order of the samples,
+        so the dataset does not depend on the number of workers.
+
+        Args:
+            samples: (image path, mask path, base name) of every sample
+            workers: Number of processes, 1 processes the samples in this process
+
+        Returns:
+            List[Dict[str, str]]: manifest rows {'image', 'label', 'transform', 'seed'} of all augmented samples
+        """
+        label_properties = self.processor.load_label_properties()
+        workers = max(1, min(workers, len(samples)))
+        if workers == 1:
+            sample_rows = [self.processor.process(*sample) for sample in tqdm(samples)]
+        else:
+            logging.info(f"Processing {len(samples)} samples in {workers} processes")
+            # Spawned workers do not inherit the CUDA state of the server process
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_sample_worker,
+                                     initargs=(self.processor.upload_folder, self.processor.processed_folder,
+                                               label_properties)) as pool:
+                chunksize = max(1, len(samples) // (workers * 4))
+                sample_rows = list(tqdm(pool.map(process_sample, samples, chunksize=chunksize), total=len(samples)))
+        return [row for rows in sample_rows for row in rows]
+
     def _split_and_save(self, data_table: pd.DataFrame, output_path: str = PROCESSED_FOLDER) -> None:
         total_images = len(data_table)
         train_count = int(total_images * self.split_fractions[0])
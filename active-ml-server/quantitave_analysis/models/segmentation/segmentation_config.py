@@ -1,3 +1,5 @@
+import os
+
 from quantitave_analysis.models.common.base_config import BaseModelConfig
 from quantitave_analysis.utils.temporary_storage import DataHandler
 from quantitave_analysis.models.config import Config
@@ -15,6 +17,9 @@ class SegmentationModelConfig(BaseModelConfig):
     output_folder: str = ALL_MODELS_FOLDER
     folder_for_inference: str = UPLOAD_FOLDER
     results_folder_after_inference: str = RETURN_FOLDER
+    predict_batch_size: int = 8  # Images passed to the predictor in one call
+    mask_writer_processes: int = max(1, (os.cpu_count() or 2) // 2)  # Processes converting and saving predicted masks
+    palette_mask_output: bool = False  # Predicted masks are saved as palette PNGs instead of RGBA
     # hyperparameters for multi-class segmentation
     hyperparameters: dict = {
         # "optimization.learning_rate": 0.001,
@@ -217,7 +217,7 @@ class SegmentationErosionProcessor:
             raise FileNotFoundError(f"Model directory does not exist: {model_directory}")
 
         # Load label properties
-        label_properties_path = os.path.join(Config().UPLOAD_FOLDER, "label_properties.json")
+        label_properties_path = os.path.join(folder_for_inference, "label_properties.json")
         label_properties = LabelPropertiesLoader.load_label_properties(label_properties_path)
         logging.info(f"Loaded label properties for inference: {label_properties}")
 
@@ -1,5 +1,9 @@
 import os
 import logging
+import multiprocessing
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional
 import pandas as pd
 import cv2
 import numpy as np
@@ -10,14 +14,24 @@ from quantitave_analysis.utils.temporary_storage import TemporaryStorageManager,
 from quantitave_analysis.utils.image_processing import LabelPropertiesLoader
 from quantitave_analysis.models.segmentation.segmentation_config import SegmentationModelConfig
 from quantitave_analysis.models.common.base_model import ModelHandlerBase
+from quantitave_analysis.models.common.model_cache import get_model_cache
 from quantitave_analysis.models.detection.results_processor import ResultProcessor
-from quantitave_analysis.utils.file_converter import ConvertorPalette2Rgba
+from quantitave_analysis.utils.file_converter import save_rgba_mask
+from quantitave_analysis.augmentations.manifest import (
+    MaterializationCache,
+    SEED_COLUMN,
+    TRANSFORM_COLUMN,
+    augmentation_pool
+)
+from quantitave_analysis.augmentations.segmentation_augmentations import materialize_sample
 from common.tools.clear_routines import clear_memory
 from quantitave_analysis.models.config import Config
 from quantitave_analysis.models.segmentation.segmentation_erosion import SegmentationErosionProcessor
 
 ALL_MODELS_FOLDER = Config().ALL_MODELS_FOLDER
 SUPPORTED_IMAGE_TYPES = Config().SUPPORTED_IMAGE_TYPES
+SEG_IMAGES_AFTER_AUG = Config().SEG_IMAGES_AFTER_AUG
+SEG_MASKS_AFTER_AUG = Config().SEG_MASKS_AFTER_AUG
 DATA_UPLOADS_FOLDER = Config().DATA_UPLOADS_FOLDER if hasattr(Config(), 'DATA_UPLOADS_FOLDER') else 'data/uploads'
 
 
@@ -29,6 +43,46 @@ class SegmentationModelHandler(ModelHandlerBase):
     temp_manager: TemporaryStorageManager = TemporaryStorageManager()
     result_processor: ResultProcessor = ResultProcessor()
 
+    def configure_folders(self, folder_for_train: str = None, folder_for_inference: str = None,
+                          results_folder_after_inference: str = None) -> None:
+        """
+        Points the handler to the folders of the current job
+
+        Args:
+            folder_for_train: folder with the prepared dataset
+            folder_for_inference: folder with images for inference and label_properties.json
+            results_folder_after_inference: folder for predicted masks
+        """
+        folders = {
+            "folder_for_train": folder_for_train,
+            "folder_for_inference": folder_for_inference,
+            "results_folder_after_inference": results_folder_after_inference
+        }
+        self.model_handler_config = self.model_handler_config.model_copy(
+            update={name: folder for name, folder in folders.items() if folder}
+        )
+
+    @staticmethod
+    def count_rows(csv_file):
+        """
+        Counts the data rows of a CSV file without parsing it
+
+        Args:
+            csv_file: path to the CSV file with a header line
+
+        Returns:
+            int: number of rows after the header
+        """
+        with open(csv_file, 'rb') as f:
+            lines = sum(block.count(b'\n') for block in iter(lambda: f.read(1024 * 1024), b''))
+            # The last line may have no line break
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    lines += 1
+        return max(0, lines - 1)
+
     def get_data_chunks(self, csv_file, target_chunk_count=None):
         """
         Calculates chunk parameters for dynamic data loading
@@ -40,8 +94,7 @@ class SegmentationModelHandler(ModelHandlerBase):
         Returns:
             tuple: (total_rows, chunk_size, num_chunks)
         """
-        df = pd.read_csv(csv_file, sep=',')
-        total_rows = len(df)
+        total_rows = self.count_rows(csv_file)
 
         # Calculate number of chunks if not specified
         if target_chunk_count is None:
@@ -53,40 +106,70 @@ class SegmentationModelHandler(ModelHandlerBase):
 
         return total_rows, chunk_size, target_chunk_count
 
-    def load_data_chunk(self, csv_file, chunk_index, chunk_size, total_rows):
+    @staticmethod
+    def chunk_sizes(total_rows, chunk_count):
         """
-        Dynamically loads a chunk of data from CSV file
+        Sizes of the chunks, computed once before training
+
+        The remainder of total_rows / chunk_count is spread over the first chunks,
+        so every row is trained on and the sizes differ by at most one.
 
         Args:
-            csv_file: path to the CSV file
-            chunk_index: index of current chunk (0-based)
-            chunk_size: size of each chunk
-            total_rows: total number of rows in the file
+            total_rows: number of rows in the file
+            chunk_count: number of chunks
 
         Returns:
+            list: number of rows of every chunk
+        """
+        chunk_size, remainder = divmod(total_rows, chunk_count)
+        return [chunk_size + (1 if index < remainder else 0) for index in range(chunk_count)]
+
+    def iter_data_chunks(self, csv_file, chunk_sizes):
+        """
+        Streams the chunks of a CSV file in one pass
+
+        The file is read by a single reader, so every chunk costs only its own rows
+        instead of re-scanning the file from the start.
+
+        Args:
+            csv_file: path to the CSV file
+            chunk_sizes: number of rows of every chunk, see chunk_sizes()
+
+        Yields:
             DataFrame with the chunk data
         """
-        start_idx = chunk_index * chunk_size
-
-        # For the last chunk, include all remaining rows
-        if chunk_index == (total_rows // chunk_size):
-            nrows = total_rows - start_idx
-        else:
-            nrows = chunk_size
-
-        # Load only the needed chunk
-        df_chunk = pd.read_csv(
-            csv_file,
-            sep=',',
-            skiprows=range(1, start_idx + 1),  # Skip rows before current chunk (keep header)
-            nrows=nrows
-        )
+        with pd.read_csv(csv_file, sep=',', iterator=True) as reader:
+            for size in chunk_sizes:
+                yield reader.get_chunk(size).reset_index(drop=True)
+
+    def materialize_chunk(self, data_chunk: pd.DataFrame, cache: MaterializationCache) -> pd.DataFrame:
+        """
+        Writes the augmented samples of a manifest chunk
 
-        return df_chunk
+        Args:
+            data_chunk: manifest rows with image, label, transform and seed
+            cache: cache the written files are registered in, evicted after the stage
+
+        Returns:
+            DataFrame with the paths of the materialised samples, without the manifest columns
+        """
+        if TRANSFORM_COLUMN not in data_chunk.columns:
+            # Dataset prepared with every augmented copy on disk
+            return data_chunk
+        folder = self.model_handler_config.folder_for_train
+        rows = cache.materialize(
+            data_chunk.to_dict('records'),
+            partial(materialize_sample, images_path=os.path.join(folder, SEG_IMAGES_AFTER_AUG),
+                    masks_path=os.path.join(folder, SEG_MASKS_AFTER_AUG))
+        )
+        data_chunk = pd.DataFrame.from_records(rows, columns=data_chunk.columns)
+        return data_chunk.drop(columns=[TRANSFORM_COLUMN, SEED_COLUMN], errors='ignore')
 
     def run_train(self, dataset_id: int):
         logging.info("Training segmentation model...")
 
+        # Cached predictors hold GPU memory that training needs
+        get_model_cache().clear()
         clear_memory([])
 
         train_file = os.path.normpath(os.path.join(self.model_handler_config.folder_for_train, "train.csv"))
@@ -105,30 +188,34 @@ class SegmentationModelHandler(ModelHandlerBase):
         # Get the base model folder path
         models_base_folder = os.path.join(ALL_MODELS_FOLDER, str(dataset_id))
 
+        pool = augmentation_pool()
         try:
             model, model_directory = self.initialize_model(models_base_folder)
 
-            for stage in range(chunk_count):
-                logging.info(f"\nStarting STAGE {stage + 1}/{chunk_count}")
+            # Training chunks are streamed from one reader
+            train_chunks = self.iter_data_chunks(train_file, self.chunk_sizes(train_total, chunk_count))
+            # val_chunks = self.iter_data_chunks(val_file, self.chunk_sizes(val_total, chunk_count))
 
-                # Dynamically load training chunk
-                training_data = self.load_data_chunk(train_file, stage, train_chunk_size, train_total)
+            for stage, training_data in enumerate(train_chunks):
+                logging.info(f"\nStarting STAGE {stage + 1}/{chunk_count}")
                 logging.info(f"Loaded training chunk {stage + 1}: {len(training_data)} rows")
 
                 # Dynamically load validation chunk
-                # validation_data = self.load_data_chunk(val_file, stage, val_chunk_size, val_total)
+                # validation_data = next(val_chunks)
                 # logging.info(f"Loaded validation chunk {stage + 1}: {len(validation_data)} rows")
 
-                # Train on batch
+                # Train on batch, the augmented copies of the chunk exist only while it is trained on
                 logging.info(f"Training on batch {stage + 1}...")
                 if os.path.exists(model_directory):
                     self.temp_manager.reset_directory(model_directory)
 
-                model.fit(
-                    train_data=training_data,
-                    tuning_data=training_data,  # Use validation_data if needed
-                    save_path=model_directory
-                )
+                with MaterializationCache(pool) as cache:
+                    training_data = self.materialize_chunk(training_data, cache)
+                    model.fit(
+                        train_data=training_data,
+                        tuning_data=training_data,  # Use validation_data if needed
+                        save_path=model_directory
+                    )
                 logging.info(f"Completed training for batch {stage + 1}")
 
                 # Clear memory after each batch
@@ -143,7 +230,12 @@ class SegmentationModelHandler(ModelHandlerBase):
             # Clean up the created directory if training fails
             TemporaryStorageManager().delete_storage(model_directory)
             exit(1)
+        finally:
+            if pool is not None:
+                pool.shutdown()
 
+        # Release the previous version right away instead of on the next inference
+        get_model_cache().invalidate(dataset_id, self.model_handler_config.model_name, keep_directory=model_directory)
         logging.info("Training complete.")
 
     
@@ -180,13 +272,16 @@ class SegmentationModelHandler(ModelHandlerBase):
         
         return binary_mask
 
-    def run_predict(self, dataset_id: int):
-        logging.info("Running segmentation inference...")
+    def load_predictor(self, dataset_id: int) -> MultiModalPredictor:
+        """
+        Loads the latest segmentation model of the dataset
 
-        folder_for_inference = os.path.normpath(self.model_handler_config.folder_for_inference)
-        if not os.path.exists(folder_for_inference):
-            raise FileNotFoundError(f"Data directory does not exist: {folder_for_inference}")
+        Args:
+            dataset_id: dataset identifier
 
+        Returns:
+            MultiModalPredictor: loaded predictor
+        """
         models_base_folder = os.path.join(ALL_MODELS_FOLDER, str(dataset_id))
 
         # Get the latest model path using the same approach as in run_train
@@ -199,53 +294,156 @@ class SegmentationModelHandler(ModelHandlerBase):
         if not os.path.exists(model_directory):
             raise FileNotFoundError(f"Model directory does not exist: {model_directory}")
 
+        return get_model_cache().get_or_load(
+            dataset_id, self.model_handler_config.model_name, model_directory,
+            lambda: MultiModalPredictor.load(model_directory)
+        )
+
+    def load_inference_label_properties(self):
+        """Loads label properties of the inference package, None for single-class segmentation"""
+        folder_for_inference = os.path.normpath(self.model_handler_config.folder_for_inference)
         # Check if this is a multi-class model by looking for label properties file
-        label_properties_path = os.path.join(Config().UPLOAD_FOLDER, "label_properties.json")
+        label_properties_path = os.path.join(folder_for_inference, "label_properties.json")
         label_properties = LabelPropertiesLoader.load_label_properties(label_properties_path)
         logging.info(f"Loaded label properties for inference: {label_properties}")
 
         # Check if we have valid label properties
         if label_properties is None:
             logging.warning("No label properties found. Defaulting to single-class segmentation.")
+        return label_properties
+
+    def predict_batch(self, predictor_model: MultiModalPredictor, img_paths: List[str]) -> list:
+        """
+        Predicts the masks of several images in one predictor call
+
+        Args:
+            predictor_model: loaded predictor
+            img_paths: paths to the PNG images
+
+        Returns:
+            list: palette mask of every image, in the order of img_paths
+        """
+        inference_df = pd.DataFrame({
+            "index": [os.path.splitext(os.path.basename(img_path))[0] for img_path in img_paths],
+            "image": img_paths
+        })
+        prediction = predictor_model.predict(inference_df)
+        return [prediction[i] for i in range(len(img_paths))]
+
+    def mask_file_path(self, img_path: str) -> str:
+        img_base_name = os.path.splitext(os.path.basename(img_path))[0]
+        return os.path.normpath(
+            os.path.join(self.model_handler_config.results_folder_after_inference, f"{img_base_name}_mask.png"))
+
+    def mask_writer_pool(self) -> ProcessPoolExecutor:
+        """
+        Pool of processes converting predicted masks to RGBA and saving them, the caller shuts it down
+
+        Spawned workers do not inherit the CUDA context of the predictor.
+        """
+        return ProcessPoolExecutor(max_workers=max(1, self.model_handler_config.mask_writer_processes),
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def submit_mask(self, pool: ProcessPoolExecutor, img_path: str, prediction, label_properties) -> Future:
+        """Save the predicted mask of an image in the writer pool, the future returns the path of the mask"""
+        return pool.submit(save_rgba_mask, label_properties, self.mask_file_path(img_path), prediction,
+                           self.model_handler_config.palette_mask_output)
+
+    def predict_image(self, predictor_model: MultiModalPredictor, img_path: str, label_properties) -> str:
+        """
+        Predicts the mask of one image and saves it to the results folder
+
+        Args:
+            predictor_model: loaded predictor
+            img_path: path to the PNG image
+            label_properties: label properties of the package
+
+        Returns:
+            str: path to the saved RGBA mask
+        """
+        prediction = self.predict_batch(predictor_model, [img_path])[0]
+        return save_rgba_mask(label_properties, self.mask_file_path(img_path), prediction,
+                              self.model_handler_config.palette_mask_output)
 
-        predictor_model = MultiModalPredictor.load(model_directory)
+    def run_predict(self, dataset_id: int, batch_size: Optional[int] = None):
+        """
+        Predicts the masks of all images of the inference folder
+
+        Images are predicted in batches of batch_size while a pool of processes converts
+        the predicted masks to RGBA and saves them, so the predictor does not wait for encoding.
+
+        Args:
+            dataset_id: dataset identifier
+            batch_size: images per predictor call, predict_batch_size of the config by default
+        """
+        logging.info("Running segmentation inference...")
+
+        folder_for_inference = os.path.normpath(self.model_handler_config.folder_for_inference)
+        if not os.path.exists(folder_for_inference):
+            raise FileNotFoundError(f"Data directory does not exist: {folder_for_inference}")
+
+        label_properties = self.load_inference_label_properties()
+        predictor_model = self.load_predictor(dataset_id)
 
         results_folder_after_inference = os.path.normpath(self.model_handler_config.results_folder_after_inference)
         TemporaryStorageManager().create_storage(results_folder_after_inference)
 
-        for img_file in tqdm(os.listdir(folder_for_inference)):
-            img_path = os.path.normpath(os.path.join(folder_for_inference, img_file))
+        img_paths = []
+        for img_file in sorted(os.listdir(folder_for_inference)):
             if img_file.endswith('.png'):
-                img_base_name = os.path.splitext(img_file)[0]
-                try:
-                    inference_df = pd.DataFrame({
-                        "index": [img_base_name],
-                        "image": [img_path]
-                    })
-                    # prediction = predictor_model.predict_proba(inference_df)
-
-                    # binary_mask = self.get_local_maxima_mask(
-                    #     prob_map=prediction[0],
-                    #     min_distance=3,      # радиус окна для поиска максимумов
-                    #     threshold=0.5        # минимальная вероятность
-                    # )
-                    # print(f"BINARY MASK SHAPE: {binary_mask.shape}")  # Print the shape of binary_mask.shape
-
-                    prediction = predictor_model.predict(inference_df)
-                    # prediction = predictor_model.predict({"image": [img_path]})
-                    mask_file_path = os.path.normpath(
-                        os.path.join(results_folder_after_inference, f"{img_base_name}_mask.png"))
-
-                    ConvertorPalette2Rgba(label_properties=label_properties, output=mask_file_path,
-                                          image_array=prediction[0]).execute()
-
-                except Exception as e:
-                    logging.error(f"Error processing image {img_file}: {e}")
+                img_paths.append(os.path.normpath(os.path.join(folder_for_inference, img_file)))
             else:
                 logging.info(f"Skipping unsupported file: {img_file}")
 
+        batch_size = max(1, batch_size or self.model_handler_config.predict_batch_size)
+        workers = max(1, self.model_handler_config.mask_writer_processes)
+        with self.mask_writer_pool() as pool:
+            pending = {}
+            for start in tqdm(range(0, len(img_paths), batch_size)):
+                batch = img_paths[start:start + batch_size]
+                for img_path, prediction in self._predict_batch_or_each(predictor_model, batch):
+                    pending[self.submit_mask(pool, img_path, prediction, label_properties)] = img_path
+
+                # Masks waiting for the pool are held in memory, the predictor waits only if the pool falls behind
+                if len(pending) > workers * batch_size * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self._collect_saved_masks(pending, done)
+
+            self._collect_saved_masks(pending, wait(pending).done)
+
         logging.info("Segmentation inference complete.")
 
+    def _predict_batch_or_each(self, predictor_model: MultiModalPredictor, img_paths: List[str]) -> list:
+        """
+        Predicts a batch, the images of a failed batch are predicted one by one so one bad image does not drop the others
+
+        Returns:
+            list: (img_path, prediction) of the images that were predicted
+        """
+        try:
+            return list(zip(img_paths, self.predict_batch(predictor_model, img_paths)))
+        except Exception as e:
+            if len(img_paths) == 1:
+                logging.error(f"Error predicting image {os.path.basename(img_paths[0])}: {e}")
+                return []
+            logging.error(f"Error predicting images {img_paths[0]}..{img_paths[-1]}, predicting them one by one: {e}")
+        predicted = []
+        for img_path in img_paths:
+            try:
+                predicted.append((img_path, self.predict_batch(predictor_model, [img_path])[0]))
+            except Exception as e:
+                logging.error(f"Error predicting image {os.path.basename(img_path)}: {e}")
+        return predicted
+
+    @staticmethod
+    def _collect_saved_masks(pending: dict, done) -> None:
+        for future in done:
+            img_path = pending.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Error processing image {os.path.basename(img_path)}: {e}")
+
     def run_predict_with_erosion(self, dataset_id: int, kernel_size=3, iterations=1):
         """
         Performs segmentation inference with morphological erosion.
@@ -12,8 +12,10 @@ from pathlib import Path
 
 from common.models import DigitalAssistantBase
 from quantitave_analysis.models.config import Config  
+from quantitave_analysis.utils.parse_detection_results import image_size, read_result_rows
 
 CONFIDENCE_THRESHOLD = Config().CONFIDENCE_THRESHOLD
+NEAREST_COLOR_CHUNK = 65536  # Colors matched against the palette at a time when there is no exact match
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -68,6 +70,62 @@ class ConvertorBboxJson2Csv:
                         image_name, ann['image_width'], ann['image_height']
                     ])
 
+def _pack_rgb(colors: np.ndarray) -> np.ndarray:
+    """Pack RGB colors into 24-bit integer keys"""
+    colors = colors.astype(np.int64)
+    return (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+
+
+def _nearest_colors(colors: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """
+    Index of the nearest palette color by squared Euclidean distance, the first one on ties
+
+    The distances are computed for NEAREST_COLOR_CHUNK colors at a time, so memory stays bounded.
+    """
+    colors = colors.astype(np.int64)
+    palette = palette.astype(np.int64).reshape(1, -1, 3)
+    nearest = np.empty(len(colors), dtype=np.int64)
+    for start in range(0, len(colors), NEAREST_COLOR_CHUNK):
+        chunk = colors[start:start + NEAREST_COLOR_CHUNK].reshape(-1, 1, 3)
+        distances = np.sum((chunk - palette) ** 2, axis=2)
+        nearest[start:start + NEAREST_COLOR_CHUNK] = np.argmin(distances, axis=1)
+    return nearest
+
+
+def nearest_palette_indices(pixels: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """
+    Index of the nearest palette color for every pixel
+
+    Pixels that are exactly a palette color, nearly all pixels of a mask, are looked up by
+    their packed 24-bit key. The remaining pixels are reduced to their distinct colors, which
+    are matched by distance in bounded chunks. The result equals the argmin over the full
+    pixel-to-palette distance matrix.
+
+    Args:
+        pixels: RGB pixels, shape (N, 3)
+        palette: RGB palette colors, shape (P, 3)
+
+    Returns:
+        Palette indices, shape (N,)
+    """
+    if not np.issubdtype(pixels.dtype, np.integer) or (len(pixels) and (pixels.min() < 0 or pixels.max() > 255)):
+        return _nearest_colors(pixels, palette)
+
+    keys = _pack_rgb(pixels)
+    # np.unique keeps the first index of a color listed twice, as argmin does
+    palette_keys, palette_indices = np.unique(_pack_rgb(palette), return_index=True)
+    positions = np.minimum(np.searchsorted(palette_keys, keys), len(palette_keys) - 1)
+    matched = palette_keys[positions] == keys
+
+    indices = np.empty(len(keys), dtype=np.int64)
+    indices[matched] = palette_indices[positions[matched]]
+    if not matched.all():
+        other_keys, inverse = np.unique(keys[~matched], return_inverse=True)
+        other_colors = np.stack([(other_keys >> 16) & 255, (other_keys >> 8) & 255, other_keys & 255], axis=1)
+        indices[~matched] = _nearest_colors(other_colors, palette)[inverse.reshape(-1)]
+    return indices
+
+
 class ConvertorRgb2Palette(ConversionOperationBase):
     def save_image_to_palette(
             self,
@@ -113,16 +171,8 @@ class ConvertorRgb2Palette(ConversionOperationBase):
         # Taking the RGB channels of the image
         rgb_pixels = img_arr[:, :, :3].reshape(-1, 3)
 
-        # Calculating the distance matrix from each pixel to each color in the palette
-        # Transforming the data shape for broadcasting operations
-        pixels_expanded = rgb_pixels.reshape(-1, 1, 3)
-        palette_expanded = palette_np.reshape(1, -1, 3)
-
-        # Calculating the square of the Euclidean distance
-        distances = np.sum((pixels_expanded - palette_expanded) ** 2, axis=2)
-
         # Finding the index of the closest color for each pixel
-        nearest_indices = np.argmin(distances, axis=1)
+        nearest_indices = nearest_palette_indices(rgb_pixels, palette_np)
 
         # Convert it back to image form
         palette_image = nearest_indices.reshape(height, width)
@@ -134,7 +184,50 @@ class ConvertorRgb2Palette(ConversionOperationBase):
         )
 
 
+def palette_lookup_table(palette: List[List[int]]) -> np.ndarray:
+    """
+    RGBA color of every palette index, index 0 is transparent
+
+    The extra last row is transparent black, used for class ids outside of the palette.
+    """
+    lut = np.zeros((len(palette) + 1, 4), dtype=np.uint8)
+    lut[:len(palette), :3] = palette
+    lut[1:len(palette), 3] = 255
+    return lut
+
+
+def _valid_class_ids(class_ids: np.ndarray, palette_size: int) -> np.ndarray:
+    """Pixels whose class id is an index of the palette"""
+    valid = (class_ids >= 0) & (class_ids < palette_size)
+    if not np.issubdtype(class_ids.dtype, np.integer):
+        # Fractional values match no palette index
+        valid &= class_ids == np.floor(class_ids)
+    return valid
+
+
+def class_ids_to_rgba(class_ids: np.ndarray, palette: List[List[int]]) -> np.ndarray:
+    """
+    Expand a class-id mask to RGBA in one pass by indexing the palette lookup table
+
+    Args:
+        class_ids: Class id of every pixel, shape (H, W)
+        palette: RGB colors, index 0 is the background
+
+    Returns:
+        RGBA image, shape (H, W, 4), ids outside of the palette are transparent black
+    """
+    class_ids = np.asarray(class_ids)
+    lut = palette_lookup_table(palette)
+    valid = _valid_class_ids(class_ids, len(palette))
+    if valid.all():
+        return lut[class_ids.astype(np.intp)]
+    return lut[np.where(valid, class_ids, len(palette)).astype(np.intp)]
+
+
 class ConvertorPalette2Rgba(ConversionOperationBase):
+    # Save the class ids as a palette image with a transparent background instead of expanding them to RGBA
+    palette_output: bool = False
+
     def execute(self):
         # Get the values and turn them into a list
         colors_list = list(self.label_properties.values())
@@ -143,31 +236,48 @@ class ConvertorPalette2Rgba(ConversionOperationBase):
         for i in range(len(colors_list)):
             palette.append(ConvertorHex2Rgb.hex_to_rgb(colors_list[i]))
 
-        # Uploading an image with indices
-        palette_arr = self.image_array
-
         # Getting rid of the extra dimension (taking the first layer)
-        palette_arr = palette_arr[0]
-        height, width = palette_arr.shape
+        palette_arr = np.asarray(self.image_array)[0]
 
-        # Creating a new image with RGBA
-        rgba_image = np.zeros((height, width, 4), dtype=np.uint8)
-
-        # Making masks for each index in the palette
-        for index, color in enumerate(palette):
-            mask = (palette_arr == index)
-            # For the RGB channels (the first 3)
-            rgba_image[mask, :3] = color  # RGB components
-
-            # Setting the alpha channel (0 for index 0, 255 for the others)
-            rgba_image[mask, 3] = 0 if index == 0 else 255
+        if self.palette_output:
+            self.save_palette_image(palette_arr, palette)
+            return
 
         # Creating an image from an array
-        rgba_image_pil = Image.fromarray(rgba_image, mode='RGBA')
+        rgba_image_pil = Image.fromarray(class_ids_to_rgba(palette_arr, palette), mode='RGBA')
 
         # Saving the new image
         rgba_image_pil.save(self.output)
 
+    def save_palette_image(self, class_ids: np.ndarray, palette: List[List[int]]) -> None:
+        """Save the class ids as an indexed PNG, or a lossless WebP, with index 0 transparent"""
+        if len(palette) > 256:
+            raise ValueError(f"Palette images hold at most 256 colors, got {len(palette)}")
+        # Ids outside of the palette get an extra transparent black entry, as in the RGBA output
+        outside = len(palette) if len(palette) < 256 else 0
+        indices = np.where(_valid_class_ids(class_ids, len(palette)), class_ids, outside).astype(np.uint8)
+
+        image = Image.fromarray(indices).convert("P")
+        image.putpalette([value for color in palette + [[0, 0, 0]] for value in color])
+        alpha = bytes([0] + [255] * (len(palette) - 1) + [0])
+        if str(self.output).lower().endswith('.webp'):
+            image.info['transparency'] = alpha
+            image.convert('RGBA').save(self.output, 'WEBP', lossless=True)
+        else:
+            image.save(self.output, transparency=alpha)
+
+
+def save_rgba_mask(label_properties: Optional[dict], output: str, image_array: np.ndarray,
+                   palette_output: bool = False) -> str:
+    """
+    Write a predicted class-id mask as an RGBA PNG, or as a palette image if palette_output is set
+
+    A top-level function, so it can run in a process pool.
+    """
+    ConvertorPalette2Rgba(label_properties=label_properties, output=output, image_array=image_array,
+                          palette_output=palette_output).execute()
+    return output
+
 class ConvertorHex2Rgb(ConversionOperationBase):
     def hex_to_rgb(hex_color):
             """Convert hex color string to RGB tuple"""
@@ -253,44 +363,27 @@ class ConvertorPng2Webp(ConversionOperationBase):
 
 class ConvertorTxt2BboxJson(ConversionOperationBase):
     def parse_result_txt(self):
-        with open(self.input, "r") as file:
-            lines = file.readlines()
-
         if not os.path.exists(self.input):
             raise FileNotFoundError(f"{self.input} not found.")
-        
-        # Skip the header
-        rows = lines[1:]
 
         results = []
-        for i in range(len(rows)):
-            image_path, bboxes_str = rows[i].split(",", 1)
-            image = cv2.imread(image_path)
-            width, height = image.shape[1], image.shape[0]
-            image_name = os.path.basename(image_path.strip())
-
-            # Convert the bounding boxes string to a Python list
-            bboxes = eval(bboxes_str.strip())
-
-            bboxes = "{ '" + image_name +"': " + bboxes + '}'
-            bboxes = bboxes.replace("'", '"')
-
-            bboxes = json.loads(bboxes)
+        for image_path, bboxes in read_result_rows(self.input):
+            width, height = image_size(image_path)
+            image_name = os.path.basename(image_path)
 
             detections = []
-            for bbox in bboxes:
-                for elems in bboxes[bbox]: 
-                    if elems["score"] > CONFIDENCE_THRESHOLD:
-                        detections.append({
-                            "label_name": elems["class"],
-                            "bbox_x": elems["bbox"][0],
-                            "bbox_y": elems["bbox"][1],
-                            "bbox_width": elems["bbox"][2] - elems["bbox"][0],
-                            "bbox_height": elems["bbox"][3] - elems["bbox"][1],
-                            #"image_name": image_name,
-                            "image_width": width,
-                            "image_height": height,
-                        })
+            for elems in bboxes:
+                if elems["score"] > CONFIDENCE_THRESHOLD:
+                    detections.append({
+                        "label_name": elems["class"],
+                        "bbox_x": elems["bbox"][0],
+                        "bbox_y": elems["bbox"][1],
+                        "bbox_width": elems["bbox"][2] - elems["bbox"][0],
+                        "bbox_height": elems["bbox"][3] - elems["bbox"][1],
+                        #"image_name": image_name,
+                        "image_width": width,
+                        "image_height": height,
+                    })
 
             results.append({
                 image_name[:-4]: detections
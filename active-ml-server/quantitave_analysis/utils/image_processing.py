@@ -13,9 +13,9 @@ PROCESSED_FOLDER = Config().PROCESSED_FOLDER
 
 
 class SegmentataionMaskSaver():
-    def __init__(self):
-        self.images_path = os.path.join(PROCESSED_FOLDER, SEG_IMAGES_AFTER_AUG)
-        self.masks_path = os.path.join(PROCESSED_FOLDER, SEG_MASKS_AFTER_AUG)
+    def __init__(self, processed_folder: str = PROCESSED_FOLDER):
+        self.images_path = os.path.join(processed_folder, SEG_IMAGES_AFTER_AUG)
+        self.masks_path = os.path.join(processed_folder, SEG_MASKS_AFTER_AUG)
 
     def save_image(self, image: np.ndarray, base_name: str, idx: int) -> str:
         path = os.path.join(self.images_path, f'{base_name}{idx}.png')
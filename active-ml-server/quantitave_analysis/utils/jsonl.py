@@ -0,0 +1,63 @@
+import os
+import json
+import logging
+import threading
+from typing import Any, Dict, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class JsonlWriter:
+    """
+    Append-only JSON Lines file, one object per line.
+
+    Every line is flushed when it is written, so the lines written before a crash
+    stay readable and at most the last line is incomplete.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self) -> "JsonlWriter":
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def write(self, item: Dict[str, Any]) -> None:
+        line = json.dumps(item) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def iter_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read a JSON Lines file one object at a time
+
+    A line that can not be parsed, the tail of an interrupted write, is skipped.
+
+    Args:
+        path: Path to the file
+
+    Yields:
+        Objects of the file in order
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Skipping unreadable line {line_number} of {path}: {e}")
@@ -1,49 +1,64 @@
 import os
+import csv
+import ast
 import json
-import cv2
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, List, Tuple
+
+from PIL import Image
 
 from quantitave_analysis.models.config import Config
 CONFIDENCE_THRESHOLD = Config().CONFIDENCE_THRESHOLD
 from quantitave_analysis.utils.temporary_storage import TemporaryStorageManager
 
-def parse_result_txt(txt_path: str) -> Dict[str, Any]:
-    with open(txt_path, "r") as file:
-        lines = file.readlines()
 
-    header = lines[0].strip()
-    rows = lines[1:]
+def image_size(image_path: str) -> Tuple[int, int]:
+    """(width, height) of the image, read from the file header without decoding the pixels"""
+    with Image.open(image_path) as image:
+        return image.size
 
-    results = []
-    for i in range(len(rows)):
-    #for row in rows:
-        #image_path, bboxes_str = row.split(",", 1)
-        image_path, bboxes_str = rows[i].split(",", 1)
-        image = cv2.imread(image_path)
-        width, height = image.shape[1], image.shape[0]
-        image_name = os.path.basename(image_path.strip())
 
-        bboxes = eval(bboxes_str.strip())
+def read_result_rows(txt_path: str) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Rows of a result.txt written by the detection predictor
+
+    Args:
+        txt_path: Path to result.txt, a CSV with the columns image and bboxes
 
-        bboxes = "{ '" + image_name +"': " + bboxes + '}'
-        bboxes = bboxes.replace("'", '"')
+    Yields:
+        (image_path, boxes), boxes are dicts with "class", "bbox" as [x1, y1, x2, y2] and "score"
+    """
+    with open(txt_path, "r", newline="") as file:
+        reader = csv.reader(file)
+        # Skip the header
+        next(reader, None)
+        for row in reader:
+            if len(row) < 2:
+                continue
+            image_path, bboxes_str = row[0].strip(), row[1].strip()
+            # The boxes are written as a Python literal, literal_eval parses it without running code
+            bboxes = ast.literal_eval(bboxes_str) if bboxes_str else []
+            yield image_path, bboxes
 
-        bboxes = json.loads(bboxes)
+
+def parse_result_txt(txt_path: str) -> Dict[str, Any]:
+    results = []
+    for image_path, bboxes in read_result_rows(txt_path):
+        width, height = image_size(image_path)
+        image_name = os.path.basename(image_path)
 
         detections = []
-        for bbox in bboxes:
-            for elems in bboxes[bbox]: 
-                if elems["score"] > CONFIDENCE_THRESHOLD:
-                    detections.append({
-                        "label_name": elems["class"],
-                        "bbox_x": elems["bbox"][0],
-                        "bbox_y": elems["bbox"][1],
-                        "bbox_width": elems["bbox"][2] - elems["bbox"][0],
-                        "bbox_height": elems["bbox"][3] - elems["bbox"][1],
-                        "image_name": image_name,
-                        "image_width": width,
-                        "image_height": height,
-                    })
+        for elems in bboxes:
+            if elems["score"] > CONFIDENCE_THRESHOLD:
+                detections.append({
+                    "label_name": elems["class"],
+                    "bbox_x": elems["bbox"][0],
+                    "bbox_y": elems["bbox"][1],
+                    "bbox_width": elems["bbox"][2] - elems["bbox"][0],
+                    "bbox_height": elems["bbox"][3] - elems["bbox"][1],
+                    "image_name": image_name,
+                    "image_width": width,
+                    "image_height": height,
+                })
 
         results.append({
             image_name[:-4]: detections
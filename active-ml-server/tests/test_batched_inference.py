@@ -0,0 +1,154 @@
+"""
+Batched inference with a stub predictor, runs on CPU without a trained model.
+
+Run from active-ml-server: python -m unittest discover tests
+"""
+import os
+import json
+import queue
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    from PIL import Image
+    from quantitave_analysis.models.detection.detection_config import DetectionModelConfig
+    from quantitave_analysis.models.detection.dino_data_processor import DinoDataProcessor
+    from ML_server.ml_routines.base import MLRoutinesBase
+    from ML_server.pipeline import StreamingInferencePipeline, _END
+except ImportError as e:
+    IMPORT_ERROR = e
+else:
+    IMPORT_ERROR = None
+
+
+class StubPredictor:
+    """Answers predict(manifest_path) with one box per image and records the manifests"""
+
+    def __init__(self):
+        self.manifests = []
+
+    def predict(self, manifest_path, as_pandas=True, save_results=False):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.manifests.append(manifest)
+        return [
+            {"image": image["file_name"], "bboxes": [{"class": "a0", "bbox": [1, 2, 11, 22], "score": 0.9}]}
+            for image in manifest["images"]
+        ]
+
+
+class StubImage:
+    def __init__(self, filename):
+        self.filename = filename
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+@unittest.skipIf(IMPORT_ERROR is not None, f"ML server dependencies are not installed: {IMPORT_ERROR}")
+class DetectionPredictBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.model_dir = os.path.join(self.tmp.name, 'model')
+        self.results_folder = os.path.join(self.tmp.name, 'results')
+        os.makedirs(self.model_dir)
+        with open(os.path.join(self.model_dir, 'class_mapping.json'), 'w') as f:
+            json.dump({"forward": {"cell": "a0"}, "reverse": {"a0": "cell"}}, f)
+        self.image_paths = []
+        for i in range(5):
+            image_path = os.path.join(self.tmp.name, f'image_{i}.png')
+            Image.new('RGB', (64, 48)).save(image_path)
+            self.image_paths.append(image_path)
+        self.processor = DinoDataProcessor(
+            model_handler_config=DetectionModelConfig(results_folder=self.results_folder)
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_one_predictor_call_per_batch(self):
+        predictor = StubPredictor()
+        results = self.processor.predict_batch(predictor, self.model_dir, self.image_paths)
+
+        self.assertEqual(len(predictor.manifests), 1)
+        self.assertEqual([image["file_name"] for image in predictor.manifests[0]["images"]], self.image_paths)
+        self.assertEqual(sorted(results), [f'image_{i}' for i in range(5)])
+        # The manifest is removed and nothing else is left in the results folder
+        self.assertEqual(os.listdir(self.results_folder), [])
+
+    def test_chunks_of_batch_size(self):
+        predictor = StubPredictor()
+        chunks = list(self.processor.predict_images(predictor, self.model_dir, self.image_paths, batch_size=2))
+
+        self.assertEqual([len(manifest["images"]) for manifest in predictor.manifests], [2, 2, 1])
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
+
+@unittest.skipIf(IMPORT_ERROR is not None, f"ML server dependencies are not installed: {IMPORT_ERROR}")
+class StreamingPredictBatchTest(unittest.TestCase):
+
+    def make_routine(self, batch_size, fail_on=None):
+        class StubRoutine(MLRoutinesBase):
+            NEEDS_IMAGE_PATH = False
+            predict_batch_size = batch_size
+            create_dataset = train = predict = predict_image = None
+            batches = []
+            finished = False
+
+            def start_inference(self, input_folder, output_folder, dataset_id):
+                pass
+
+            def finish_inference(self):
+                self.finished = True
+
+            def predict_decoded_images(self, images):
+                self.batches.append([image.filename for image in images])
+                if fail_on is not None and len(images) > 1 and any(image.filename == fail_on for image in images):
+                    raise RuntimeError("bad image in batch")
+                if fail_on is not None and images[0].filename == fail_on:
+                    raise RuntimeError("bad image")
+                return [f"mask of {image.filename}" for image in images]
+
+        return StubRoutine()
+
+    def run_predict_stage(self, routine, count):
+        pipeline = StreamingInferencePipeline(mock.Mock(), routine, mock.Mock(), queue_size=count + 1)
+        images = [StubImage(f'{i}.png') for i in range(count)]
+        for i, image in enumerate(images):
+            pipeline._images.put((str(i), image))
+        pipeline._images.put(_END)
+
+        self.assertTrue(pipeline._predict_stage('upload', 'return', 1))
+        results = []
+        while True:
+            try:
+                results.append(pipeline._results.get_nowait())
+            except queue.Empty:
+                break
+        return pipeline, images, results
+
+    def test_ready_images_are_predicted_together(self):
+        routine = self.make_routine(batch_size=4)
+        pipeline, images, results = self.run_predict_stage(routine, 10)
+
+        self.assertEqual([len(batch) for batch in routine.batches], [4, 4, 2])
+        self.assertEqual([record_id for record_id, _, _ in results], [str(i) for i in range(10)])
+        self.assertEqual(pipeline.predicted, 10)
+        self.assertEqual(pipeline.failed, 0)
+        self.assertTrue(all(image.released for image in images))
+        self.assertTrue(routine.finished)
+
+    def test_failed_batch_is_retried_per_image(self):
+        routine = self.make_routine(batch_size=4, fail_on='2.png')
+        pipeline, _, results = self.run_predict_stage(routine, 4)
+
+        self.assertEqual([record_id for record_id, _, _ in results], ['0', '1', '3'])
+        self.assertEqual(pipeline.predicted, 3)
+        self.assertEqual(pipeline.failed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
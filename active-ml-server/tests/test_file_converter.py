@@ -0,0 +1,130 @@
+"""
+Palette conversions of masks against the plain NumPy versions they replaced.
+
+Run from active-ml-server: python -m unittest discover tests
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+try:
+    from PIL import Image
+    from quantitave_analysis.utils import file_converter
+    from quantitave_analysis.utils.file_converter import ConvertorPalette2Rgba, class_ids_to_rgba, nearest_palette_indices
+except ImportError as e:
+    IMPORT_ERROR = e
+else:
+    IMPORT_ERROR = None
+
+PALETTE = np.array([[0, 0, 0], [255, 0, 0], [20, 255, 0], [0, 0, 255], [255, 0, 0]])
+
+
+def reference_nearest_indices(pixels, palette):
+    """Argmin over the full pixel-to-palette distance matrix"""
+    distances = np.sum((pixels[:, np.newaxis, :].astype(np.int64) - palette[np.newaxis, :, :]) ** 2, axis=2)
+    return np.argmin(distances, axis=1)
+
+
+def reference_rgba(class_ids, palette):
+    """The per-index loop of ConvertorPalette2Rgba before the lookup table"""
+    rgba_image = np.zeros(class_ids.shape + (4,), dtype=np.uint8)
+    for index, color in enumerate(palette):
+        mask = class_ids == index
+        rgba_image[mask, :3] = color
+        rgba_image[mask, 3] = 0 if index == 0 else 255
+    return rgba_image
+
+
+def class_id_mask(seed, palette_size, shape=(37, 53)):
+    """Class ids of the palette with a few ids outside of it"""
+    rng = np.random.default_rng(seed)
+    return rng.integers(-1, palette_size + 2, shape)
+
+
+def mask_pixels(seed, count=5000):
+    """Mostly exact palette colors, the rest antialiased edges and noise"""
+    rng = np.random.default_rng(seed)
+    pixels = PALETTE[rng.integers(0, len(PALETTE), count)].copy()
+    noisy = rng.random(count) < 0.2
+    pixels[noisy] = rng.integers(0, 256, (noisy.sum(), 3))
+    return pixels.astype(np.uint8)
+
+
+@unittest.skipIf(IMPORT_ERROR is not None, f"Image dependencies are not installed: {IMPORT_ERROR}")
+class NearestPaletteIndicesTest(unittest.TestCase):
+
+    def test_matches_full_argmin(self):
+        for seed in range(3):
+            pixels = mask_pixels(seed)
+            with self.subTest(seed=seed):
+                np.testing.assert_array_equal(nearest_palette_indices(pixels, PALETTE),
+                                              reference_nearest_indices(pixels, PALETTE))
+
+    def test_matches_full_argmin_in_small_chunks(self):
+        pixels = mask_pixels(3)
+        with mock.patch.object(file_converter, 'NEAREST_COLOR_CHUNK', 7):
+            np.testing.assert_array_equal(nearest_palette_indices(pixels, PALETTE),
+                                          reference_nearest_indices(pixels, PALETTE))
+
+    def test_duplicate_palette_color_takes_first_index(self):
+        pixels = np.array([[255, 0, 0], [250, 3, 1]], dtype=np.uint8)
+        np.testing.assert_array_equal(nearest_palette_indices(pixels, PALETTE), [1, 1])
+
+    def test_non_integer_pixels(self):
+        pixels = mask_pixels(4, count=500).astype(np.float64) + 0.25
+        np.testing.assert_array_equal(nearest_palette_indices(pixels, PALETTE),
+                                      reference_nearest_indices(pixels, PALETTE))
+
+    def test_empty(self):
+        self.assertEqual(len(nearest_palette_indices(np.empty((0, 3), dtype=np.uint8), PALETTE)), 0)
+
+
+@unittest.skipIf(IMPORT_ERROR is not None, f"Image dependencies are not installed: {IMPORT_ERROR}")
+class PaletteToRgbaTest(unittest.TestCase):
+    palette = [[0, 0, 0], [255, 0, 0], [20, 255, 0], [0, 0, 255]]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_class_ids_to_rgba_matches_loop(self):
+        for seed in range(3):
+            class_ids = class_id_mask(seed, len(self.palette))
+            with self.subTest(seed=seed):
+                np.testing.assert_array_equal(class_ids_to_rgba(class_ids, self.palette),
+                                              reference_rgba(class_ids, self.palette))
+
+    def test_class_ids_inside_palette(self):
+        class_ids = np.random.default_rng(3).integers(0, len(self.palette), (16, 16)).astype(np.uint8)
+        np.testing.assert_array_equal(class_ids_to_rgba(class_ids, self.palette),
+                                      reference_rgba(class_ids, self.palette))
+
+    def test_fractional_class_ids(self):
+        class_ids = np.array([[0.0, 1.0, 1.5], [2.0, 3.0, 2.5]])
+        np.testing.assert_array_equal(class_ids_to_rgba(class_ids, self.palette),
+                                      reference_rgba(class_ids, self.palette))
+
+    def save_palette_image(self, class_ids, file_name):
+        output = os.path.join(self.tmp.name, file_name)
+        ConvertorPalette2Rgba(output=output, palette_output=True).save_palette_image(class_ids, self.palette)
+        with Image.open(output) as image:
+            return np.array(image.convert('RGBA'))
+
+    def test_palette_png_matches_loop(self):
+        class_ids = class_id_mask(4, len(self.palette))
+        np.testing.assert_array_equal(self.save_palette_image(class_ids, 'mask.png'),
+                                      reference_rgba(class_ids, self.palette))
+
+    def test_palette_webp_matches_loop(self):
+        class_ids = class_id_mask(5, len(self.palette))
+        np.testing.assert_array_equal(self.save_palette_image(class_ids, 'mask.webp'),
+                                      reference_rgba(class_ids, self.palette))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Vectorized overlap suppression against the pure-Python loop it replaced.
+
+Run from active-ml-server: python -m unittest discover tests
+"""
+import unittest
+
+try:
+    from quantitave_analysis.models.detection.nms import suppress_overlaps
+    from quantitave_analysis.models.detection.results_processor import (
+        INTERSECTION_THRESHOLD,
+        Rectangle,
+        filter_overlapping_rectangles,
+        is_touching_or_contained
+    )
+    from quantitave_analysis.models.detection.benchmark_nms import random_rectangles, reference_filter
+except ImportError as e:
+    IMPORT_ERROR = e
+else:
+    IMPORT_ERROR = None
+
+SEEDS = range(3)
+
+
+def class_aware_reference(rectangles):
+    """The loop of the reference, a box only suppresses boxes of its own class"""
+    rectangles = sorted(rectangles, key=lambda r: r.score, reverse=True)
+    keep = []
+    while rectangles:
+        current = rectangles.pop(0)
+        keep.append(current.detection)
+        rectangles = [rect for rect in rectangles
+                      if rect.detection["label_name"] != current.detection["label_name"]
+                      or not is_touching_or_contained(current, rect)]
+    return keep
+
+
+@unittest.skipIf(IMPORT_ERROR is not None, f"Detection dependencies are not installed: {IMPORT_ERROR}")
+class SuppressOverlapsTest(unittest.TestCase):
+
+    def suppress(self, rectangles, grid_min_boxes, class_aware=False):
+        keep = suppress_overlaps(
+            [(rect.x, rect.y, rect.width, rect.height) for rect in rectangles],
+            [rect.score for rect in rectangles],
+            INTERSECTION_THRESHOLD,
+            classes=[rect.detection["label_name"] for rect in rectangles] if class_aware else None,
+            grid_min_boxes=grid_min_boxes
+        )
+        return [rectangles[index].detection for index in keep]
+
+    def test_matches_reference(self):
+        for seed in SEEDS:
+            rectangles = random_rectangles(400, image_size=600, box_size=40, seed=seed)
+            expected = reference_filter(rectangles)
+            with self.subTest(seed=seed):
+                self.assertEqual(self.suppress(rectangles, grid_min_boxes=None), expected)
+
+    def test_grid_matches_reference(self):
+        for seed in SEEDS:
+            rectangles = random_rectangles(400, image_size=600, box_size=40, seed=seed)
+            expected = reference_filter(rectangles)
+            with self.subTest(seed=seed):
+                self.assertEqual(self.suppress(rectangles, grid_min_boxes=0), expected)
+
+    def test_class_aware_matches_reference(self):
+        for seed in SEEDS:
+            rectangles = random_rectangles(300, image_size=400, box_size=40, seed=seed)
+            for rect in rectangles:
+                rect.detection["label_name"] = f"class_{rect.detection['index'] % 3}"
+            expected = class_aware_reference(rectangles)
+            for grid_min_boxes in (None, 0):
+                with self.subTest(seed=seed, grid_min_boxes=grid_min_boxes):
+                    self.assertEqual(self.suppress(rectangles, grid_min_boxes, class_aware=True), expected)
+
+    def test_nested_and_equal_score_boxes(self):
+        rectangles = [
+            Rectangle(0, 0, 100, 100, 0.5, {"index": 0, "label_name": "a"}),
+            Rectangle(10, 10, 20, 20, 0.9, {"index": 1, "label_name": "a"}),  # Inside box 0
+            Rectangle(200, 200, 50, 50, 0.5, {"index": 2, "label_name": "a"}),
+            Rectangle(200, 200, 50, 50, 0.5, {"index": 3, "label_name": "a"}),  # Duplicate with the same score
+            Rectangle(300, 300, 10, 10, 0.1, {"index": 4, "label_name": "a"}),
+        ]
+        expected = reference_filter(rectangles)
+        self.assertEqual([detection["index"] for detection in expected], [1, 2, 4])
+        self.assertEqual(filter_overlapping_rectangles(rectangles, class_aware=False), expected)
+        self.assertEqual(self.suppress(rectangles, grid_min_boxes=0), expected)
+
+    def test_empty(self):
+        self.assertEqual(suppress_overlaps([], [], INTERSECTION_THRESHOLD), [])
+        self.assertEqual(filter_overlapping_rectangles([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
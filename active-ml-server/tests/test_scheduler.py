@@ -0,0 +1,100 @@
+"""
+Job scheduler slots and the concurrency cap, jobs are stubbed and run on threads.
+
+Run from active-ml-server: python -m unittest discover tests
+"""
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+try:
+    from common.models import ProcessingMode
+    from ML_server.scheduler import JobScheduler
+except ImportError as e:
+    IMPORT_ERROR = e
+else:
+    IMPORT_ERROR = None
+
+TIMEOUT = 5
+
+
+@unittest.skipIf(IMPORT_ERROR is not None, f"ML server dependencies are not installed: {IMPORT_ERROR}")
+class JobSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.release = threading.Event()
+        self.started = []
+        self.lock = threading.Lock()
+        self.both_running = threading.Barrier(2, timeout=TIMEOUT)
+
+    def tearDown(self):
+        self.release.set()
+        self.tmp.cleanup()
+
+    def run_job(self, task_package, slot):
+        with self.lock:
+            self.started.append((task_package.package_id, slot.name))
+        self.release.wait(TIMEOUT)
+
+    def make_scheduler(self, slots_per_mode, max_concurrent_jobs, job_runner=None):
+        scheduler = JobScheduler(job_runner or self.run_job, slots_per_mode,
+                                 workspace_root=self.tmp.name, max_concurrent_jobs=max_concurrent_jobs)
+        scheduler.start()
+        return scheduler
+
+    @staticmethod
+    def wait_idle(scheduler, modes):
+        """Wait until no package is queued or running"""
+        deadline = time.monotonic() + TIMEOUT
+        while any(scheduler.free_capacity(mode) == 0 for mode in modes) or any(scheduler.active_tasks().values()):
+            if time.monotonic() > deadline:
+                raise AssertionError("Scheduler did not finish its packages")
+            time.sleep(0.01)
+
+    @staticmethod
+    def package(package_id, mode):
+        return SimpleNamespace(package_id=package_id, mode=mode)
+
+    def test_two_slots_run_concurrently_when_configured(self):
+        def run_job(task_package, slot):
+            # Both jobs have to be running at once to pass the barrier
+            self.both_running.wait()
+            self.run_job(task_package, slot)
+
+        scheduler = self.make_scheduler({ProcessingMode.SEGMENTATION: 1, ProcessingMode.DETECTION: 1},
+                                        max_concurrent_jobs=2, job_runner=run_job)
+        self.assertTrue(scheduler.submit(self.package(1, ProcessingMode.SEGMENTATION)))
+        self.assertTrue(scheduler.submit(self.package(2, ProcessingMode.DETECTION)))
+
+        self.release.set()
+        self.wait_idle(scheduler, [ProcessingMode.SEGMENTATION, ProcessingMode.DETECTION])
+        self.assertFalse(self.both_running.broken)
+        self.assertEqual(sorted(self.started), [(1, 'segmentation_0'), (2, 'detection_0')])
+
+    def test_two_slots_of_one_mode(self):
+        scheduler = self.make_scheduler({ProcessingMode.SEGMENTATION: 2}, max_concurrent_jobs=None)
+
+        self.assertTrue(scheduler.submit(self.package(1, ProcessingMode.SEGMENTATION)))
+        self.assertEqual(scheduler.free_capacity(ProcessingMode.SEGMENTATION), 1)
+        self.assertTrue(scheduler.submit(self.package(2, ProcessingMode.SEGMENTATION)))
+        self.assertEqual(scheduler.free_capacity(ProcessingMode.SEGMENTATION), 0)
+        self.assertFalse(scheduler.submit(self.package(3, ProcessingMode.SEGMENTATION)))
+
+    def test_cap_holds_back_other_modes(self):
+        scheduler = self.make_scheduler({ProcessingMode.SEGMENTATION: 1, ProcessingMode.DETECTION: 1},
+                                        max_concurrent_jobs=1)
+
+        self.assertTrue(scheduler.submit(self.package(1, ProcessingMode.SEGMENTATION)))
+        self.assertEqual(scheduler.accepting_modes(), [])
+        self.assertFalse(scheduler.submit(self.package(2, ProcessingMode.DETECTION)))
+
+        self.release.set()
+        self.assertTrue(scheduler.wait_for_capacity(TIMEOUT))
+        self.assertTrue(scheduler.submit(self.package(2, ProcessingMode.DETECTION)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -192,6 +192,17 @@ CELERY_RESULT_BACKEND = 'django-db'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+CELERY_BEAT_SCHEDULE = {
+    'requeue-expired-packages': {
+        'task': 'network.tasks.requeue_expired_packages',
+        'schedule': 60.0,
+    },
+}
+
+PACKAGE_LEASE_SECONDS = env.int('PACKAGE_LEASE_SECONDS', default=120)
+PACKAGE_WAIT_TIMEOUT = env.int('PACKAGE_WAIT_TIMEOUT', default=25)
+PACKAGE_MAX_ATTEMPTS = env.int('PACKAGE_MAX_ATTEMPTS', default=3)  # Failed runs before a package is FAILED
+PACKAGE_RETRY_BACKOFF_SECONDS = env.int('PACKAGE_RETRY_BACKOFF_SECONDS', default=60)  # Doubled after every failed run
 
 
 if USE_CLOUD:
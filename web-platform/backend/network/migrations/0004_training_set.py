@@ -0,0 +1,27 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0003_package_delta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrainingSet',
+            fields=[
+                ('training_set_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('mode', models.CharField(max_length=255)),
+                ('watermark', models.DateTimeField()),
+                ('record_ids', models.JSONField(default=list)),
+                ('dataset_id', models.ForeignKey(db_column='dataset_id', on_delete=django.db.models.deletion.CASCADE, to='network.datasets')),
+                ('user_id', models.ForeignKey(db_column='user_id', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user_id', 'dataset_id', 'mode')},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0004_training_set'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='package',
+            name='retry_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
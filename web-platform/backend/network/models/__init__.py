@@ -9,6 +9,6 @@ from .taxonomy import Species, Sex, Object_Metadata
 from .localization import Localization, Diagnosis
 from .records import Records, Segmentation, Detection, record_metadata_dynamic_path, record_metrics_path
 from .assets_metadata import Assets_Metadata_Dynamic, record_dynamic_path
-from .packages import Package, package_path
+from .packages import Package, TrainingSet, package_path
 from .downloads import UploadTransfer, archive_path, DownloadDataset
 from .paths import *
@@ -1,5 +1,7 @@
 import os
+from datetime import timedelta
 from django.db import models
+from django.utils import timezone
 from .users import Users
 from .datasets import Datasets
 
@@ -28,6 +30,48 @@ class Package(models.Model):
     dataset_id = models.ForeignKey(Datasets, on_delete=models.CASCADE, db_column='dataset_id')
     package = models.FileField(upload_to=package_path, null=True, blank=True)
     label_properties = models.FileField(upload_to=record_label_path, null=True, blank=True)
+    lease_owner = models.CharField(max_length=255, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    since = models.DateTimeField(null=True, blank=True)
+    watermark = models.DateTimeField(null=True, blank=True)
+    # Failed runs of the package, it is not claimed again before retry_after
+    attempts = models.PositiveIntegerField(default=0)
+    retry_after = models.DateTimeField(null=True, blank=True)
+
+    def release_lease(self):
+        self.lease_owner = None
+        self.lease_expires_at = None
+
+    def record_failed_attempt(self, max_attempts, backoff_seconds):
+        """Requeue the package after a failed run with a doubling delay, or mark it FAILED after max_attempts"""
+        self.attempts += 1
+        if self.attempts >= max_attempts:
+            self.package_status = 'FAILED'
+            self.retry_after = None
+        else:
+            self.package_status = 'CREATED'
+            self.retry_after = timezone.now() + timedelta(seconds=backoff_seconds * 2 ** (self.attempts - 1))
 
     def __str__(self):
         return str(self.package_id)
+
+
+class TrainingSet(models.Model):
+    """
+    Watermark and record IDs of the last finished training package of a dataset.
+
+    Kept apart from Package: the package row of a user and dataset is reused by every
+    request, so an inference package would otherwise reset the base of the next delta.
+    """
+    training_set_id = models.BigAutoField(primary_key=True)
+    user_id = models.ForeignKey(Users, on_delete=models.CASCADE, db_column='user_id')
+    dataset_id = models.ForeignKey(Datasets, on_delete=models.CASCADE, db_column='dataset_id')
+    mode = models.CharField(max_length=255)
+    watermark = models.DateTimeField()
+    record_ids = models.JSONField(default=list)
+
+    class Meta:
+        unique_together = ('user_id', 'dataset_id', 'mode')
+
+    def __str__(self):
+        return f"{self.dataset_id_id} {self.mode}"
@@ -49,6 +49,7 @@ class Records(models.Model):
     validation_bbox_flag = models.BooleanField(default=False)
     description_mask = models.JSONField(null=True, blank=True)
     description_bbox = models.JSONField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return str(self.record_id)
@@ -59,6 +60,7 @@ class Record_Metadata_Dynamic(models.Model):
     processing_type_id = models.ForeignKey(Processing_Types, on_delete=models.CASCADE, db_column='processing_type_id', null=True, blank=True)
     record_id = models.OneToOneField("Records", on_delete=models.CASCADE, null=True, blank=True, db_column='record_id' )
     metrics = models.FileField(upload_to=record_metrics_path, null=True, blank=True, max_length=500)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         abstract = True
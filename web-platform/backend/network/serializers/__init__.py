@@ -634,16 +634,32 @@ class ProcessedFilesViewSerializer(serializers.ModelSerializer):
       
 class PackageSerializer(serializers.ModelSerializer):
     dataset_id = serializers.PrimaryKeyRelatedField(queryset=Datasets.objects.all(), required=False) 
+    # A training package holds only the records changed since the last finished training package
+    incremental = serializers.BooleanField(write_only=True, required=False, default=False)
     class Meta:
         model = Package
-        fields = ['package_id', 'mode', 'package' , 'package_status', 'user_id', 'task', 'label_properties', 'dataset_id']
-        read_only_fields = ['package', 'package_status', 'user_id', 'label_properties']
+        fields = ['package_id', 'mode', 'package' , 'package_status', 'user_id', 'task', 'label_properties', 'dataset_id', 'lease_owner', 'lease_expires_at', 'since', 'watermark', 'incremental']
+        read_only_fields = ['package', 'package_status', 'user_id', 'label_properties', 'lease_owner', 'lease_expires_at', 'since', 'watermark']
 
 class PackageStatusSerializer(serializers.ModelSerializer):
+    # Only the worker holding the lease may finish or release the package
+    worker = serializers.CharField(max_length=255, write_only=True)
+    # CREATED from a worker is a failed run unless the worker gives the package back without running it
+    released = serializers.BooleanField(default=False, write_only=True)
 
     class Meta:
         model = Package
-        fields = ['package_id', 'package_status']
+        fields = ['package_id', 'package_status', 'worker', 'released', 'attempts']
+        read_only_fields = ['attempts']
+
+class PackageClaimSerializer(serializers.Serializer):
+    modes = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+    worker = serializers.CharField(max_length=255)
+    lease_seconds = serializers.IntegerField(min_value=1, required=False)
+
+class PackageHeartbeatSerializer(serializers.Serializer):
+    worker = serializers.CharField(max_length=255)
+    lease_seconds = serializers.IntegerField(min_value=1, required=False)
         
 class BatchUploadMetadataDynamicSerializer(serializers.ModelSerializer):
     
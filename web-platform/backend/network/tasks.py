@@ -1,5 +1,7 @@
 import io
 from django.utils import timezone
+from django.db import transaction
+from django.conf import settings
 from celery import shared_task, group, chain
 from .models import Datasets, Access_Policies, DownloadDataset, Access_Types, Access_Group_Linkage, Group_User_Linkage, Groups, Users, Roles, Scaling_Value, Device_Type, Metadata_Static, Assets, Records, Species, Diagnosis, Assets_Metadata_Dynamic, Localization, Object_Metadata, Package, Sex, Segmentation, Detection
 from .serializers import AccessTypesSerializer, AssetsSerializer, CopyDatasetSerializer, DatasetsSerializer, DeviceTypeSerializer, MetadataStaticSerializer, MetadataDynamicSerializer, LocalizationSerializer, DiagnosisSerializer, RecordsCopySerializer, RecordsSerializer, ScalingValueSerializer, SexSerializer, SpeciesSerializer, ObjectMetadataSerializer
@@ -520,7 +522,7 @@ def update_asset_metrics(asset_id, inference):
                     metrics_bytes.write(json.dumps(metrics_data, indent=2).encode('utf-8'))
                     metrics_bytes.seek(0)
                     metrics_filename = f"{record_name}_bbox_metrics.json"
-                    detection.metrics.save(metrics_filename, ContentFile(metrics_bytes.read()))
+                    detection.metrics.save(metrics_filename, ContentFile(metrics_bytes.read()), save=False)
                     needs_save = True
                 
                 if metrics_data:
@@ -531,7 +533,8 @@ def update_asset_metrics(asset_id, inference):
                     
                     
                     if needs_save:
-                        detection.save()
+                        # Metrics are not an annotation change, updated_at is left alone
+                        detection.save(update_fields=['metrics'])
 
             segmentations = Segmentation.objects.filter(record_id=record.record_id)
             for segmentation in segmentations:
@@ -551,7 +554,7 @@ def update_asset_metrics(asset_id, inference):
                     metrics_bytes.write(json.dumps(metrics_data, indent=2).encode('utf-8'))
                     metrics_bytes.seek(0)
                     metrics_filename = f"{record_name}_mask_metrics.json"
-                    segmentation.metrics.save(metrics_filename, ContentFile(metrics_bytes.read()))
+                    segmentation.metrics.save(metrics_filename, ContentFile(metrics_bytes.read()), save=False)
                     needs_save = True
                 
                 if metrics_data:
@@ -562,7 +565,8 @@ def update_asset_metrics(asset_id, inference):
                     
                     
                     if needs_save:
-                        segmentation.save()
+                        # Metrics are not an annotation change, updated_at is left alone
+                        segmentation.save(update_fields=['metrics'])
 
         for label in asset_metrics['segmentation']['total_square']:
             asset_metrics['segmentation']['total_square'][label] = asset_metrics['segmentation']['total_square'][label] / asset_metrics['total_records']
@@ -827,4 +831,20 @@ def update_annotation_colors(dataset_id, old_color, new_color):
         
     except Exception as e:
     
-        return False
\ No newline at end of file
+        return False
+
+
+@shared_task
+def requeue_expired_packages():
+    """A lease that expired is a failed run, e.g. the worker crashed, the package is retried after a backoff"""
+    requeued = 0
+    with transaction.atomic():
+        expired = Package.objects.select_for_update(skip_locked=True).filter(
+            package_status='IN_PROGRESS', lease_expires_at__lt=timezone.now())
+        for package in expired:
+            package.release_lease()
+            package.record_failed_attempt(settings.PACKAGE_MAX_ATTEMPTS, settings.PACKAGE_RETRY_BACKOFF_SECONDS)
+            package.save(update_fields=['package_status', 'lease_owner', 'lease_expires_at', 'attempts', 'retry_after'])
+            if package.package_status == 'CREATED':
+                requeued += 1
+    return requeued
@@ -1 +1,124 @@
-from django.test import TestCase
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from .models import (
+    Access_Group_Linkage, Access_Policies, Access_Types, Datasets, Group_User_Linkage, Groups, Package, Roles, Users
+)
+from .tasks import requeue_expired_packages
+
+
+@override_settings(PACKAGE_MAX_ATTEMPTS=3, PACKAGE_RETRY_BACKOFF_SECONDS=60)
+class PackageLeaseTests(TestCase):
+    """Claiming, leasing and retrying packages by ML workers"""
+
+    def setUp(self):
+        self.user = Users.objects.create_user(username='worker', password='workerpass')
+        access_policy = Access_Policies.objects.create(
+            access_type_id=Access_Types.objects.create(access_type_name='Private'))
+        group = Groups.objects.create()
+        Access_Group_Linkage.objects.create(group_id=group, access_policy_id=access_policy)
+        Group_User_Linkage.objects.create(group_id=group, user_id=self.user,
+                                          role_id=Roles.objects.create(role_name='Admin'))
+        self.dataset = Datasets.objects.create(dataset_name='dataset', access_policy_id=access_policy)
+        self.package = Package.objects.create(mode='Segmentation', task='INFERENCE', package_status='CREATED',
+                                              user_id=self.user, dataset_id=self.dataset)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def claim(self, worker='worker-a'):
+        return self.client.post(reverse('package_claim'), {'modes': ['Segmentation'], 'worker': worker}, format='json')
+
+    def update_status(self, package_status, worker='worker-a', released=False):
+        return self.client.put(
+            reverse('package_status', args=[self.package.package_id]),
+            {'package_status': package_status, 'worker': worker, 'released': released},
+            format='json'
+        )
+
+    def test_claim_returns_package_once(self):
+        response = self.claim('worker-a')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['package_id'], self.package.package_id)
+        self.assertEqual(response.data['lease_owner'], 'worker-a')
+
+        self.assertEqual(self.claim('worker-b').status_code, status.HTTP_404_NOT_FOUND)
+        self.package.refresh_from_db()
+        self.assertEqual(self.package.package_status, 'IN_PROGRESS')
+        self.assertEqual(self.package.lease_owner, 'worker-a')
+
+    def test_status_update_from_other_worker_conflicts(self):
+        self.claim('worker-a')
+
+        response = self.update_status('DONE', worker='worker-b')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.package.refresh_from_db()
+        self.assertEqual(self.package.package_status, 'IN_PROGRESS')
+        self.assertEqual(self.package.lease_owner, 'worker-a')
+
+    def test_heartbeat_from_other_worker_conflicts(self):
+        self.claim('worker-a')
+        url = reverse('package_heartbeat', args=[self.package.package_id])
+
+        self.assertEqual(self.client.put(url, {'worker': 'worker-b'}, format='json').status_code,
+                         status.HTTP_409_CONFLICT)
+        self.assertEqual(self.client.put(url, {'worker': 'worker-a'}, format='json').status_code,
+                         status.HTTP_200_OK)
+
+    def test_released_package_is_not_a_failed_attempt(self):
+        self.claim('worker-a')
+
+        response = self.update_status('CREATED', released=True)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.package.refresh_from_db()
+        self.assertEqual(self.package.package_status, 'CREATED')
+        self.assertEqual(self.package.attempts, 0)
+        self.assertIsNone(self.package.retry_after)
+        self.assertIsNone(self.package.lease_owner)
+        self.assertEqual(self.claim('worker-b').status_code, status.HTTP_200_OK)
+
+    def test_failed_run_waits_for_backoff(self):
+        self.claim('worker-a')
+
+        self.update_status('CREATED')
+        self.package.refresh_from_db()
+        self.assertEqual(self.package.package_status, 'CREATED')
+        self.assertEqual(self.package.attempts, 1)
+        self.assertGreater(self.package.retry_after, timezone.now())
+        self.assertEqual(self.claim('worker-b').status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(PACKAGE_MAX_ATTEMPTS=2, PACKAGE_RETRY_BACKOFF_SECONDS=0)
+    def test_package_fails_after_max_attempts(self):
+        for attempt in range(1, 3):
+            self.assertEqual(self.claim('worker-a').status_code, status.HTTP_200_OK)
+            response = self.update_status('CREATED')
+            self.assertEqual(response.data['attempts'], attempt)
+
+        self.package.refresh_from_db()
+        self.assertEqual(self.package.package_status, 'FAILED')
+        self.assertIsNone(self.package.retry_after)
+        self.assertEqual(self.claim('worker-a').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_expired_lease_is_requeued(self):
+        self.claim('worker-a')
+        Package.objects.filter(pk=self.package.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(requeue_expired_packages(), 1)
+        self.package.refresh_from_db()
+        self.assertEqual(self.package.package_status, 'CREATED')
+        self.assertIsNone(self.package.lease_owner)
+        self.assertIsNone(self.package.lease_expires_at)
+        self.assertEqual(self.package.attempts, 1)
+        self.assertIsNotNone(self.package.retry_after)
+
+    def test_live_lease_is_not_requeued(self):
+        self.claim('worker-a')
+
+        self.assertEqual(requeue_expired_packages(), 0)
+        self.package.refresh_from_db()
+        self.assertEqual(self.package.package_status, 'IN_PROGRESS')
+        self.assertEqual(self.package.attempts, 0)
@@ -4,7 +4,7 @@ from .views import ProfileView, AssetUploadView
 router = DefaultRouter()
 
 
-from .views import DatasetsViewSet, AssetViewSet, AssetRecordsView, TransferCreateView,DatasetDownloadView,CopyDataset, FavoritesLabelsView, LabelsPropertiesView, DownloadStatusView, AssetDeleteViewSet,TransferProgressView,GroupUserView, RecordViewSet, ProcessedPackageView, Tables_Assets_And_Metadata_Dynamic_View, MetadataStaticView, AnnotationRecordViewSet, ValidationRecordViewSet, PackageStatusView,Tables_Dataset_And_Metadata_Static_View, DatasetStatusView, PackageGetViewSet, ValidationAssetViewSet, PackageViewSet, DatasetManagementViewSet
+from .views import DatasetsViewSet, AssetViewSet, AssetRecordsView, TransferCreateView,DatasetDownloadView,CopyDataset, FavoritesLabelsView, LabelsPropertiesView, DownloadStatusView, AssetDeleteViewSet,TransferProgressView,GroupUserView, RecordViewSet, ProcessedPackageView, Tables_Assets_And_Metadata_Dynamic_View, MetadataStaticView, AnnotationRecordViewSet, ValidationRecordViewSet, PackageStatusView,Tables_Dataset_And_Metadata_Static_View, DatasetStatusView, PackageGetViewSet, PackageClaimView, PackageHeartbeatView, package_wait_view, PackageArchiveView, PackageRecordsView, ValidationAssetViewSet, PackageViewSet, DatasetManagementViewSet
 router.register(r'datasets', DatasetsViewSet)
 
 router.register(r'datasets/(?P<dataset_id>[^/.]+)/assets', AssetViewSet, basename='dataset-assets')
@@ -26,6 +26,11 @@ urlpatterns = [
     path('package_status/<int:package_id>/', PackageStatusView.as_view(), name='package_status'),    
     path('status_mfdqofn19101f/', DatasetStatusView.as_view(), name='status'),
     path('package/', PackageGetViewSet.as_view(), name='package'),
+    path('package/claim/', PackageClaimView.as_view(), name='package_claim'),
+    path('package/wait/', package_wait_view, name='package_wait'),
+    path('package_heartbeat/<int:package_id>/', PackageHeartbeatView.as_view(), name='package_heartbeat'),
+    path('package_archive/<int:package_id>/', PackageArchiveView.as_view(), name='package_archive'),
+    path('package_records/<int:package_id>/', PackageRecordsView.as_view(), name='package_records'),
     path("tables/", Tables_Dataset_And_Metadata_Static_View.as_view(), name='tables'),
     path("assets/metadata/", Tables_Assets_And_Metadata_Dynamic_View.as_view(), name='tables'),
     path('dataset/metadata_static/<int:dataset_id>/', MetadataStaticView.as_view(), name='metadata_static'),
@@ -1,17 +1,20 @@
 import json
 import tempfile
+import tarfile
+import logging
 import os
 import numpy as np
 import requests
 from network.models import Assets, Records, Segmentation, Detection, Assets_Metadata_Dynamic
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
+from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 import os
 from django.core.files.storage import FileSystemStorage
 from django.core.files.storage import default_storage
 
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 def build_full_url(file_field, package=False):
     if not file_field:
         return None
@@ -199,6 +202,137 @@ def notify_dataset_status_change(dataset_id, status, message=""):
         }
     )
 
+PACKAGES_GROUP = 'packages'
+
+def notify_package_created(package_id, mode):
+    channel_layer = get_channel_layer()
+
+    async_to_sync(channel_layer.group_send)(
+        PACKAGES_GROUP,
+        {
+            'type': 'package_created',
+            'package_id': package_id,
+            'mode': mode
+        }
+    )
+
+def package_archive_member_name(url):
+    """Name of a package file in the package archive, the ML server maps it back to the URL"""
+    return urlparse(url).path.lstrip('/')
+
+
+def training_records(dataset, mode):
+    """Validated records of the dataset that have an annotation for the mode"""
+    validation_field = 'validation_mask_flag' if mode == 'Segmentation' else 'validation_bbox_flag'
+    related_field = 'segmentation' if mode == 'Segmentation' else 'detection'
+    return Records.objects.filter(
+        asset_id__dataset_id=dataset,
+        **{validation_field: True}
+    ).select_related(related_field).exclude(
+        **{f'{related_field}__isnull': True}
+    )
+
+
+def training_package_entries(records, mode):
+    """Package JSON entries of training records: the image and its annotation"""
+    related_field = 'segmentation' if mode == 'Segmentation' else 'detection'
+    return [
+        {record.record_id: [
+            build_full_url(record.record_link, False),
+            build_full_url(getattr(record, related_field).record_metadata_dynamic_link, False)
+        ]}
+        for record in records
+    ]
+
+
+def package_archive_files(package, records=None):
+    """
+    Files referenced by the package JSON, as (member name, field file) pairs.
+
+    Files are looked up through the records of the package, a file that was replaced
+    after the package had been created is left out and downloaded by URL instead.
+    records replaces the entries of the package JSON, used for the full training set
+    behind an incremental package.
+    """
+    if records is None:
+        with package.package.open('rb') as package_file:
+            records = json.load(package_file).get('records', [])
+
+    wanted = {}
+    for record in records:
+        for record_id, urls in record.items():
+            for url in urls:
+                if url:
+                    wanted[package_archive_member_name(url)] = int(record_id)
+
+    related_field = 'segmentation' if package.mode == 'Segmentation' else 'detection'
+    record_ids = set(wanted.values())
+    for record in Records.objects.filter(record_id__in=record_ids).select_related(related_field):
+        field_files = [record.record_link]
+        try:
+            field_files.append(getattr(record, related_field).record_metadata_dynamic_link)
+        except ObjectDoesNotExist:
+            pass
+        for field_file in field_files:
+            url = build_full_url(field_file)
+            if url and package_archive_member_name(url) in wanted:
+                yield package_archive_member_name(url), field_file
+
+
+class _TarStreamBuffer:
+    """Write-only file object for tarfile in stream mode, the written bytes are taken by the response"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_tar(files):
+    """
+    Stream an uncompressed tar of the files chunk by chunk, the archive is never stored.
+
+    Args:
+        files: Iterable of (member name, field file) pairs
+    """
+    buffer = _TarStreamBuffer()
+    with tarfile.open(fileobj=buffer, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+        for name, field_file in files:
+            try:
+                source = field_file.storage.open(field_file.name, 'rb')
+                size = field_file.storage.size(field_file.name)
+            except (OSError, ValueError) as e:
+                logging.getLogger(__name__).error(f"File {field_file.name} is left out of the package archive: {e}")
+                continue
+            with source:
+                member = tarfile.TarInfo(name=name)
+                member.size = size
+                archive.addfile(member, source)
+            yield buffer.take()
+    yield buffer.take()
+
+
+async def iterate_in_thread(iterator):
+    """
+    Serve a blocking iterator to an ASGI response chunk by chunk, Django would
+    otherwise read a synchronous streaming iterator completely into memory first
+    """
+    iterator = iter(iterator)
+    end = object()
+    while True:
+        chunk = await sync_to_async(next)(iterator, end)
+        if chunk is end:
+            break
+        yield chunk
+
+
 def hex_to_rgb_lable(hex_color):
     hex_color = hex_color.lstrip("#")
     return tuple(int(hex_color[i : i + 2], 16) for i in (0, 2, 4))
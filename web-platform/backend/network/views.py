@@ -2,6 +2,7 @@
 import json
 import io
 import os
+import asyncio
 from django.core.files.base import ContentFile
 from django.db.models import Count, Q, Case, When, Value, BooleanField
 from collections import Counter
@@ -9,15 +10,26 @@ from django.db import transaction
 from django.utils import timezone
 from celery import group
 import requests
-from .utils import build_full_url, notify_dataset_status_change, calculate_segmentation_metrics
+from .utils import build_full_url, notify_dataset_status_change, notify_package_created, calculate_segmentation_metrics, PACKAGES_GROUP
+from .utils import package_archive_files, stream_tar, iterate_in_thread, training_records, training_package_entries
 from PIL import Image
 from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from urllib.parse import urljoin
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.response import Response
 from rest_framework import permissions, generics, viewsets, status
 from rest_framework.views import APIView
 from .serializers import UserSerializer, RegisterSerializer, DatasetsCreateSerializer, DatasetsReadSerializer, PackageStatusSerializer, DatasetStatusSerializer, PackageSerializer, DatasetManagementSerializer, ValidationSerializer,RecordsInfoSerializer, AssetsManagementSerializer, AssetSerializer, AssetRecordsSerializer, AnnotationRecordSerializer 
+from .serializers import PackageClaimSerializer, PackageHeartbeatSerializer
 from .serializers import AccessTypesSerializer, MetadataStaticTablesSerializer, DatasetTablesSerializer, LabelPropertiesSerializer, CopyDatasetSerializer, ProcessedFilesViewSerializer,DownloadDatasetSerializer, SpeciesTablesSerializer,LocalizationTablesSerializer, DiagnosisTablesSerializer,SexTablesSerializer, ObjectMetadataTablesSerializer, SpeciesSerializer, DiagnosisSerializer, ObjectMetadataSerializer, GroupUserLinkageSerializer,GroupUserLinkageViewSerializer, MetadataStaticChangeSerializer, DeviceTypeTablesSerializer, ScalingValueTablesSerializer, DeviceTypeSerializer, ScalingValueSerializer
-from .models import Users, Records, Access_Group_Linkage, Group_User_Linkage, Assets,UserPreferences, Assets_Metadata_Dynamic,DownloadDataset, Datasets, Access_Policies, Groups , UploadTransfer, Roles, Processing_Types, Detection, Segmentation, Package, Access_Types, Metadata_Static, Device_Type, Scaling_Value, Object_Metadata, Sex, Species, Localization, Diagnosis
+from .models import Users, Records, Access_Group_Linkage, Group_User_Linkage, Assets,UserPreferences, Assets_Metadata_Dynamic,DownloadDataset, Datasets, Access_Policies, Groups , UploadTransfer, Roles, Processing_Types, Detection, Segmentation, Package, TrainingSet, Access_Types, Metadata_Static, Device_Type, Scaling_Value, Object_Metadata, Sex, Species, Localization, Diagnosis
 from .services import create_dataset,process_label_properties, delete_record, delete_asset, delete_dataset
 from .tasks import recalculate_all_metrics, generate_dataset_archive, copy_dataset, clean_annotations_after_class_delete, update_annotation_colors
 class ProfileView(generics.GenericAPIView):
@@ -673,23 +685,36 @@ class PackageViewSet(viewsets.ModelViewSet):
                 validation_field = 'validation_mask_flag' if mode == 'Segmentation' else 'validation_bbox_flag'
                 records_filter = {validation_field: False}
             
+            package_data = {}
+            since = None
+            watermark = None
             if task == 'TRAIN':
-
-                related_field = 'segmentation' if mode == 'Segmentation' else 'detection'
-                records = Records.objects.filter(
-                    asset_id__dataset_id=dataset,
-                    **records_filter
-                ).select_related(related_field).exclude(
-                    **{f'{related_field}__isnull': True}
-                )
-                
-                records_task = [
-                    {record.record_id: [
-                        build_full_url(record.record_link, False),
-                        build_full_url(getattr(record, related_field).record_metadata_dynamic_link, False)
-                    ]}
-                    for record in records
-                ]
+                # Taken before the records are read, a change made while the package is built is sent again next time
+                watermark = timezone.now()
+                records = training_records(dataset, mode)
+                record_ids = list(records.values_list('record_id', flat=True))
+                previous_ids = None
+                if serializer.validated_data.get('incremental'):
+                    since, previous_ids = previous_training_set(user, dataset, mode)
+
+                if previous_ids is not None:
+                    related_field = 'segmentation' if mode == 'Segmentation' else 'detection'
+                    changed_ids = set(records.filter(
+                        Q(updated_at__gt=since) | Q(**{f'{related_field}__updated_at__gt': since})
+                    ).values_list('record_id', flat=True))
+                    changed_ids.update(set(record_ids) - previous_ids)
+                    records = records.filter(record_id__in=changed_ids)
+                    package_data['deleted'] = sorted(previous_ids - set(record_ids))
+                else:
+                    since = None
+
+                records_task = training_package_entries(records, mode)
+                package_data.update({
+                    'dataset_id': dataset.dataset_id,
+                    'since': since.isoformat() if since else None,
+                    'watermark': watermark.isoformat(),
+                    'record_ids': record_ids
+                })
             else:
                 records = Records.objects.filter(
                     asset_id__dataset_id=dataset,
@@ -708,15 +733,32 @@ class PackageViewSet(viewsets.ModelViewSet):
                     'label_properties': dataset.label_properties,
                     'mode': mode,
                     'task': task,
-                    'package_status': 'CREATED'
+                    'package_status': 'CREATED',
+                    'lease_owner': None,
+                    'lease_expires_at': None,
+                    'attempts': 0,
+                    'retry_after': None,
+                    'since': since,
+                    'watermark': watermark
                 }
             )
             
-            records_json = json.dumps({'records': records_task})
+            # The ML server downloads all files of the package in one request from the archive
+            package_data.update({
+                'records': records_task,
+                'archive': urljoin(settings.BASE_URL, reverse('package_archive', args=[package.package_id]))
+            })
+            if task == 'TRAIN':
+                # An ML server that does not hold the previous training set takes the full one from here
+                package_data['full'] = urljoin(settings.BASE_URL, reverse('package_records', args=[package.package_id]))
+            records_json = json.dumps(package_data)
             record_file = ContentFile(records_json.encode('utf-8'), name='records_package.json')
             package.package = record_file
             package.save()
 
+            # ML servers waiting for a package are woken up only once the package is visible to them
+            transaction.on_commit(lambda: notify_package_created(package.package_id, package.mode))
+
                     
 
 class PackageGetViewSet(APIView):
@@ -728,7 +770,12 @@ class PackageGetViewSet(APIView):
     
     def get(self, request, *args, **kwargs):
        
-        package = Package.objects.filter(package_status='CREATED').order_by('-package_id').first()
+        packages = Package.objects.filter(package_status='CREATED').filter(
+            Q(retry_after__isnull=True) | Q(retry_after__lte=timezone.now()))
+        modes = request.query_params.getlist('mode')
+        if modes:
+            packages = packages.filter(mode__in=modes)
+        package = packages.order_by('-package_id').first()
         if not package:
             return Response({"error": "No packages found"}, status=status.HTTP_404_NOT_FOUND)
         dataset = package.dataset_id
@@ -748,6 +795,201 @@ class PackageGetViewSet(APIView):
                 return Response({"error": "You don't have access to this dataset"}, status=status.HTTP_403_FORBIDDEN)
     
 
+def previous_training_set(user, dataset, mode):
+    """
+    Watermark and record IDs of the last finished training package of the dataset
+
+    Returns:
+        (since, record_ids), record_ids is None when there is no package to build a delta on
+    """
+    training_set = TrainingSet.objects.filter(user_id=user, dataset_id=dataset, mode=mode).first()
+    if not training_set:
+        return None, None
+    return training_set.watermark, set(training_set.record_ids)
+
+
+def record_training_set(package):
+    """Keep the watermark and record IDs of a finished training package as the base of the next delta"""
+    if package.task != 'TRAIN' or not package.watermark or not package.package:
+        return
+    try:
+        with package.package.open('rb') as package_file:
+            record_ids = json.load(package_file).get('record_ids')
+    except (OSError, ValueError):
+        return
+    if record_ids is None:
+        return
+    TrainingSet.objects.update_or_create(
+        user_id=package.user_id,
+        dataset_id=package.dataset_id,
+        mode=package.mode,
+        defaults={'watermark': package.watermark, 'record_ids': record_ids}
+    )
+
+
+def accessible_packages(user):
+    user_groups = Group_User_Linkage.objects.filter(user_id=user.user_id).values('group_id')
+    access_policies = Access_Group_Linkage.objects.filter(group_id__in=user_groups).values('access_policy_id')
+    return Package.objects.filter(dataset_id__access_policy_id__in=access_policies)
+
+
+def claimable_packages(user, modes=None):
+    # A package requeued after a failed run waits for its backoff
+    packages = accessible_packages(user).filter(package_status='CREATED').filter(
+        Q(retry_after__isnull=True) | Q(retry_after__lte=timezone.now()))
+    if modes:
+        packages = packages.filter(mode__in=modes)
+    return packages
+
+
+async def package_wait_view(request):
+    """
+    Long-poll for a claimable package.
+
+    Returns as soon as a package of one of the requested modes is created or the
+    timeout expires. The response only tells whether there is something to claim,
+    the package itself is taken with PackageClaimView.
+    """
+    if request.method != 'GET':
+        return JsonResponse({"error": "Method not allowed"}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    try:
+        auth_result = await sync_to_async(JWTAuthentication().authenticate)(request)
+    except AuthenticationFailed as e:
+        return JsonResponse({"error": str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+    if auth_result is None:
+        return JsonResponse({"error": "Authentication credentials were not provided"}, status=status.HTTP_401_UNAUTHORIZED)
+    user = auth_result[0]
+
+    modes = request.GET.getlist('mode')
+    try:
+        timeout = min(float(request.GET.get('timeout', settings.PACKAGE_WAIT_TIMEOUT)), settings.PACKAGE_WAIT_TIMEOUT)
+    except ValueError:
+        return JsonResponse({"error": "Invalid timeout"}, status=status.HTTP_400_BAD_REQUEST)
+
+    channel_layer = get_channel_layer()
+    channel_name = await channel_layer.new_channel()
+    # Subscribe before looking at the database so a package created in between is not missed
+    await channel_layer.group_add(PACKAGES_GROUP, channel_name)
+    try:
+        if await sync_to_async(claimable_packages(user, modes).exists)():
+            return JsonResponse({"available": True})
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return JsonResponse({"available": False})
+            try:
+                event = await asyncio.wait_for(channel_layer.receive(channel_name), remaining)
+            except asyncio.TimeoutError:
+                return JsonResponse({"available": False})
+            if not modes or event.get('mode') in modes:
+                return JsonResponse({"available": True, "package_id": event.get('package_id')})
+    finally:
+        await channel_layer.group_discard(PACKAGES_GROUP, channel_name)
+
+
+class PackageClaimView(APIView):
+    """
+    Atomically claim the newest CREATED package and lease it to a worker.
+
+    Rows locked by a concurrent claim are skipped, so every package is handed
+    to exactly one worker. The lease must be extended with heartbeats, expired
+    leases are requeued by the requeue_expired_packages task.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = PackageClaimSerializer
+
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        modes = serializer.validated_data['modes']
+        worker = serializer.validated_data['worker']
+        lease_seconds = serializer.validated_data.get('lease_seconds', settings.PACKAGE_LEASE_SECONDS)
+
+        with transaction.atomic():
+            packages = claimable_packages(request.user, modes).select_for_update(skip_locked=True, of=('self',))
+            package = packages.order_by('-package_id').first()
+            if not package:
+                return Response({"error": "No packages found"}, status=status.HTTP_404_NOT_FOUND)
+
+            package.package_status = 'IN_PROGRESS'
+            package.lease_owner = worker
+            package.lease_expires_at = timezone.now() + timedelta(seconds=lease_seconds)
+            package.save(update_fields=['package_status', 'lease_owner', 'lease_expires_at'])
+
+        return Response(PackageSerializer(package).data, status=status.HTTP_200_OK)
+
+
+class PackageHeartbeatView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = PackageHeartbeatSerializer
+
+    def put(self, request, package_id):
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        worker = serializer.validated_data['worker']
+        lease_seconds = serializer.validated_data.get('lease_seconds', settings.PACKAGE_LEASE_SECONDS)
+
+        with transaction.atomic():
+            package = get_object_or_404(Package.objects.select_for_update(), package_id=package_id)
+            if package.package_status != 'IN_PROGRESS' or package.lease_owner != worker:
+                return Response({"error": "Lease is not held by this worker"}, status=status.HTTP_409_CONFLICT)
+            package.lease_expires_at = timezone.now() + timedelta(seconds=lease_seconds)
+            package.save(update_fields=['lease_expires_at'])
+
+        return Response({"package_id": package.package_id, "lease_expires_at": package.lease_expires_at}, status=status.HTTP_200_OK)
+
+
+class PackageArchiveView(APIView):
+    """
+    All files of a package as one streamed tar.
+
+    Member names are the URL paths of the files in the package JSON, so the ML server
+    can map them back to records. The archive is built while it is sent.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, package_id):
+        package = get_object_or_404(accessible_packages(request.user), package_id=package_id)
+        if not package.package:
+            return Response({"error": "Package has no data"}, status=status.HTTP_404_NOT_FOUND)
+
+        records = None
+        if package.task == 'TRAIN' and request.GET.get('full'):
+            records = training_package_entries(training_records(package.dataset_id, package.mode), package.mode)
+
+        response = StreamingHttpResponse(
+            iterate_in_thread(stream_tar(package_archive_files(package, records))),
+            content_type='application/x-tar'
+        )
+        response['Content-Disposition'] = f'attachment; filename="package_{package_id}.tar"'
+        return response
+
+
+class PackageRecordsView(APIView):
+    """
+    Full training set behind an incremental training package.
+
+    Returned to an ML server whose retained training set does not match the watermark
+    the package was built on, it is read at request time.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, package_id):
+        package = get_object_or_404(accessible_packages(request.user), package_id=package_id)
+        if package.task != 'TRAIN':
+            return Response({"error": "Only training packages have a full training set"}, status=status.HTTP_400_BAD_REQUEST)
+
+        records = training_records(package.dataset_id, package.mode)
+        return Response({
+            'records': training_package_entries(records, package.mode),
+            'record_ids': [record.record_id for record in records],
+            'archive': urljoin(settings.BASE_URL, reverse('package_archive', args=[package.package_id])) + '?full=1'
+        })
+
+
 class ProcessedPackageView(APIView):
   
     permission_classes = [permissions.IsAuthenticated]
@@ -836,14 +1078,27 @@ class PackageStatusView(APIView):
     serializer_class = PackageStatusSerializer
     def put(self, request, package_id):
         serializer = self.serializer_class(data=request.data, context={'request': request})
-      
-        if serializer.is_valid():
-            queryset = Package.objects.get(package_id=package_id)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            queryset = get_object_or_404(Package.objects.select_for_update(), package_id=package_id)
+            if queryset.lease_owner != serializer.validated_data['worker']:
+                # The lease expired and the package may already be run by another worker
+                return Response({"error": "Lease is not held by this worker"}, status=status.HTTP_409_CONFLICT)
             queryset.package_status = serializer.validated_data['package_status']
+            failed_run = queryset.package_status == 'CREATED' and not serializer.validated_data['released']
+            if failed_run:
+                # Waiting workers are not woken up, they find the package by polling once the backoff is over
+                queryset.record_failed_attempt(settings.PACKAGE_MAX_ATTEMPTS, settings.PACKAGE_RETRY_BACKOFF_SECONDS)
+            if queryset.package_status != 'IN_PROGRESS':
+                queryset.release_lease()
             queryset.save()
-            serializer = self.serializer_class(queryset)
-            return Response(serializer.data, status=status.HTTP_200_OK)  
-        
+            if queryset.package_status == 'DONE':
+                record_training_set(queryset)
+            if queryset.package_status == 'CREATED' and not failed_run:
+                transaction.on_commit(lambda: notify_package_created(queryset.package_id, queryset.mode))
+        serializer = self.serializer_class(queryset)
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
 
 class Tables_Dataset_And_Metadata_Static_View(APIView):